@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+'''
+Micro-benchmarks of the hot paths of training and decoding, runnable on
+CPU with synthetic data (see synthetic.py):
+
+  - CtcTrainingGraphCompiler.compile and MmiTrainingGraphCompiler.compile
+  - CTCLoss and LFMMILoss (exact, pruned and memory budget modes),
+    forward and backward
+  - compile_HLG
+  - k2.intersect_dense_pruned with the HLG
+  - rescore_with_n_best_list and rescore_with_whole_lattice
+
+Each benchmark runs for every batch size and vocabulary size given. The
+timings are written as JSON, along with the commit and the library
+versions, so that runs on different commits can be compared:
+
+    python3 benchmarks/run_benchmarks.py --output master.json
+    git checkout my-branch
+    python3 benchmarks/run_benchmarks.py --output my-branch.json \\
+        --baseline master.json --max-slowdown 1.2
+
+With --baseline, the script exits with status 1 if a benchmark is more
+than --max-slowdown times slower than in the baseline, or if it fails
+while it succeeded in the baseline.
+'''
+
+import argparse
+import json
+import logging
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import k2
+import torch
+
+from snowfall.decoding.graph import compile_HLG, prepare_HLG
+from snowfall.decoding.lm_rescore import rescore_with_n_best_list
+from snowfall.decoding.lm_rescore import rescore_with_whole_lattice
+from snowfall.lexicon import Lexicon
+from snowfall.objectives import CTCLoss, LFMMILoss
+from snowfall.training.ctc_graph import CtcTrainingGraphCompiler, build_ctc_topo
+from snowfall.training.mmi_graph import MmiTrainingGraphCompiler, create_bigram_phone_lm
+from synthetic import SyntheticLang
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--output',
+        type=Path,
+        default=Path('benchmarks.json'),
+        help='The JSON file to which the results are written.')
+    parser.add_argument(
+        '--batch-sizes',
+        type=int,
+        nargs='+',
+        default=[4, 16],
+        help='Number of sequences per batch.')
+    parser.add_argument(
+        '--vocab-sizes',
+        type=int,
+        nargs='+',
+        default=[1000, 5000],
+        help='Number of words of the synthetic lexicons.')
+    parser.add_argument(
+        '--num-phones',
+        type=int,
+        default=40,
+        help='Number of phones of the synthetic lexicons.')
+    parser.add_argument(
+        '--lm-successors',
+        type=int,
+        default=10,
+        help='Number of successors of each word in the synthetic bigram LM.')
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=5,
+        help='Number of timed runs of each benchmark.')
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=1,
+        help='Number of untimed runs of each benchmark before the timed ones.')
+    parser.add_argument(
+        '--benchmarks',
+        type=str,
+        default='.*',
+        help='A regular expression; only the benchmarks whose name matches '
+             'it are run.')
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cpu',
+        help='The device to run the benchmarks on.')
+    parser.add_argument(
+        '--num-threads',
+        type=int,
+        default=1,
+        help='Number of threads used by PyTorch on CPU. A fixed number '
+             'makes the timings comparable across machines and runs.')
+    parser.add_argument(
+        '--memory-budget',
+        type=float,
+        default=2 ** 27,
+        help='The memory budget, in bytes, of LFMMILoss in memory budget mode. '
+             'The default is small enough for the larger batches to be split.')
+    parser.add_argument(
+        '--search-beam',
+        type=float,
+        default=20.0,
+        help='search_beam of k2.intersect_dense_pruned in decoding.')
+    parser.add_argument(
+        '--output-beam',
+        type=float,
+        default=8.0,
+        help='output_beam of k2.intersect_dense_pruned in decoding.')
+    parser.add_argument(
+        '--num-paths',
+        type=int,
+        default=100,
+        help='Number of paths for rescore_with_n_best_list.')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='The random seed of the synthetic data.')
+    parser.add_argument(
+        '--baseline',
+        type=Path,
+        default=None,
+        help='The JSON file of a previous run to compare with.')
+    parser.add_argument(
+        '--max-slowdown',
+        type=float,
+        default=1.2,
+        help='With --baseline, the largest acceptable ratio of the median '
+             'times of a benchmark in this run and in the baseline.')
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        default='warning',
+        choices=['debug', 'info', 'warning'],
+        help='The log level of the libraries; compile_HLG logs every stage '
+             'at the info level.')
+    return parser
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class BenchmarkRunner(object):
+    '''Runs the benchmarks and collects their results.'''
+
+    def __init__(self, device: torch.device, repeats: int, warmup: int,
+                 pattern: str):
+        self.device = device
+        self.repeats = repeats
+        self.warmup = warmup
+        self.pattern = re.compile(pattern)
+        self.results: List[Dict[str, Any]] = []
+
+    def run(self,
+            name: str,
+            params: Dict[str, Any],
+            fn: Callable[..., Optional[Dict[str, Any]]],
+            setup: Optional[Callable[[], Tuple]] = None) -> None:
+        '''Time `fn(*setup())` and record the result.
+
+        `setup` is called before each run and is not timed. It returns the
+        arguments of `fn`, which may modify them. If `fn` returns a dict,
+        the one of the last run is stored as `info` with the result, e.g.,
+        the size of the graphs it built.
+        '''
+        if not self.pattern.search(name):
+            return
+        result = dict(name=name, params=params)
+        times = []
+        try:
+            for i in range(self.warmup + self.repeats):
+                args = setup() if setup is not None else ()
+                _synchronize(self.device)
+                start = time.perf_counter()
+                info = fn(*args)
+                _synchronize(self.device)
+                if i >= self.warmup:
+                    times.append(1000.0 * (time.perf_counter() - start))
+        except Exception as e:
+            logging.exception(f'Benchmark {name} {params} failed')
+            result['error'] = f'{type(e).__name__}: {e}'
+        else:
+            result.update(times_ms=times,
+                          median_ms=statistics.median(times),
+                          mean_ms=statistics.mean(times),
+                          min_ms=min(times))
+            if info is not None:
+                result['info'] = info
+        self.results.append(result)
+        print(_format_result(result), flush=True)
+
+
+def _format_params(params: Dict[str, Any]) -> str:
+    return ' '.join(f'{k}={v}' for k, v in sorted(params.items()))
+
+
+def _format_result(result: Dict[str, Any]) -> str:
+    if 'error' in result:
+        timing = f'FAILED ({result["error"]})'
+    else:
+        timing = f'median {result["median_ms"]:10.2f} ms, ' \
+                 f'min {result["min_ms"]:10.2f} ms'
+    return f'{result["name"]:<24} {_format_params(result["params"]):<44} {timing}'
+
+
+def _num_arcs(fsa: k2.Fsa) -> int:
+    return fsa.arcs.num_elements()
+
+
+def benchmark_vocab(runner: BenchmarkRunner, args: argparse.Namespace,
+                    vocab_size: int, lang_dir: Path) -> None:
+    '''Run all the benchmarks with a synthetic lexicon of `vocab_size`
+    words.'''
+    device = runner.device
+    lang = SyntheticLang(num_words=vocab_size,
+                         num_phones=args.num_phones,
+                         seed=args.seed)
+    lang.write(lang_dir)
+    lexicon = Lexicon(lang_dir)
+    G = lang.G(successors=args.lm_successors, seed=args.seed)
+
+    with open(lang_dir / 'L_disambig.fst.txt') as f:
+        L = k2.Fsa.from_openfst(f.read(), acceptor=False)
+    H = build_ctc_topo([0] + lang.phone_ids)
+
+    def compile_hlg() -> Dict[str, Any]:
+        HLG = compile_HLG(L=L,
+                          G=G,
+                          H=H,
+                          labels_disambig_id_start=lang.first_phone_disambig_id,
+                          aux_labels_disambig_id_start=lang.first_word_disambig_id)
+        return dict(num_arcs=_num_arcs(HLG))
+
+    runner.run('compile_HLG', dict(vocab_size=vocab_size), compile_hlg)
+
+    HLG = prepare_HLG(compile_HLG(
+        L=L,
+        G=G,
+        H=H,
+        labels_disambig_id_start=lang.first_phone_disambig_id,
+        aux_labels_disambig_id_start=lang.first_word_disambig_id).to(device))
+
+    G_rescore = lang.rescoring_G(G).to(device)
+    G_rescore.lm_scores = G_rescore.scores.clone()
+    G_with_epsilon_loops = k2.arc_sort(k2.add_epsilon_self_loops(G_rescore))
+    G_with_epsilon_loops.lm_scores = G_with_epsilon_loops.scores.clone()
+
+    ctc_compiler = CtcTrainingGraphCompiler(L_inv=lexicon.L_inv.to(device),
+                                            phones=lexicon.phones,
+                                            words=lexicon.words)
+    P = create_bigram_phone_lm(lang.phone_ids)
+    mmi_compiler = MmiTrainingGraphCompiler(lexicon=lexicon, P=P, device=device)
+    losses = {
+        'ctc': CTCLoss(ctc_compiler),
+        'mmi_exact': LFMMILoss(mmi_compiler),
+        'mmi_pruned': LFMMILoss(mmi_compiler, use_pruned_intersect=True),
+        'mmi_memory_budget': LFMMILoss(mmi_compiler,
+                                       memory_budget=args.memory_budget),
+    }
+
+    rng = random.Random(args.seed)
+
+    for batch_size in args.batch_sizes:
+        params = dict(vocab_size=vocab_size, batch_size=batch_size)
+
+        # New transcripts for every run, so that the caches of the
+        # compilers are cold, as for most batches in training.
+        def texts() -> Tuple[List[str]]:
+            return lang.transcripts(batch_size, rng),
+
+        def compile_ctc(texts: List[str]) -> Dict[str, Any]:
+            return dict(num_arcs=_num_arcs(ctc_compiler.compile(texts)))
+
+        def compile_mmi(texts: List[str]) -> Dict[str, Any]:
+            num_graphs, _ = mmi_compiler.compile(texts, replicate_den=False)
+            return dict(num_arcs=_num_arcs(num_graphs))
+
+        runner.run('ctc_graph_compile', params, compile_ctc, texts)
+        runner.run('mmi_graph_compile', params, compile_mmi, texts)
+
+        def loss_inputs() -> Tuple[torch.Tensor, List[str], torch.Tensor]:
+            texts = lang.transcripts(batch_size, rng)
+            nnet_output, supervision_segments = lang.nnet_output(texts, rng)
+            nnet_output = nnet_output.to(device).requires_grad_(True)
+            return nnet_output, texts, supervision_segments
+
+        for mode, loss_fn in losses.items():
+            def forward_backward(nnet_output: torch.Tensor, texts: List[str],
+                                 supervision_segments: torch.Tensor) -> None:
+                tot_score, _, _ = loss_fn(nnet_output, texts,
+                                          supervision_segments)
+                (-tot_score).backward()
+
+            name = 'ctc_loss' if mode == 'ctc' else 'lfmmi_loss'
+            runner.run(name, dict(params, mode=mode), forward_backward,
+                       loss_inputs)
+
+        def dense_fsa_vec() -> Tuple[k2.DenseFsaVec]:
+            texts = lang.transcripts(batch_size, rng)
+            nnet_output, supervision_segments = lang.nnet_output(texts, rng)
+            return k2.DenseFsaVec(nnet_output.to(device),
+                                  supervision_segments),
+
+        def intersect(dense_fsa_vec: k2.DenseFsaVec) -> k2.Fsa:
+            return k2.intersect_dense_pruned(HLG, dense_fsa_vec,
+                                             args.search_beam,
+                                             args.output_beam,
+                                             min_active_states=30,
+                                             max_active_states=10000)
+
+        def decode(dense_fsa_vec: k2.DenseFsaVec) -> Dict[str, Any]:
+            return dict(num_arcs=_num_arcs(intersect(dense_fsa_vec)))
+
+        runner.run('intersect_dense_pruned', params, decode, dense_fsa_vec)
+
+        def lattices() -> Tuple[k2.Fsa]:
+            return intersect(*dense_fsa_vec()),
+
+        def n_best(lats: k2.Fsa) -> None:
+            rescore_with_n_best_list(lats, G_rescore, args.num_paths,
+                                     lm_scale_list=[1.0])
+
+        def whole_lattice(lats: k2.Fsa) -> None:
+            rescore_with_whole_lattice(lats, G_with_epsilon_loops,
+                                       lm_scale_list=[1.0])
+
+        runner.run('rescore_n_best_list', dict(params, num_paths=args.num_paths),
+                   n_best, lattices)
+        runner.run('rescore_whole_lattice', params, whole_lattice, lattices)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).parent,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result: Dict[str, Any]) -> str:
+    return f'{result["name"]} {_format_params(result["params"])}'
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any],
+            max_slowdown: float) -> bool:
+    '''Print the ratio of the median times of the benchmarks in `results`
+    and in `baseline`. Return False if one of them is slower than
+    `max_slowdown` times its baseline, or if it fails while it succeeded
+    in the baseline.'''
+    baseline_results = {_key(r): r for r in baseline['results'] if 'error' not in r}
+    print(f'\nComparison with commit {baseline["metadata"].get("commit")}:')
+    ok = True
+    for result in results:
+        old = baseline_results.get(_key(result))
+        if old is None:
+            continue
+        if 'error' in result:
+            ok = False
+            print(f'{_key(result):<69} {old["median_ms"]:10.2f} -> '
+                  f'FAILED ({result["error"]})  REGRESSION')
+            continue
+        ratio = result['median_ms'] / old['median_ms']
+        regression = ratio > max_slowdown
+        ok = ok and not regression
+        print(f'{_key(result):<69} {old["median_ms"]:10.2f} -> '
+              f'{result["median_ms"]:10.2f} ms ({ratio:.2f}x)'
+              f'{"  REGRESSION" if regression else ""}')
+    return ok
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s',
+        level=getattr(logging, args.log_level.upper()))
+
+    torch.set_num_threads(args.num_threads)
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+
+    runner = BenchmarkRunner(device, repeats=args.repeats, warmup=args.warmup,
+                             pattern=args.benchmarks)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for vocab_size in args.vocab_sizes:
+            benchmark_vocab(runner, args, vocab_size,
+                            Path(tmp_dir) / f'lang_{vocab_size}')
+
+    metadata = dict(
+        commit=_git_commit(),
+        date=datetime.now().isoformat(),
+        python=platform.python_version(),
+        torch=torch.__version__,
+        k2=getattr(k2, '__version__', None),
+        platform=platform.platform(),
+        args={k: str(v) if isinstance(v, Path) else v
+              for k, v in vars(args).items()},
+    )
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(dict(metadata=metadata, results=runner.results), f, indent=2)
+    print(f'Wrote {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(runner.results, baseline, args.max_slowdown):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+'''
+Synthetic inputs for the benchmarks: a lang directory with a random
+lexicon, a back-off bigram word LM, random transcripts and network outputs
+that are peaked around an alignment of the transcripts.
+
+Everything is generated from a `random.Random`, so a given seed and set of
+sizes always produces the same inputs.
+'''
+
+import random
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import k2
+import torch
+
+from snowfall.common import Pathlike
+
+OOV = '<UNK>'
+
+
+class SyntheticLang(object):
+    '''A random lexicon over `num_phones` phones and `num_words` words.
+
+    Phone IDs are 1..num_phones, so the network has num_phones + 1 outputs
+    with the blank at 0. Word IDs are 2..num_words + 1, after <eps> and
+    <UNK>. Pronunciations have between `min_phones` and `max_phones`
+    phones and are all distinct.
+    '''
+
+    def __init__(self,
+                 num_words: int,
+                 num_phones: int = 40,
+                 min_phones: int = 2,
+                 max_phones: int = 6,
+                 seed: int = 0):
+        self.num_words = num_words
+        self.num_phones = num_phones
+        rng = random.Random(seed)
+
+        self.phones = [f'P{i}' for i in range(1, num_phones + 1)]
+        self.words = [OOV] + [f'W{i}' for i in range(1, num_words + 1)]
+        self.word_ids = {w: i for i, w in enumerate(self.words, start=1)}
+
+        prons = set()
+        self.lexicon: Dict[str, List[int]] = dict()
+        for word in self.words:
+            while True:
+                pron = tuple(rng.randint(1, num_phones) for _ in range(
+                    rng.randint(min_phones, max_phones)))
+                if pron not in prons:
+                    break
+            prons.add(pron)
+            self.lexicon[word] = list(pron)
+
+        # <eps>, the phones, then #0 and #1
+        self.first_phone_disambig_id = num_phones + 1
+        # <eps>, <UNK>, the words, then #0
+        self.first_word_disambig_id = len(self.words) + 1
+
+    @property
+    def phone_ids(self) -> List[int]:
+        return list(range(1, self.num_phones + 1))
+
+    def write(self, lang_dir: Pathlike) -> None:
+        '''Write phones.txt, words.txt, L.fst.txt and L_disambig.fst.txt
+        to `lang_dir`, as the data preparation of the recipes does.'''
+        lang_dir = Path(lang_dir)
+        lang_dir.mkdir(parents=True, exist_ok=True)
+        with open(lang_dir / 'phones.txt', 'w') as f:
+            for i, s in enumerate(['<eps>'] + self.phones + ['#0', '#1']):
+                f.write(f'{s} {i}\n')
+        with open(lang_dir / 'words.txt', 'w') as f:
+            for i, s in enumerate(['<eps>'] + self.words + ['#0']):
+                f.write(f'{s} {i}\n')
+        with open(lang_dir / 'L.fst.txt', 'w') as f:
+            f.write(self._lexicon_fst(disambig=False))
+        with open(lang_dir / 'L_disambig.fst.txt', 'w') as f:
+            f.write(self._lexicon_fst(disambig=True))
+
+    def _lexicon_fst(self, disambig: bool) -> str:
+        '''Return L (phones to words) in OpenFst text format. State 0 is
+        both the start and the final state.
+
+        With `disambig`, each pronunciation ends with #1, which is enough
+        to make L*G determinizable since the pronunciations are distinct,
+        and #0 of G is passed through by a self-loop on state 0.
+        '''
+        arcs = []
+        next_state = 1
+        for word in self.words:
+            word_id = self.word_ids[word]
+            pron = self.lexicon[word]
+            if disambig:
+                pron = pron + [self.first_phone_disambig_id + 1]
+            src = 0
+            for i, phone in enumerate(pron):
+                if i + 1 == len(pron):
+                    dst = 0
+                else:
+                    dst = next_state
+                    next_state += 1
+                arcs.append((src, dst, phone, word_id if i == 0 else 0))
+                src = dst
+        if disambig:
+            arcs.append((0, 0, self.first_phone_disambig_id,
+                         self.first_word_disambig_id))
+        arcs.sort(key=lambda arc: arc[0])
+        lines = [' '.join(str(x) for x in arc) for arc in arcs]
+        lines.append('0')
+        return '\n'.join(lines) + '\n'
+
+    def G(self, successors: int = 10, seed: int = 0) -> k2.Fsa:
+        '''Return a back-off bigram word LM as an acceptor.
+
+        State 0 is the unigram (and start) state, with an arc to the state
+        of each word, whose number is the word ID. Each word state has arcs
+        to the states of `successors` random words, a back-off arc to
+        state 0 labeled with #0, and an arc to the final state. Scores are
+        random log-probabilities.
+        '''
+        rng = random.Random(seed)
+        num_words = len(self.words)
+        final_state = num_words + 1
+        arcs = []
+
+        def logprob() -> float:
+            return -rng.uniform(0.5, 8.0)
+
+        # Arcs are listed by increasing source state.
+        for w in range(1, num_words + 1):
+            arcs.append(f'0 {w} {w} {logprob()}')
+        for w in range(1, num_words + 1):
+            for n in rng.sample(range(1, num_words + 1),
+                                min(successors, num_words)):
+                arcs.append(f'{w} {n} {n} {logprob()}')
+            arcs.append(f'{w} 0 {self.first_word_disambig_id} {logprob()}')
+            arcs.append(f'{w} {final_state} -1 {logprob()}')
+        arcs.append(f'{final_state}')
+        return k2.Fsa.from_str('\n'.join(arcs))
+
+    def rescoring_G(self, G: k2.Fsa) -> k2.Fsa:
+        '''Convert the output of :meth:`G` as
+        :func:`snowfall.decoding.graph.load_G` does: #0 becomes epsilon,
+        and the result is an arc-sorted FsaVec.'''
+        G = k2.Fsa.from_dict(G.as_dict())
+        G.labels[G.labels >= self.first_word_disambig_id] = 0
+        return k2.create_fsa_vec([k2.arc_sort(G)])
+
+    def transcripts(self, num_transcripts: int, rng: random.Random,
+                    min_words: int = 5, max_words: int = 20) -> List[str]:
+        '''Return random transcripts of in-vocabulary words.'''
+        return [
+            ' '.join(rng.choice(self.words[1:])
+                     for _ in range(rng.randint(min_words, max_words)))
+            for _ in range(num_transcripts)
+        ]
+
+    def nnet_output(self, texts: List[str], rng: random.Random,
+                    peak: float = 5.0) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''Return log-probabilities that favour an alignment of `texts`.
+
+        Each phone lasts 1 to 3 frames and is followed by up to 2 blank
+        frames; the score of the aligned output is increased by `peak`
+        before the log-softmax, so that the lattices look more like those
+        of a trained model than of random noise.
+
+        Returns:
+          A tuple (nnet_output, supervision_segments), where `nnet_output`
+          has shape [N, T, num_phones + 1] and `supervision_segments` is
+          sorted by decreasing number of frames, as expected by
+          `k2.DenseFsaVec`.
+        '''
+        alignments = []
+        for text in texts:
+            alignment = [0] * rng.randint(0, 2)
+            for word in text.split():
+                for phone in self.lexicon[word]:
+                    alignment += [phone] * rng.randint(1, 3)
+                    alignment += [0] * rng.randint(0, 2)
+            alignments.append(alignment)
+
+        num_frames = max(len(a) for a in alignments)
+        generator = torch.Generator().manual_seed(rng.randint(0, 2 ** 31))
+        logits = torch.randn(len(texts), num_frames, self.num_phones + 1,
+                             generator=generator)
+        for i, alignment in enumerate(alignments):
+            frames = torch.arange(len(alignment))
+            logits[i, frames, torch.tensor(alignment)] += peak
+        nnet_output = logits.log_softmax(dim=-1)
+
+        supervision_segments = torch.tensor(
+            [[i, 0, len(a)] for i, a in enumerate(alignments)],
+            dtype=torch.int32)
+        indices = torch.argsort(supervision_segments[:, 2], descending=True)
+        return nnet_output, supervision_segments[indices]
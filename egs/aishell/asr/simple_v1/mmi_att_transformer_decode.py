@@ -11,19 +11,19 @@ import logging
 import numpy as np
 import os
 import torch
-from k2 import Fsa, SymbolTable
+from k2 import SymbolTable
 from kaldialign import edit_distance
 from pathlib import Path
 from typing import List
-from typing import Union
 
 from snowfall.common import average_checkpoint
 from snowfall.common import find_first_disambig_symbol
-from snowfall.common import get_texts
+from snowfall.common import get_word_table
 from snowfall.common import load_checkpoint
 from snowfall.common import setup_logger
 from snowfall.data import AishellAsrDataModule
-from snowfall.decoding.graph import compile_LG
+from snowfall.decoding.engine import DecodingEngine
+from snowfall.decoding.graph import compile_HLG, load_HLG, save_HLG
 from snowfall.models import AcousticModel
 from snowfall.models.transformer import Transformer
 from snowfall.models.conformer import Conformer
@@ -32,67 +32,6 @@ from snowfall.training.mmi_graph import create_bigram_phone_lm
 from snowfall.training.mmi_graph import get_phone_symbols
 
 
-def decode(dataloader: torch.utils.data.DataLoader, model: AcousticModel,
-           device: Union[str, torch.device], LG: Fsa, symbols: SymbolTable):
-    tot_num_cuts = len(dataloader.dataset.cuts)
-    num_cuts = 0
-    results = []  # a list of pair (ref_words, hyp_words)
-    for batch_idx, batch in enumerate(dataloader):
-        feature = batch['inputs']
-        supervisions = batch['supervisions']
-        supervision_segments = torch.stack(
-            (supervisions['sequence_idx'],
-             (((supervisions['start_frame'] - 1) // 2 - 1) // 2),
-             (((supervisions['num_frames'] - 1) // 2 - 1) // 2)), 1).to(torch.int32)
-        supervision_segments = torch.clamp(supervision_segments, min=0)
-        indices = torch.argsort(supervision_segments[:, 2], descending=True)
-        supervision_segments = supervision_segments[indices]
-        texts = supervisions['text']
-        assert feature.ndim == 3
-
-        feature = feature.to(device)
-        # at entry, feature is [N, T, C]
-        feature = feature.permute(0, 2, 1)  # now feature is [N, C, T]
-        with torch.no_grad():
-            nnet_output, _, _ = model(feature, supervisions)
-        # nnet_output is [N, C, T]
-        nnet_output = nnet_output.permute(0, 2,
-                                          1)  # now nnet_output is [N, T, C]
-
-        #  blank_bias = -3.0
-        #  nnet_output[:, :, 0] += blank_bias
-
-        dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
-        # assert LG.is_cuda()
-        assert LG.device == nnet_output.device, \
-            f"Check failed: LG.device ({LG.device}) == nnet_output.device ({nnet_output.device})"
-        # TODO(haowen): with a small `beam`, we may get empty `target_graph`,
-        # thus `tot_scores` will be `inf`. Definitely we need to handle this later.
-        lattices = k2.intersect_dense_pruned(LG, dense_fsa_vec, 20.0, 7.0, 30,
-                                             10000)
-
-        # lattices = k2.intersect_dense(LG, dense_fsa_vec, 10.0)
-        best_paths = k2.shortest_path(lattices, use_double_scores=True)
-        assert best_paths.shape[0] == len(texts)
-        hyps = get_texts(best_paths, indices)
-        assert len(hyps) == len(texts)
-
-        for i in range(len(texts)):
-            hyp_words = [symbols.get(x) for x in hyps[i]]
-            ref_words = texts[i].split(' ')
-            results.append((ref_words, hyp_words))
-
-        if batch_idx % 10 == 0:
-            logging.info(
-                'batch {}, cuts processed until now is {}/{} ({:.6f}%)'.format(
-                    batch_idx, num_cuts, tot_num_cuts,
-                    float(num_cuts) / tot_num_cuts * 100))
-
-        num_cuts += len(texts)
-
-    return results
-
-
 def print_transition_probabilities(P: k2.Fsa, phone_symbol_table: SymbolTable,
                                    phone_ids: List[int], filename: str):
     '''Print the transition probabilities of a phone LM.
@@ -194,6 +133,11 @@ def get_parser():
         type=int,
         default=256,
         help="Number of units in transformer attention layers.")
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cuda',
+        help='The device to decode on, e.g., cuda, cuda:1 or cpu.')
     return parser
 
 
@@ -222,9 +166,7 @@ def main():
     ctc_topo = k2.arc_sort(build_ctc_topo(phone_ids_with_blank))
 
     logging.debug("About to load model")
-    # Note: Use "export CUDA_VISIBLE_DEVICES=N" to setup device id to N
-    # device = torch.device('cuda', 1)
-    device = torch.device('cuda')
+    device = torch.device(args.device)
 
     if att_rate != 0.0:
         num_decoder_layers = 6
@@ -258,9 +200,6 @@ def main():
                        range(epoch - avg, epoch)]
         average_checkpoint(checkpoints, model)
 
-    model.to(device)
-    model.eval()
-
     assert P.requires_grad is False
     P.scores = model.P_scores.cpu()
     print_transition_probabilities(P, phone_symbol_table, phone_ids, filename='model_P_scores.txt')
@@ -268,7 +207,7 @@ def main():
     P.set_scores_stochastic_(model.P_scores)
     print_transition_probabilities(P, phone_symbol_table, phone_ids, filename='P_scores.txt')
 
-    if not os.path.exists(lang_dir / 'LG.pt'):
+    if not os.path.exists(lang_dir / 'HLG.pt'):
         logging.debug("Loading L_disambig.fst.txt")
         with open(lang_dir / 'L_disambig.fst.txt') as f:
             L = k2.Fsa.from_openfst(f.read(), acceptor=False)
@@ -277,35 +216,31 @@ def main():
             G = k2.Fsa.from_openfst(f.read(), acceptor=False)
         first_phone_disambig_id = find_first_disambig_symbol(phone_symbol_table)
         first_word_disambig_id = find_first_disambig_symbol(symbol_table)
-        LG = compile_LG(L=L,
-                        G=G,
-                        ctc_topo=ctc_topo,
-                        labels_disambig_id_start=first_phone_disambig_id,
-                        aux_labels_disambig_id_start=first_word_disambig_id)
-        torch.save(LG.as_dict(), lang_dir / 'LG.pt')
-    else:
-        logging.debug("Loading pre-compiled LG")
-        d = torch.load(lang_dir / 'LG.pt')
-        LG = k2.Fsa.from_dict(d)
+        HLG = compile_HLG(L=L,
+                         G=G,
+                         H=ctc_topo,
+                         labels_disambig_id_start=first_phone_disambig_id,
+                         aux_labels_disambig_id_start=first_word_disambig_id,
+                         cache_dir=lang_dir / 'graph_cache')
+        save_HLG(HLG, lang_dir / 'HLG.pt')
+
+    logging.debug("Loading HLG")
+    HLG = load_HLG(lang_dir / 'HLG.pt', device)
+
+    engine = DecodingEngine(model,
+                            HLG,
+                            strategy='1best',
+                            device=device,
+                            output_beam_size=7.0,
+                            conv_subsampling=True)
+    words = get_word_table(symbol_table)
 
     # load dataset
     aishell = AishellAsrDataModule(args)
     test_dl = aishell.test_dataloaders()
 
-    #  if not torch.cuda.is_available():
-    #  logging.error('No GPU detected!')
-    #  sys.exit(-1)
-
-    logging.debug("convert LG to device")
-    LG = LG.to(device)
-    LG.aux_labels = k2.ragged.remove_values_eq(LG.aux_labels, 0)
-    LG.requires_grad_(False)
     logging.debug("About to decode")
-    results = decode(dataloader=test_dl,
-                     model=model,
-                     device=device,
-                     LG=LG,
-                     symbols=symbol_table)
+    results = engine.decode_dataset(test_dl, words)['no_rescore']
     s = ''
     results2 = []
     for ref, hyp in results:
@@ -209,9 +209,6 @@ def train_one_epoch(
                 curr_batch_objf / (curr_batch_frames + 0.001),
                 global_batch_idx_train,
             )
-            # if batch_idx >= 10:
-            #    print("Exiting early to get profile info")
-            #    sys.exit(0)
 
         if batch_idx > 0 and batch_idx % 200 == 0:
             (
@@ -139,10 +139,10 @@ if [ $stage -le 8 ]; then
       --oov "<UNK>" \
       > data/lm/corpus_${subset}.txt
 
-    ./local/make_kn_lm.py \
-      -ngram-order 2 \
-      -text data/lm/corpus_${subset}.txt \
-      -lm data/lm/P_${subset}.arpa
+    snowfall lm make-kn-lm \
+      --ngram-order 2 \
+      --text data/lm/corpus_${subset}.txt \
+      --lm data/lm/P_${subset}.arpa
   fi
 fi
 
@@ -18,6 +18,7 @@ import numpy as np
 import torch
 
 from snowfall.data import LibriSpeechAsrDataModule
+from snowfall.decoding.attention_rescore import rescore_with_attention_decoder
 from snowfall.common import average_checkpoint, store_transcripts
 from snowfall.common import get_texts
 from snowfall.common import load_checkpoint
@@ -33,7 +34,8 @@ def decode(dataloader: torch.utils.data.DataLoader,
            ctc_topo: None,
            numericalizer=None,
            num_paths=-1,
-           output_beam_size: float=8):
+           output_beam_size: float=8,
+           att_scale: float=0.0):
     tot_num_cuts = len(dataloader.dataset.cuts)
     num_cuts = 0
     results = []
@@ -67,7 +69,19 @@ def decode(dataloader: torch.utils.data.DataLoader,
             lattices = k2.intersect_dense_pruned(ctc_topo, dense_fsa_vec, 20.0,
                                                  output_beam_size, 30, 10000)
 
-        best_paths = k2.shortest_path(lattices, use_double_scores=True)
+        if att_scale > 0 and num_paths > 0:
+            # Rescore the n-best list with the attention decoder, reusing
+            # the encoder output computed above.
+            best_paths = rescore_with_attention_decoder(
+                lattices,
+                num_paths,
+                model=model,
+                memory=encoder_memory,
+                memory_mask=memory_mask,
+                sequence_idx=supervision_segments[:, 0],
+                att_scale_list=[att_scale])[f'att_scale_{att_scale}']
+        else:
+            best_paths = k2.shortest_path(lattices, use_double_scores=True)
         hyps = get_texts(best_paths, indices)
         assert len(hyps) == len(texts)
 
@@ -173,6 +187,14 @@ def get_parser():
         default=8,
         help='Output beam size. Used in k2.intersect_dense_pruned.')
 
+    parser.add_argument(
+        '--att-scale',
+        type=float,
+        default=0.0,
+        help='If positive and --num-paths is positive, the n-best list '\
+             'is rescored with the attention decoder and its scores are '\
+             'scaled by this value.')
+
     return parser
 
 
@@ -264,7 +286,8 @@ def main():
                          ctc_topo=ctc_topo,
                          numericalizer=numericalizer,
                          num_paths=args.num_paths,
-                         output_beam_size=args.output_beam_size)
+                         output_beam_size=args.output_beam_size,
+                         att_scale=args.att_scale)
 
         recog_path = exp_dir / f'recogs-{test_set}.txt'
         store_transcripts(path=recog_path, texts=results)
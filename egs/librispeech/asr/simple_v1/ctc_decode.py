@@ -17,10 +17,11 @@ from lhotse.dataset import K2SpeechRecognitionDataset
 from lhotse.dataset import SingleCutSampler
 from snowfall.common import find_first_disambig_symbol
 from snowfall.common import get_phone_symbols
-from snowfall.common import get_texts
+from snowfall.common import get_word_table
+from snowfall.common import get_word_texts
 from snowfall.common import load_checkpoint
 from snowfall.common import setup_logger
-from snowfall.decoding.graph import compile_HLG
+from snowfall.decoding.graph import compile_HLG, load_HLG, save_HLG
 from snowfall.models import AcousticModel
 from snowfall.models.tdnn_lstm import TdnnLstm1b
 from snowfall.training.ctc_graph import build_ctc_topo
@@ -30,6 +31,7 @@ def decode(dataloader: torch.utils.data.DataLoader, model: AcousticModel,
            device: Union[str, torch.device], HLG: Fsa, symbols: SymbolTable):
     tot_num_cuts = len(dataloader.dataset.cuts)
     num_cuts = 0
+    words = get_word_table(symbols)
     results = []  # a list of pair (ref_words, hyp_words)
     for batch_idx, batch in enumerate(dataloader):
         feature = batch['inputs']
@@ -69,11 +71,11 @@ def decode(dataloader: torch.utils.data.DataLoader, model: AcousticModel,
         # lattices = k2.intersect_dense(HLG, dense_fsa_vec, 10.0)
         best_paths = k2.shortest_path(lattices, use_double_scores=True)
         assert best_paths.shape[0] == len(texts)
-        hyps = get_texts(best_paths, indices)
+        hyps = get_word_texts(best_paths, words, indices)
         assert len(hyps) == len(texts)
 
         for i in range(len(texts)):
-            hyp_words = [symbols.get(x) for x in hyps[i]]
+            hyp_words = hyps[i]
             ref_words = texts[i].split(' ')
             results.append((ref_words, hyp_words))
 
@@ -113,12 +115,9 @@ def main():
                          G=G,
                          H=ctc_topo,
                          labels_disambig_id_start=first_phone_disambig_id,
-                         aux_labels_disambig_id_start=first_word_disambig_id)
-        torch.save(HLG.as_dict(), lang_dir / 'HLG.pt')
-    else:
-        print("Loading pre-compiled HLG")
-        d = torch.load(lang_dir / 'HLG.pt')
-        HLG = k2.Fsa.from_dict(d)
+                         aux_labels_disambig_id_start=first_word_disambig_id,
+                         cache_dir=lang_dir / 'graph_cache')
+        save_HLG(HLG, lang_dir / 'HLG.pt')
 
     # load dataset
     feature_dir = Path('exp/data')
@@ -149,10 +148,8 @@ def main():
     model.to(device)
     model.eval()
 
-    print("convert HLG to device")
-    HLG = HLG.to(device)
-    HLG.aux_labels = k2.ragged.remove_values_eq(HLG.aux_labels, 0)
-    HLG.requires_grad_(False)
+    print("Loading HLG")
+    HLG = load_HLG(lang_dir / 'HLG.pt', device)
     print("About to decode")
     results = decode(dataloader=test_dl,
                      model=model,
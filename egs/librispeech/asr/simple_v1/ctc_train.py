@@ -194,9 +194,6 @@ def train_one_epoch(dataloader: torch.utils.data.DataLoader,
             tb_writer.add_scalar('train/current_batch_average_objf',
                                  curr_batch_objf / (curr_batch_frames + 0.001),
                                  global_batch_idx_train)
-            # if batch_idx >= 10:
-            #    print("Exiting early to get profile info")
-            #    sys.exit(0)
 
         if batch_idx > 0 and batch_idx % 200 == 0:
             total_valid_objf, total_valid_frames, total_valid_all_frames = get_validation_objf(
@@ -246,7 +243,8 @@ def main():
     graph_compiler = CtcTrainingGraphCompiler(
         L_inv=L_inv,
         phones=phone_symbol_table,
-        words=word_symbol_table
+        words=word_symbol_table,
+        cache_dir=lang_dir / 'ctc_graph_cache'
     )
     phone_ids = get_phone_symbols(phone_symbol_table)
 
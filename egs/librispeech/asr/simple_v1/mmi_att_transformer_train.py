@@ -8,328 +8,31 @@
 
 import argparse
 import logging
-import os
 import sys
-from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
 
 import k2
-import numpy as np
 import torch
-import torch.distributed as dist
 import torch.multiprocessing as mp
-from torch import nn
-from torch.cuda.amp import GradScaler, autocast
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.nn.utils import clip_grad_value_
-from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
-from lhotse.utils import fix_random_seed, nullcontext
+from lhotse.utils import fix_random_seed
 from snowfall.common import describe, str2bool
 from snowfall.common import find_first_disambig_symbol
-from snowfall.common import load_checkpoint, save_checkpoint
-from snowfall.common import save_training_info
 from snowfall.common import setup_logger
 from snowfall.data.librispeech import LibriSpeechAsrDataModule
 from snowfall.dist import cleanup_dist
 from snowfall.dist import setup_dist
 from snowfall.lexicon import Lexicon
-from snowfall.models import AcousticModel
 from snowfall.models.conformer import Conformer
 from snowfall.models.contextnet import ContextNet
 from snowfall.models.tdnn_lstm import TdnnLstm1b  # alignment model
 from snowfall.models.transformer import Noam, Transformer
-from snowfall.objectives import LFMMILoss, encode_supervisions
-from snowfall.training.diagnostics import measure_gradient_norms, optim_step_and_measure_param_change
+from snowfall.objectives import LFMMILoss, PrunedBeamTuner
 from snowfall.training.mmi_graph import MmiTrainingGraphCompiler
-
-
-def get_objf(batch: Dict,
-             model: AcousticModel,
-             ali_model: Optional[AcousticModel],
-             device: torch.device,
-             graph_compiler: MmiTrainingGraphCompiler,
-             use_pruned_intersect: bool,
-             is_training: bool,
-             is_update: bool,
-             accum_grad: int = 1,
-             den_scale: float = 1.0,
-             att_rate: float = 0.0,
-             tb_writer: Optional[SummaryWriter] = None,
-             global_batch_idx_train: Optional[int] = None,
-             optimizer: Optional[torch.optim.Optimizer] = None,
-             scaler: GradScaler = None
-             ):
-    feature = batch['inputs']
-    # at entry, feature is [N, T, C]
-    feature = feature.permute(0, 2, 1)  # now feature is [N, C, T]
-    assert feature.ndim == 3
-    feature = feature.to(device)
-
-    supervisions = batch['supervisions']
-    supervision_segments, texts = encode_supervisions(supervisions)
-
-    loss_fn = LFMMILoss(
-        graph_compiler=graph_compiler,
-        den_scale=den_scale,
-        use_pruned_intersect=use_pruned_intersect
-    )
-
-    grad_context = nullcontext if is_training else torch.no_grad
-
-    with autocast(enabled=scaler.is_enabled()), grad_context():
-
-        if att_rate == 0:
-            # Note: Make TorchScript happy by making the supervision dict strictly
-            #       conform to type Dict[str, Tensor]
-            #       Using the attention decoder with TorchScript is currently unsupported,
-            #       we'll need to separate out the 'text' field from 'supervisions' first.
-            del supervisions['text']
-
-        nnet_output, encoder_memory, memory_mask = model(feature, supervisions)
-        if att_rate != 0.0:
-            if hasattr(model, 'module'):
-                att_loss = model.module.decoder_forward(encoder_memory, memory_mask, supervisions, graph_compiler)
-            else:
-                att_loss = model.decoder_forward(encoder_memory, memory_mask, supervisions, graph_compiler)
-
-        if (ali_model is not None and global_batch_idx_train is not None and
-                global_batch_idx_train // accum_grad < 4000):
-            with torch.no_grad():
-                ali_model_output = ali_model(feature)
-            # subsampling is done slightly differently, may be small length
-            # differences.
-            min_len = min(ali_model_output.shape[2], nnet_output.shape[2])
-            # scale less than one so it will be encouraged
-            # to mimic ali_model's output
-            ali_model_scale = 500.0 / (global_batch_idx_train // accum_grad + 500)
-            nnet_output = nnet_output.clone()  # or log-softmax backprop will fail.
-            nnet_output[:, :,:min_len] += ali_model_scale * ali_model_output[:, :,:min_len]
-
-        # nnet_output is [N, C, T]
-        nnet_output = nnet_output.permute(0, 2, 1)  # now nnet_output is [N, T, C]
-
-        mmi_loss, tot_frames, all_frames = loss_fn(nnet_output, texts, supervision_segments)
-
-    if is_training:
-        def maybe_log_gradients(tag: str):
-            if tb_writer is not None and global_batch_idx_train is not None and global_batch_idx_train % 200 == 0:
-                tb_writer.add_scalars(
-                    tag,
-                    measure_gradient_norms(model, norm='l1'),
-                    global_step=global_batch_idx_train
-                )
-
-        if att_rate != 0.0:
-            loss = (- (1.0 - att_rate) * mmi_loss + att_rate * att_loss) / (len(texts) * accum_grad)
-        else:
-            loss = (-mmi_loss) / (len(texts) * accum_grad)
-        scaler.scale(loss).backward()
-        if is_update:
-            maybe_log_gradients('train/grad_norms')
-            scaler.unscale_(optimizer)
-            clip_grad_value_(model.parameters(), 5.0)
-            maybe_log_gradients('train/clipped_grad_norms')
-            if tb_writer is not None and (global_batch_idx_train // accum_grad) % 200 == 0:
-                # Once in a time we will perform a more costly diagnostic
-                # to check the relative parameter change per minibatch.
-                deltas = optim_step_and_measure_param_change(model, optimizer, scaler)
-                tb_writer.add_scalars(
-                    'train/relative_param_change_per_minibatch',
-                    deltas,
-                    global_step=global_batch_idx_train
-                )
-            else:
-                scaler.step(optimizer)
-            optimizer.zero_grad()
-            scaler.update()
-
-    ans = -mmi_loss.detach().cpu().item(), tot_frames.cpu().item(
-    ), all_frames.cpu().item()
-    return ans
-
-
-def get_validation_objf(dataloader: torch.utils.data.DataLoader,
-                        model: AcousticModel,
-                        ali_model: Optional[AcousticModel],
-                        device: torch.device,
-                        graph_compiler: MmiTrainingGraphCompiler,
-                        use_pruned_intersect: bool,
-                        scaler: GradScaler,
-                        den_scale: float = 1,
-                        ):
-    total_objf = 0.
-    total_frames = 0.  # for display only
-    total_all_frames = 0.  # all frames including those seqs that failed.
-
-    model.eval()
-
-    from torchaudio.datasets.utils import bg_iterator
-    for batch_idx, batch in enumerate(bg_iterator(dataloader, 2)):
-        objf, frames, all_frames = get_objf(
-            batch=batch,
-            model=model,
-            ali_model=ali_model,
-            device=device,
-            graph_compiler=graph_compiler,
-            use_pruned_intersect=use_pruned_intersect,
-            is_training=False,
-            is_update=False,
-            den_scale=den_scale,
-            scaler=scaler
-        )
-        total_objf += objf
-        total_frames += frames
-        total_all_frames += all_frames
-
-    return total_objf, total_frames, total_all_frames
-
-
-def train_one_epoch(dataloader: torch.utils.data.DataLoader,
-                    valid_dataloader: torch.utils.data.DataLoader,
-                    model: AcousticModel,
-                    ali_model: Optional[AcousticModel],
-                    device: torch.device,
-                    graph_compiler: MmiTrainingGraphCompiler,
-                    use_pruned_intersect: bool,
-                    optimizer: torch.optim.Optimizer,
-                    accum_grad: int,
-                    den_scale: float,
-                    att_rate: float,
-                    current_epoch: int,
-                    tb_writer: SummaryWriter,
-                    num_epochs: int,
-                    global_batch_idx_train: int,
-                    world_size: int,
-                    scaler: GradScaler
-                    ):
-    """One epoch training and validation.
-
-    Args:
-        dataloader: Training dataloader
-        valid_dataloader: Validation dataloader
-        model: Acoustic model to be trained
-        device: Training device, torch.device("cpu") or torch.device("cuda", device_id)
-        graph_compiler: MMI training graph compiler
-        optimizer: Training optimizer
-        accum_grad: Number of gradient accumulation
-        den_scale: Denominator scale in mmi loss
-        att_rate: Attention loss rate, final loss is att_rate * att_loss + (1-att_rate) * other_loss
-        current_epoch: current training epoch, for logging only
-        tb_writer: tensorboard SummaryWriter
-        num_epochs: total number of training epochs, for logging only
-        global_batch_idx_train: global training batch index before this epoch, for logging only
-
-    Returns:
-        A tuple of 3 scalar:  (total_objf / total_frames, valid_average_objf, global_batch_idx_train)
-        - `total_objf / total_frames` is the average training loss
-        - `valid_average_objf` is the average validation loss
-        - `global_batch_idx_train` is the global training batch index after this epoch
-    """
-    total_objf, total_frames, total_all_frames = 0., 0., 0.
-    valid_average_objf = float('inf')
-    time_waiting_for_batch = 0
-    forward_count = 0
-    prev_timestamp = datetime.now()
-
-    model.train()
-    for batch_idx, batch in enumerate(dataloader):
-        forward_count += 1
-        if forward_count == accum_grad:
-            is_update = True
-            forward_count = 0
-        else:
-            is_update = False
-
-        global_batch_idx_train += 1
-        timestamp = datetime.now()
-        time_waiting_for_batch += (timestamp - prev_timestamp).total_seconds()
-
-        curr_batch_objf, curr_batch_frames, curr_batch_all_frames = get_objf(
-            batch=batch,
-            model=model,
-            ali_model=ali_model,
-            device=device,
-            graph_compiler=graph_compiler,
-            use_pruned_intersect=use_pruned_intersect,
-            is_training=True,
-            is_update=is_update,
-            accum_grad=accum_grad,
-            den_scale=den_scale,
-            att_rate=att_rate,
-            tb_writer=tb_writer,
-            global_batch_idx_train=global_batch_idx_train,
-            optimizer=optimizer,
-            scaler=scaler
-        )
-
-        total_objf += curr_batch_objf
-        total_frames += curr_batch_frames
-        total_all_frames += curr_batch_all_frames
-
-        if batch_idx % 10 == 0:
-            logging.info(
-                'batch {}, epoch {}/{} '
-                'global average objf: {:.6f} over {} '
-                'frames ({:.1f}% kept), current batch average objf: {:.6f} over {} frames ({:.1f}% kept) '
-                'avg time waiting for batch {:.3f}s'.format(
-                    batch_idx, current_epoch, num_epochs,
-                    total_objf / total_frames, total_frames,
-                    100.0 * total_frames / total_all_frames,
-                    curr_batch_objf / (curr_batch_frames + 0.001),
-                    curr_batch_frames,
-                    100.0 * curr_batch_frames / curr_batch_all_frames,
-                    time_waiting_for_batch / max(1, batch_idx)))
-
-            if tb_writer is not None:
-                tb_writer.add_scalar('train/global_average_objf',
-                                     total_objf / total_frames, global_batch_idx_train)
-
-                tb_writer.add_scalar('train/current_batch_average_objf',
-                                     curr_batch_objf / (curr_batch_frames + 0.001),
-                                     global_batch_idx_train)
-            # if batch_idx >= 10:
-            #    print("Exiting early to get profile info")
-            #    sys.exit(0)
-
-        if batch_idx > 0 and batch_idx % 200 == 0:
-            total_valid_objf, total_valid_frames, total_valid_all_frames = get_validation_objf(
-                dataloader=valid_dataloader,
-                model=model,
-                ali_model=ali_model,
-                device=device,
-                graph_compiler=graph_compiler,
-                use_pruned_intersect=use_pruned_intersect,
-                scaler=scaler)
-            if world_size > 1:
-                s = torch.tensor([
-                    total_valid_objf, total_valid_frames,
-                    total_valid_all_frames
-                ]).to(device)
-
-                dist.all_reduce(s, op=dist.ReduceOp.SUM)
-                total_valid_objf, total_valid_frames, total_valid_all_frames = s.cpu().tolist()
-
-            valid_average_objf = total_valid_objf / total_valid_frames
-            model.train()
-            logging.info(
-                'Validation average objf: {:.6f} over {} frames ({:.1f}% kept)'
-                    .format(valid_average_objf,
-                            total_valid_frames,
-                            100.0 * total_valid_frames / total_valid_all_frames))
-
-            if tb_writer is not None:
-                tb_writer.add_scalar('train/global_valid_average_objf',
-                                     valid_average_objf,
-                                     global_batch_idx_train)
-                if hasattr(model, 'module'):
-                    model.module.write_tensorboard_diagnostics(tb_writer, global_step=global_batch_idx_train)
-                else:
-                    model.write_tensorboard_diagnostics(tb_writer, global_step=global_batch_idx_train)
-        prev_timestamp = datetime.now()
-    return total_objf / total_frames, valid_average_objf, global_batch_idx_train
+from snowfall.training.profiler import StepProfiler
+from snowfall.training.trainer import LFMMIObjective, Trainer
+from snowfall.training.validation import ValidationScheduler
 
 
 def get_parser():
@@ -441,6 +144,71 @@ def get_parser():
              'You probably want to set it to True if you have a very large LM. ' \
              'In that case, you will get an OOM if it is False. ')
     #  See https://github.com/k2-fsa/k2/issues/739 for more details
+    parser.add_argument(
+        '--lattice-memory-budget',
+        type=float,
+        default=0,
+        help='If positive, the memory (in GB) that a single LF-MMI lattice '
+             'intersection may use. The loss then picks the fastest '
+             'intersection method that fits, splitting the batch if needed, '
+             'and --use-pruned-intersect is ignored.')
+    parser.add_argument(
+        '--den-search-beam',
+        type=float,
+        default=20.0,
+        help='search_beam of the pruned den intersection. '
+             'Used only if --use-pruned-intersect is True.')
+    parser.add_argument(
+        '--den-output-beam',
+        type=float,
+        default=7.0,
+        help='output_beam of the pruned den intersection. '
+             'Used only if --use-pruned-intersect is True.')
+    parser.add_argument(
+        '--tune-den-beams-interval',
+        type=int,
+        default=0,
+        help='If positive, every this many batches compare the pruned den '
+             'scores with the exact ones and adjust --den-search-beam and '
+             '--den-output-beam accordingly. '
+             'Used only if --use-pruned-intersect is True.')
+    parser.add_argument(
+        '--tune-den-beams-tolerance',
+        type=float,
+        default=0.01,
+        help='The largest acceptable difference per frame between '
+             'the pruned and the exact den scores when tuning the beams.')
+    parser.add_argument(
+        '--tune-den-beams-on-valid',
+        type=str2bool,
+        default=False,
+        help='When enabled, tune the den beams on the first validation '
+             'batch instead of on the training batches.')
+    parser.add_argument(
+        '--valid-interval',
+        type=int,
+        default=200,
+        help='Compute the validation objf every this many batches.')
+    parser.add_argument(
+        '--valid-time-interval',
+        type=float,
+        default=0.0,
+        help='If positive, compute the validation objf every this many '
+             'seconds instead of every --valid-interval batches.')
+    parser.add_argument(
+        '--async-validation',
+        type=str2bool,
+        default=False,
+        help='When enabled, compute the validation objf on a snapshot of '
+             'the model in the background while training goes on. '
+             'It needs the memory of a second copy of the model.')
+    parser.add_argument(
+        '--profile',
+        type=str2bool,
+        default=True,
+        help='When enabled (=default), time the stages of every training step '
+             'and count the arcs of the lattices, and write them to TensorBoard '
+             'and to exp_dir/profile-rank<rank>.jsonl.')
     parser.add_argument(
         '--torchscript',
         type=str2bool,
@@ -528,9 +296,27 @@ def run(rank, world_size, args):
         lexicon=lexicon,
         P=P,
         device=device,
+        word_ids_cache=args.feature_dir / 'word_ids.pt'
     )
     phone_ids = lexicon.phone_symbols()
 
+    loss_fn = LFMMILoss(
+        graph_compiler=graph_compiler,
+        den_scale=den_scale,
+        use_pruned_intersect=use_pruned_intersect,
+        memory_budget=(args.lattice_memory_budget * 1024**3
+                       if args.lattice_memory_budget > 0 else None),
+        search_beam=args.den_search_beam,
+        output_beam=args.den_output_beam,
+        beam_tuner=(PrunedBeamTuner(
+            interval=args.tune_den_beams_interval,
+            tolerance=args.tune_den_beams_tolerance,
+            max_search_beam=args.den_search_beam,
+            max_output_beam=args.den_output_beam,
+            held_out=args.tune_den_beams_on_valid)
+            if args.tune_den_beams_interval > 0 else None)
+    )
+
     librispeech = LibriSpeechAsrDataModule(args)
     train_dl = librispeech.train_dataloaders()
     valid_dl = librispeech.valid_dataloaders()
@@ -584,9 +370,6 @@ def run(rank, world_size, args):
     model.to(device)
     describe(model)
 
-    if world_size > 1:
-        model = DDP(model, device_ids=[rank])
-
     # Now for the alignment model, if any
     if args.use_ali_model:
         ali_model = TdnnLstm1b(
@@ -613,105 +396,43 @@ def run(rank, world_size, args):
                      warm_step=args.warm_step,
                      weight_decay=args.weight_decay)
 
-    scaler = GradScaler(enabled=args.amp)
-
-    best_objf = np.inf
-    best_valid_objf = np.inf
-    best_epoch = start_epoch
-    best_model_path = os.path.join(exp_dir, 'best_model.pt')
-    best_epoch_info_filename = os.path.join(exp_dir, 'best-epoch-info')
-    global_batch_idx_train = 0  # for logging only
-
-    if start_epoch > 0:
-        model_path = os.path.join(exp_dir, 'epoch-{}.pt'.format(start_epoch - 1))
-        ckpt = load_checkpoint(filename=model_path, model=model, optimizer=optimizer, scaler=scaler)
-        best_objf = ckpt['objf']
-        best_valid_objf = ckpt['valid_objf']
-        global_batch_idx_train = ckpt['global_batch_idx_train']
-        logging.info(f"epoch = {ckpt['epoch']}, objf = {best_objf}, valid_objf = {best_valid_objf}")
-
-    for epoch in range(start_epoch, num_epochs):
-        train_dl.sampler.set_epoch(epoch)
-        curr_learning_rate = optimizer._rate
-        if tb_writer is not None:
-            tb_writer.add_scalar('train/learning_rate', curr_learning_rate, global_batch_idx_train)
-            tb_writer.add_scalar('train/epoch', epoch, global_batch_idx_train)
-
-        logging.info('epoch {}, learning rate {}'.format(epoch, curr_learning_rate))
-        objf, valid_objf, global_batch_idx_train = train_one_epoch(
-            dataloader=train_dl,
-            valid_dataloader=valid_dl,
-            model=model,
-            ali_model=ali_model,
-            device=device,
-            graph_compiler=graph_compiler,
-            use_pruned_intersect=use_pruned_intersect,
-            optimizer=optimizer,
-            accum_grad=accum_grad,
-            den_scale=den_scale,
-            att_rate=att_rate,
-            current_epoch=epoch,
-            tb_writer=tb_writer,
-            num_epochs=num_epochs,
-            global_batch_idx_train=global_batch_idx_train,
-            world_size=world_size,
-            scaler=scaler
-        )
-        # the lower, the better
-        if valid_objf < best_valid_objf:
-            best_valid_objf = valid_objf
-            best_objf = objf
-            best_epoch = epoch
-            save_checkpoint(filename=best_model_path,
-                            optimizer=None,
-                            scheduler=None,
-                            scaler=None,
-                            model=model,
-                            epoch=epoch,
-                            learning_rate=curr_learning_rate,
-                            objf=objf,
-                            valid_objf=valid_objf,
-                            global_batch_idx_train=global_batch_idx_train,
-                            local_rank=rank,
-                            torchscript=args.torchscript_epoch != -1 and epoch >= args.torchscript_epoch
-                            )
-            save_training_info(filename=best_epoch_info_filename,
-                               model_path=best_model_path,
-                               current_epoch=epoch,
-                               learning_rate=curr_learning_rate,
-                               objf=objf,
-                               best_objf=best_objf,
-                               valid_objf=valid_objf,
-                               best_valid_objf=best_valid_objf,
-                               best_epoch=best_epoch,
-                               local_rank=rank)
-
-        # we always save the model for every epoch
-        model_path = os.path.join(exp_dir, 'epoch-{}.pt'.format(epoch))
-        save_checkpoint(filename=model_path,
-                        optimizer=optimizer,
-                        scheduler=None,
-                        scaler=scaler,
-                        model=model,
-                        epoch=epoch,
-                        learning_rate=curr_learning_rate,
-                        objf=objf,
-                        valid_objf=valid_objf,
-                        global_batch_idx_train=global_batch_idx_train,
-                        local_rank=rank,
-                        torchscript=args.torchscript_epoch != -1 and epoch >= args.torchscript_epoch
-                        )
-        epoch_info_filename = os.path.join(exp_dir, 'epoch-{}-info'.format(epoch))
-        save_training_info(filename=epoch_info_filename,
-                           model_path=model_path,
-                           current_epoch=epoch,
-                           learning_rate=curr_learning_rate,
-                           objf=objf,
-                           best_objf=best_objf,
-                           valid_objf=valid_objf,
-                           best_valid_objf=best_valid_objf,
-                           best_epoch=best_epoch,
-                           local_rank=rank)
+    objective = LFMMIObjective(loss_fn,
+                               device=device,
+                               att_rate=att_rate,
+                               ali_model=ali_model,
+                               accum_grad=accum_grad,
+                               beam_tuning_batch=(
+                                   next(iter(valid_dl))
+                                   if use_pruned_intersect and
+                                   loss_fn.beam_tuner is not None and
+                                   args.tune_den_beams_on_valid else None))
+    trainer = Trainer(model,
+                      objective,
+                      optimizer,
+                      device=device,
+                      exp_dir=exp_dir,
+                      accum_grad=accum_grad,
+                      use_amp=args.amp,
+                      rank=rank,
+                      world_size=world_size,
+                      tb_writer=tb_writer,
+                      validation=ValidationScheduler(
+                          batch_interval=args.valid_interval,
+                          time_interval=args.valid_time_interval
+                          if args.valid_time_interval > 0 else None,
+                          asynchronous=args.async_validation),
+                      torchscript_epoch=args.torchscript_epoch,
+                      profiler=StepProfiler(
+                          device,
+                          tb_writer=tb_writer,
+                          trace_path=exp_dir / f'profile-rank{rank}.jsonl',
+                          enabled=args.profile))
+    trainer.resume(start_epoch)
+    trainer.fit(train_dl,
+                valid_dl,
+                start_epoch=start_epoch,
+                num_epochs=num_epochs,
+                get_learning_rate=lambda: optimizer._rate)
 
     logging.warning('Done')
     if world_size > 1:
@@ -326,9 +326,6 @@ def train_one_epoch(dataloader: torch.utils.data.DataLoader,
             tb_writer.add_scalar('train/current_batch_average_mbr_loss',
                                  curr_batch_mbr_loss / (curr_batch_frames + 0.001),
                                  global_batch_idx_train)
-            # if batch_idx >= 10:
-            #    print("Exiting early to get profile info")
-            #    sys.exit(0)
 
         if batch_idx > 0 and batch_idx % 3000 == 0:
             total_valid_loss, total_valid_mmi_loss, total_valid_mbr_loss, \
@@ -74,14 +74,17 @@ if [ $stage -le 4 ]; then
     echo "Skip generating data/lang_nosp/G.fst.txt"
   fi
 
-  if [ ! -f data/lang_nosp/G_4_gram.fst.txt ]; then
-    python3 -m kaldilm \
-      --read-symbol-table="data/lang_nosp/words.txt" \
-      --disambig-symbol='#0' \
-      --max-order=4 \
-      data/local/lm/lm_fglarge.arpa >data/lang_nosp/G_4_gram.fst.txt
+  if [ ! -f data/lang_nosp/G_4_gram.fst.pt ]; then
+    # Writes the k2 FSA directly; it is much faster than
+    # going through G_4_gram.fst.txt for the 4-gram LM.
+    snowfall lm arpa2fsa \
+      --symbol-table data/lang_nosp/words.txt \
+      --disambig-symbol '#0' \
+      --max-order 4 \
+      --arpa data/local/lm/lm_fglarge.arpa \
+      --output-file data/lang_nosp/G_4_gram.fst.pt
   else
-    echo "Skip generating data/lang_nosp/G_4_gram.fst.txt"
+    echo "Skip generating data/lang_nosp/G_4_gram.fst.pt"
   fi
 
   echo ""
@@ -125,10 +128,10 @@ if [ $stage -le 6 ]; then
       --oov "<UNK>" \
       > data/lm/corpus.txt
 
-    ./local/make_kn_lm.py \
-      -ngram-order 2 \
-      -text data/lm/corpus.txt \
-      -lm data/lm/P.arpa
+    snowfall lm make-kn-lm \
+      --ngram-order 2 \
+      --text data/lm/corpus.txt \
+      --lm data/lm/P.arpa
   fi
 fi
 
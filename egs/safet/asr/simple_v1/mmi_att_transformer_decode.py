@@ -11,23 +11,21 @@ import numpy as np
 import os
 import torch
 import re
-from k2 import Fsa, SymbolTable
+from k2 import SymbolTable
 from kaldialign import edit_distance
 from pathlib import Path
 from typing import List
-from typing import Union
 
 from snowfall.common import average_checkpoint, store_transcripts
 from snowfall.common import find_first_disambig_symbol
-from snowfall.common import get_texts
+from snowfall.common import get_word_table
 from snowfall.common import write_error_stats
 from snowfall.common import load_checkpoint
 from snowfall.common import setup_logger
 from snowfall.common import str2bool
 from snowfall.data.safet import SafetAsrDataModule
-from snowfall.decoding.graph import compile_HLG
-from snowfall.decoding.lm_rescore import decode_with_lm_rescoring
-from snowfall.models import AcousticModel
+from snowfall.decoding.engine import DecodingEngine
+from snowfall.decoding.graph import compile_HLG, load_HLG, save_HLG
 from snowfall.models.transformer import Transformer
 from snowfall.models.conformer import Conformer
 from snowfall.models.contextnet import ContextNet
@@ -90,73 +88,6 @@ def calculate_WER(results: list):
     return filtered_results
 
 
-def decode(dataloader: torch.utils.data.DataLoader, model: AcousticModel,
-           device: Union[str, torch.device], HLG: Fsa, symbols: SymbolTable,
-           num_paths: int, G: k2.Fsa, use_whole_lattice: bool, output_beam_size: float):
-    tot_num_cuts = len(dataloader.dataset.cuts)
-    num_cuts = 0
-    results = []  # a list of pair (ref_words, hyp_words)
-    for batch_idx, batch in enumerate(dataloader):
-        feature = batch['inputs']
-        supervisions = batch['supervisions']
-        supervision_segments = torch.stack(
-            (supervisions['sequence_idx'],
-             (((supervisions['start_frame'] - 1) // 2 - 1) // 2),
-             (((supervisions['num_frames'] - 1) // 2 - 1) // 2)), 1).to(torch.int32)
-        supervision_segments = torch.clamp(supervision_segments, min=0)
-        indices = torch.argsort(supervision_segments[:, 2], descending=True)
-        supervision_segments = supervision_segments[indices]
-        texts = supervisions['text']
-        assert feature.ndim == 3
-
-        feature = feature.to(device)
-        # at entry, feature is [N, T, C]
-        feature = feature.permute(0, 2, 1)  # now feature is [N, C, T]
-        with torch.no_grad():
-            nnet_output, _, _ = model(feature, supervisions)
-        # nnet_output is [N, C, T]
-        nnet_output = nnet_output.permute(0, 2,
-                                          1)  # now nnet_output is [N, T, C]
-
-        #  blank_bias = -3.0
-        #  nnet_output[:, :, 0] += blank_bias
-
-        dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
-        # assert HLG.is_cuda()
-        assert HLG.device == nnet_output.device, \
-            f"Check failed: HLG.device ({HLG.device}) == nnet_output.device ({nnet_output.device})"
-        lattices = k2.intersect_dense_pruned(HLG, dense_fsa_vec, 20.0, output_beam_size, 30,
-                                             10000)
-
-        if G is None:
-            best_paths = k2.shortest_path(lattices, use_double_scores=True)
-        else:
-            best_paths = decode_with_lm_rescoring(
-                lattices,
-                G,
-                num_paths=num_paths,
-                use_whole_lattice=use_whole_lattice)
-
-        assert best_paths.shape[0] == len(texts)
-        hyps = get_texts(best_paths, indices)
-        assert len(hyps) == len(texts)
-
-        for i in range(len(texts)):
-            hyp_words = [symbols.get(x) for x in hyps[i]]
-            ref_words = texts[i].split(' ')
-            results.append((ref_words, hyp_words))
-
-        if batch_idx % 10 == 0:
-            logging.info(
-                'batch {}, cuts processed until now is {}/{} ({:.6f}%)'.format(
-                    batch_idx, num_cuts, tot_num_cuts,
-                    float(num_cuts) / tot_num_cuts * 100))
-
-        num_cuts += len(texts)
-
-    return results
-
-
 def print_transition_probabilities(P: k2.Fsa, phone_symbol_table: SymbolTable,
                                    phone_ids: List[int], filename: str):
     '''Print the transition probabilities of a phone LM.
@@ -261,19 +192,25 @@ def get_parser():
              'Choose a large value (e.g., 20), for 1-best decoding '\
              'and n-best rescoring. Choose a small value (e.g., 8) for ' \
              'rescoring with the whole lattice')
-    parser.add_argument(
-        '--use-lm-rescoring',
-        type=str2bool,
-        default=False,
-        help='When enabled, it uses LM for rescoring')
     parser.add_argument(
         '--num-paths',
         type=int,
         default=-1,
-        help='Number of paths for rescoring using n-best list.' \
-             'If it is negative, then rescore with the whole lattice.'\
-             'CAUTION: You have to reduce max_duration in case of CUDA OOM'
+        help='Number of paths for n-best list decoding. ' \
+             'If it is less than 2, use 1-best decoding.'
              )
+    parser.add_argument(
+        '--use-top-k-paths',
+        type=str2bool,
+        default=False,
+        help='When enabled, n-best lists contain the --num-paths best '\
+             'distinct word sequences of each lattice instead of '\
+             '--num-paths random paths. The results are deterministic.')
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='cuda',
+        help='The device to decode on, e.g., cuda, cuda:1 or cpu.')
     return parser
 
 
@@ -287,12 +224,8 @@ def main():
     avg = args.avg
     att_rate = args.att_rate
     num_paths = args.num_paths
-    use_lm_rescoring = args.use_lm_rescoring
-    use_whole_lattice = False
-    if use_lm_rescoring and num_paths < 1:
-        # It doesn't make sense to use n-best list for rescoring
-        # when n is less than 1
-        use_whole_lattice = True
+    # There is no LM for rescoring in this recipe.
+    strategy = 'nbest' if num_paths > 1 else '1best'
 
     output_beam_size = args.output_beam_size
 
@@ -313,7 +246,7 @@ def main():
     ctc_topo = k2.arc_sort(build_ctc_topo(phone_ids_with_blank))
 
     logging.debug("About to load model")
-    device = torch.device('cuda')
+    device = torch.device(args.device)
 
     if att_rate != 0.0:
         num_decoder_layers = 6
@@ -355,9 +288,6 @@ def main():
                        range(epoch - avg, epoch)]
         average_checkpoint(checkpoints, model)
 
-    model.to(device)
-    model.eval()
-
     assert P.requires_grad is False
     P.scores = model.P_scores.cpu()
     print_transition_probabilities(P, phone_symbol_table, phone_ids, filename='model_P_scores.txt')
@@ -378,36 +308,34 @@ def main():
                          G=G,
                          H=ctc_topo,
                          labels_disambig_id_start=first_phone_disambig_id,
-                         aux_labels_disambig_id_start=first_word_disambig_id)
-        torch.save(HLG.as_dict(), lang_dir / 'HLG.pt')
-    else:
-        logging.debug("Loading pre-compiled HLG")
-        d = torch.load(lang_dir / 'HLG.pt')
-        HLG = k2.Fsa.from_dict(d)
+                         aux_labels_disambig_id_start=first_word_disambig_id,
+                         cache_dir=lang_dir / 'graph_cache')
+        save_HLG(HLG, lang_dir / 'HLG.pt')
 
     logging.debug('Decoding without LM rescoring')
-    G = None
+    if num_paths > 1:
+        logging.debug(f'Use n-best list decoding, n is {num_paths}')
+    else:
+        logging.debug('Use 1-best decoding')
 
-    logging.debug("convert HLG to device")
-    HLG = HLG.to(device)
-    HLG.aux_labels = k2.ragged.remove_values_eq(HLG.aux_labels, 0)
-    HLG.requires_grad_(False)
+    logging.debug("Loading HLG")
+    HLG = load_HLG(lang_dir / 'HLG.pt', device)
 
-    if not hasattr(HLG, 'lm_scores'):
-        HLG.lm_scores = HLG.scores.clone()
+    engine = DecodingEngine(model,
+                            HLG,
+                            strategy=strategy,
+                            device=device,
+                            output_beam_size=output_beam_size,
+                            num_paths=num_paths,
+                            use_top_k=args.use_top_k_paths,
+                            conv_subsampling=True)
+    words = get_word_table(symbol_table)
 
     # load dataset
     safetspeech = SafetAsrDataModule(args)
     test_dl = safetspeech.test_dataloaders()
-    results = decode(dataloader=test_dl,
-                     model=model,
-                     device=device,
-                     HLG=HLG,
-                     symbols=symbol_table,
-                     num_paths=num_paths,
-                     G=G,
-                     use_whole_lattice=use_whole_lattice,
-                     output_beam_size=output_beam_size)
+    results_dict = engine.decode_dataset(test_dl, words)
+    results = next(iter(results_dict.values()))
 
     filtered_results = calculate_WER(results)
 
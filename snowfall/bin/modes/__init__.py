@@ -1,2 +1,4 @@
 from .ali import ali
 from .cli_base import cli
+from .lm import lm
+from .serve import serve
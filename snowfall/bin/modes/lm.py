@@ -0,0 +1,144 @@
+from typing import Optional
+
+import sys
+
+import click
+import k2
+import torch
+
+from .cli_base import cli
+from snowfall.lm import KneserNeyLm
+from snowfall.lm import arpa_to_fsa
+
+
+@cli.group()
+def lm():
+    '''
+    Language model tools in snowfall
+    '''
+    pass
+
+
+@lm.command()
+@click.option('-i',
+              '--arpa',
+              type=click.Path(exists=True, dir_okay=False),
+              required=True,
+              help='The ARPA language model')
+@click.option('-s',
+              '--symbol-table',
+              type=click.Path(exists=True, dir_okay=False),
+              required=True,
+              help='The word symbol table, e.g., words.txt')
+@click.option('-o',
+              '--output-file',
+              type=click.Path(dir_okay=False),
+              required=True,
+              help='Output file, e.g., G.fst.pt')
+@click.option('-d',
+              '--disambig-symbol',
+              type=str,
+              default='#0',
+              show_default=True,
+              help='The label of the back-off arcs')
+@click.option('-m',
+              '--max-order',
+              type=int,
+              default=None,
+              help='If given, ignore n-grams of higher order')
+@click.option('-j',
+              '--num-jobs',
+              type=int,
+              default=8,
+              show_default=True,
+              help='Number of processes used for parsing')
+def arpa2fsa(arpa: str,
+             symbol_table: str,
+             output_file: str,
+             disambig_symbol: str = '#0',
+             max_order: Optional[int] = None,
+             num_jobs: int = 8):
+    '''Convert an ARPA language model to a k2 FSA.
+
+    The output is equivalent (up to state numbering) to
+
+        k2.Fsa.from_openfst(<output of arpa2fst>, acceptor=False)
+
+    and is saved with `torch.save(G.as_dict(), output_file)`.
+    Load it with `k2.Fsa.from_dict(torch.load(output_file))`.
+    '''
+    G = arpa_to_fsa(arpa,
+                    symbol_table=k2.SymbolTable.from_file(symbol_table),
+                    disambig_symbol=disambig_symbol,
+                    max_order=max_order,
+                    num_jobs=num_jobs)
+    torch.save(G.as_dict(), output_file)
+
+    print(f'Saved to {output_file}', file=sys.stderr)
+
+
+@lm.command()
+@click.option('-t',
+              '--text',
+              type=click.Path(exists=True, dir_okay=False),
+              required=True,
+              help='The corpus, one sentence per line')
+@click.option('-n',
+              '--ngram-order',
+              type=int,
+              default=4,
+              show_default=True,
+              help='Order of the n-gram LM')
+@click.option('-o',
+              '--lm',
+              type=click.Path(dir_okay=False),
+              help='Output ARPA file')
+@click.option('-s',
+              '--symbol-table',
+              type=click.Path(exists=True, dir_okay=False),
+              help='The symbol table used for --output-fsa')
+@click.option('-g',
+              '--output-fsa',
+              type=click.Path(dir_okay=False),
+              help='If given, also save G as a k2 FSA, like arpa2fsa does')
+@click.option('-d',
+              '--disambig-symbol',
+              type=str,
+              default='#0',
+              show_default=True,
+              help='The label of the back-off arcs in --output-fsa')
+@click.option('-j',
+              '--num-jobs',
+              type=int,
+              default=8,
+              show_default=True,
+              help='Number of processes used for counting')
+def make_kn_lm(text: str,
+               ngram_order: int = 4,
+               lm: Optional[str] = None,
+               symbol_table: Optional[str] = None,
+               output_fsa: Optional[str] = None,
+               disambig_symbol: str = '#0',
+               num_jobs: int = 8):
+    '''Train a Kneser-Ney smoothed n-gram LM.
+
+    The ARPA output is the same as that of local/make_kn_lm.py in the
+    recipes, which matches srilm's
+
+        ngram-count -order N -kn-modify-counts-at-end -ukndiscount
+                    -gt1min 0 ... -gtNmin 0
+    '''
+    assert lm or output_fsa, 'Please specify --lm and/or --output-fsa'
+    assert output_fsa is None or symbol_table, \
+        '--output-fsa requires --symbol-table'
+    kn_lm = KneserNeyLm.from_text(text,
+                                  ngram_order=ngram_order,
+                                  num_jobs=num_jobs)
+    if lm:
+        kn_lm.write_arpa(lm)
+        print(f'Saved to {lm}', file=sys.stderr)
+    if output_fsa:
+        G = kn_lm.to_fsa(k2.SymbolTable.from_file(symbol_table),
+                         disambig_symbol=disambig_symbol)
+        torch.save(G.as_dict(), output_fsa)
+        print(f'Saved to {output_fsa}', file=sys.stderr)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from pathlib import Path
+from typing import Optional
+
+import click
+
+from .cli_base import cli
+from snowfall.examples.asr import ASR
+from snowfall.examples.asr_server import AsrServer
+
+
+@cli.command()
+@click.option('-l',
+              '--lang-dir',
+              type=click.Path(exists=True, file_okay=False),
+              required=True,
+              help='The lang dir containing HLG.pt, words.txt and phones.txt')
+@click.option('-m',
+              '--model-dir',
+              type=click.Path(exists=True, file_okay=False),
+              default=None,
+              help='The directory containing the checkpoints to average')
+@click.option('--scripted-model',
+              type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='A TorchScript model; used instead of --model-dir')
+@click.option('-s',
+              '--socket',
+              type=click.Path(dir_okay=False),
+              required=True,
+              help='The path of the Unix socket to listen on')
+@click.option('-d',
+              '--device',
+              type=str,
+              default='cpu',
+              show_default=True,
+              help='The device to decode on, e.g., cuda:0')
+@click.option('--max-duration',
+              type=float,
+              default=200.0,
+              show_default=True,
+              help='The maximum total duration of a batch in seconds')
+@click.option('--max-delay',
+              type=float,
+              default=0.05,
+              show_default=True,
+              help='How long a request may wait for a batch to fill, '
+              'in seconds')
+def serve(lang_dir: str,
+          socket: str,
+          model_dir: Optional[str] = None,
+          scripted_model: Optional[str] = None,
+          device: str = 'cpu',
+          max_duration: float = 200.0,
+          max_delay: float = 0.05):
+    '''Run a decoding service on a Unix socket.
+
+    Each line sent to the socket is a JSON request
+    {"id": ..., "audio": "/path/to/audio.wav"} and each line received is
+    {"id": ..., "text": "..."}. Requests are decoded in dynamic batches;
+    the model and the graph are loaded once.
+    '''
+    logging.basicConfig(level=logging.INFO)
+    asr = ASR(lang_dir=Path(lang_dir),
+              scripted_model_path=scripted_model,
+              model_dir=Path(model_dir) if model_dir is not None else None,
+              device=device)
+
+    loop = asyncio.get_event_loop()
+    server = AsrServer(asr, max_duration=max_duration, max_delay=max_delay)
+    loop.run_until_complete(server.start())
+    unix_server = loop.run_until_complete(server.serve_unix(socket))
+    logging.info(f'Listening on {socket}')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        unix_server.close()
+        loop.run_until_complete(unix_server.wait_closed())
+        loop.run_until_complete(server.stop())
@@ -4,6 +4,7 @@
 # Apache 2.0
 import argparse
 import logging
+import multiprocessing.pool
 import os
 import re
 from collections import defaultdict
@@ -14,6 +15,7 @@ from typing import Any, Dict, Iterable, List, Optional, TextIO, Tuple, Union
 import k2
 import k2.ragged as k2r
 import kaldialign
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch.cuda.amp import GradScaler
@@ -308,22 +310,10 @@ def describe(model: torch.nn.Module):
     logging.info('=' * 80)
 
 
-def get_texts(best_paths: k2.Fsa, indices: Optional[torch.Tensor] = None) -> List[List[int]]:
-    '''Extract the texts from the best-path FSAs, in the original order (before
-       the permutation given by `indices`).
-       Args:
-           best_paths:  a k2.Fsa with best_paths.arcs.num_axes() == 3, i.e.
-                    containing multiple FSAs, which is expected to be the result
-                    of k2.shortest_path (otherwise the returned values won't
-                    be meaningful).  Must have the 'aux_labels' attribute, as
-                  a ragged tensor.
-           indices: possibly a torch.Tensor giving the permutation that we used
-                    on the supervisions of this minibatch to put them in decreasing
-                    order of num-frames.  We'll apply the inverse permutation.
-                    Doesn't have to be on the same device as `best_paths`
-      Return:
-          Returns a list of lists of int, containing the label sequences we
-          decoded.
+def get_ragged_texts(best_paths: k2.Fsa, indices: Optional[torch.Tensor] = None) -> k2.RaggedInt:
+    '''Like :func:`get_texts`, but return the label sequences as a k2.RaggedInt
+       with 2 axes [utt][label] on the device of `best_paths` instead of
+       converting them to Python lists.
     '''
     # remove any 0's or -1's (there should be no 0's left but may be -1's.)
 
@@ -344,10 +334,67 @@ def get_texts(best_paths: k2.Fsa, indices: Optional[torch.Tensor] = None) -> Lis
         aux_labels = k2r.remove_values_leq(aux_labels, 0)
 
     assert (aux_labels.num_axes() == 2)
-    aux_labels, _ = k2r.index(aux_labels,
-                                    invert_permutation(indices).to(dtype=torch.int32,
-                                                                   device=best_paths.device))
-    return k2r.to_list(aux_labels)
+    if indices is not None:
+        aux_labels, _ = k2r.index(aux_labels,
+                                        invert_permutation(indices).to(dtype=torch.int32,
+                                                                       device=best_paths.device))
+    return aux_labels
+
+
+def get_texts(best_paths: k2.Fsa, indices: Optional[torch.Tensor] = None) -> List[List[int]]:
+    '''Extract the texts from the best-path FSAs, in the original order (before
+       the permutation given by `indices`).
+       Args:
+           best_paths:  a k2.Fsa with best_paths.arcs.num_axes() == 3, i.e.
+                    containing multiple FSAs, which is expected to be the result
+                    of k2.shortest_path (otherwise the returned values won't
+                    be meaningful).  Must have the 'aux_labels' attribute, as
+                  a ragged tensor.
+           indices: possibly a torch.Tensor giving the permutation that we used
+                    on the supervisions of this minibatch to put them in decreasing
+                    order of num-frames.  We'll apply the inverse permutation.
+                    Doesn't have to be on the same device as `best_paths`
+      Return:
+          Returns a list of lists of int, containing the label sequences we
+          decoded.
+    '''
+    return k2r.to_list(get_ragged_texts(best_paths, indices))
+
+
+def get_word_table(symbols: k2.SymbolTable) -> np.ndarray:
+    '''Return a NumPy array of strings `ans` with `ans[i] == symbols.get(i)`,
+       so that label sequences can be mapped to words with one array lookup
+       (see :func:`ragged_to_words`). Unused IDs are mapped to None.
+    '''
+    ids = list(symbols.ids)
+    ans = np.empty(max(ids) + 1, dtype=object)
+    for i in ids:
+        ans[i] = symbols.get(i)
+    return ans
+
+
+def ragged_to_words(texts: k2.RaggedInt, words: np.ndarray) -> List[List[str]]:
+    '''Convert label sequences to words.
+       Args:
+           texts: a k2.RaggedInt with 2 axes [utt][label], e.g., the return
+                  value of :func:`get_ragged_texts`.
+           words: the return value of :func:`get_word_table`.
+      Return:
+          Returns a list of lists of str, containing the words of each
+          utterance.
+    '''
+    row_splits = texts.row_splits(1).cpu().numpy()
+    # One lookup for all labels of all utterances.
+    tokens = words[texts.values().cpu().numpy()].tolist()
+    return [tokens[begin:end] for begin, end in zip(row_splits[:-1], row_splits[1:])]
+
+
+def get_word_texts(best_paths: k2.Fsa, words: np.ndarray,
+                   indices: Optional[torch.Tensor] = None) -> List[List[str]]:
+    '''Like :func:`get_texts`, but return words instead of IDs, using a table
+       returned by :func:`get_word_table`.
+    '''
+    return ragged_to_words(get_ragged_texts(best_paths, indices), words)
 
 
 def invert_permutation(indices: torch.Tensor) -> torch.Tensor:
@@ -356,6 +403,40 @@ def invert_permutation(indices: torch.Tensor) -> torch.Tensor:
     return ans
 
 
+def get_num_arcs_per_fsa(fsas: k2.Fsa) -> torch.Tensor:
+    '''Return a 1-D int64 tensor containing the number of arcs of each FSA
+    in the FsaVec `fsas`.'''
+    shape = fsas.arcs.shape()
+    row_splits1 = shape.row_splits(1).to(torch.int64)
+    row_splits2 = shape.row_splits(2).to(torch.int64)
+    arc_splits = row_splits2[row_splits1]
+    return arc_splits[1:] - arc_splits[:-1]
+
+
+def split_into_sub_batches(costs: List[int], budget: float) -> List[int]:
+    '''Greedily split a batch into contiguous sub-batches.
+
+    Args:
+      costs:
+        costs[i] is the estimated cost of the i-th sequence.
+      budget:
+        The maximum total cost of a sub-batch. A sequence whose own cost
+        exceeds it forms a sub-batch by itself.
+    Returns:
+      Return the split points, e.g., [0, 3, 7, 8] for three sub-batches
+      [0, 3), [3, 7) and [7, 8).
+    '''
+    splits = [0]
+    cur = 0
+    for i, cost in enumerate(costs):
+        if cur > 0 and cur + cost > budget:
+            splits.append(i)
+            cur = 0
+        cur += cost
+    splits.append(len(costs))
+    return splits
+
+
 def find_first_disambig_symbol(symbols: k2.SymbolTable) -> int:
     return min(v for k, v in symbols._sym2id.items() if is_disambig_symbol(k))
 
@@ -378,97 +459,187 @@ def store_transcripts_for_sclite(
             print(f'{" ".join(hyp)} (utt{idx})', file=hyp_f)
 
 
-def write_error_stats(f: TextIO, test_set_name: str, results: List[Tuple[str,str]]) -> float:
-    subs: Dict[Tuple[str,str], int] = defaultdict(int)
-    ins: Dict[str, int] = defaultdict(int)
-    dels: Dict[str, int] = defaultdict(int)
-
-    # `words` stores counts per word, as follows:
-    #   corr, ref_sub, hyp_sub, ins, dels
-    words: Dict[str, List[int]] = defaultdict(lambda: [0,0,0,0,0])
-    num_corr = 0
-    ERR = '*'
-    for ref, hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR)
+_ERR = '*'
+
+
+def _zero_word_counts() -> List[int]:
+    # corr, ref_sub, hyp_sub, ins, dels
+    return [0, 0, 0, 0, 0]
+
+
+def _per_utt_details(ali: List[Tuple[str, str]]) -> str:
+    combine_successive_errors = True
+    if combine_successive_errors:
+        ali = [ [[x],[y]] for x,y in ali ]
+        for i in range(len(ali) - 1):
+            if ali[i][0] != ali[i][1] and ali[i+1][0] != ali[i+1][1]:
+                ali[i+1][0] = ali[i][0] + ali[i+1][0]
+                ali[i+1][1] = ali[i][1] + ali[i+1][1]
+                ali[i] = [[],[]]
+        ali = [ [list(filter(lambda a: a != _ERR, x)),
+                 list(filter(lambda a: a != _ERR, y))]
+                 for x,y in ali ]
+        ali = list(filter(lambda x: x != [[],[]], ali))
+        ali = [ [_ERR if x == [] else ' '.join(x),
+                 _ERR if y == [] else ' '.join(y)]
+                for x,y in ali ]
+
+    return ' '.join((ref_word if ref_word == hyp_word else f'({ref_word}->{hyp_word})'
+                     for ref_word,hyp_word in ali))
+
+
+class ErrorStats(object):
+    '''Accumulates the error statistics written by :func:`write_error_stats`.
+
+    Each (ref, hyp) pair is aligned once, when it is added, and only the
+    counters and the per-utterance detail lines are kept. If a
+    `multiprocessing.Pool` is given, :meth:`update` aligns each batch of
+    results in the pool and returns immediately, so the alignment overlaps
+    with decoding. The pool can be shared by several instances, e.g., one
+    per LM scale.
+    '''
+
+    def __init__(self, pool: Optional[multiprocessing.pool.Pool] = None):
+        self.subs: Dict[Tuple[str,str], int] = defaultdict(int)
+        self.ins: Dict[str, int] = defaultdict(int)
+        self.dels: Dict[str, int] = defaultdict(int)
+        # `words` stores counts per word, as follows:
+        #   corr, ref_sub, hyp_sub, ins, dels
+        self.words: Dict[str, List[int]] = defaultdict(_zero_word_counts)
+        self.num_corr = 0
+        self.ref_len = 0
+        self.utt_details: List[str] = []
+        self._pool = pool
+        self._pending = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['_pending'] = []
+        return state
+
+    def add(self, ref: List[str], hyp: List[str]) -> None:
+        ali = kaldialign.align(ref, hyp, _ERR)
         for ref_word,hyp_word in ali:
-            if ref_word == ERR:
-                ins[hyp_word] += 1
-                words[hyp_word][3] += 1
-            elif hyp_word == ERR:
-                dels[ref_word] += 1
-                words[ref_word][4] += 1
+            if ref_word == _ERR:
+                self.ins[hyp_word] += 1
+                self.words[hyp_word][3] += 1
+            elif hyp_word == _ERR:
+                self.dels[ref_word] += 1
+                self.words[ref_word][4] += 1
             elif hyp_word != ref_word:
-                subs[(ref_word,hyp_word)] += 1
-                words[ref_word][1] += 1
-                words[hyp_word][2] += 1
+                self.subs[(ref_word,hyp_word)] += 1
+                self.words[ref_word][1] += 1
+                self.words[hyp_word][2] += 1
             else:
-                words[ref_word][0] += 1
-                num_corr += 1
-    ref_len = sum([len(r) for r,_ in results])
-    sub_errs = sum(subs.values())
-    ins_errs = sum(ins.values())
-    del_errs = sum(dels.values())
-    tot_errs = sub_errs + ins_errs + del_errs
-    tot_err_rate = '%.2f' % (100.0 * tot_errs / ref_len)
-
-    logging.info(
-        f'[{test_set_name}] %WER {tot_errs / ref_len:.2%} '
-        f'[{tot_errs} / {ref_len}, {ins_errs} ins, {del_errs} del, {sub_errs} sub ]'
-    )
-
-    print(f"%WER = {tot_err_rate}", file=f)
-    print(f"Errors: {ins_errs} insertions, {del_errs} deletions, {sub_errs} substitutions, over {ref_len} reference words ({num_corr} correct)",
-          file=f)
-    print("Search below for sections starting with PER-UTT DETAILS:, SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
-          file=f)
-
-    print("", file=f)
-    print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
-    for ref, hyp in results:
-        ali = kaldialign.align(ref, hyp, ERR)
-        combine_successive_errors = True
-        if combine_successive_errors:
-            ali = [ [[x],[y]] for x,y in ali ]
-            for i in range(len(ali) - 1):
-                if ali[i][0] != ali[i][1] and ali[i+1][0] != ali[i+1][1]:
-                    ali[i+1][0] = ali[i][0] + ali[i+1][0]
-                    ali[i+1][1] = ali[i][1] + ali[i+1][1]
-                    ali[i] = [[],[]]
-            ali = [ [list(filter(lambda a: a != ERR, x)),
-                     list(filter(lambda a: a != ERR, y))]
-                     for x,y in ali ]
-            ali = list(filter(lambda x: x != [[],[]], ali))
-            ali = [ [ERR if x == [] else ' '.join(x),
-                     ERR if y == [] else ' '.join(y)]
-                    for x,y in ali ]
-
-        print(' '.join((ref_word if ref_word == hyp_word else f'({ref_word}->{hyp_word})'
-                        for ref_word,hyp_word in ali)), file=f)
-
-
-    print("", file=f)
-    print("SUBSTITUTIONS: count ref -> hyp", file=f)
-
-    for count,(ref,hyp) in sorted([(v,k) for k,v in subs.items()], reverse=True):
-        print(f"{count}   {ref} -> {hyp}", file=f)
-
-    print("", file=f)
-    print("DELETIONS: count ref", file=f)
-    for count,ref in sorted([(v,k) for k,v in dels.items()], reverse=True):
-        print(f"{count}   {ref}", file=f)
-
-    print("", file=f)
-    print("INSERTIONS: count hyp", file=f)
-    for count,hyp in sorted([(v,k) for k,v in ins.items()], reverse=True):
-        print(f"{count}   {hyp}", file=f)
-
-    print("", file=f)
-    print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
-    for _,word,counts in sorted([(sum(v[1:]),k,v) for k,v in words.items()], reverse=True):
-        (corr, ref_sub, hyp_sub, ins, dels) = counts
-        tot_errs = ref_sub + hyp_sub + ins + dels
-        ref_count = corr + ref_sub + dels
-        hyp_count = corr + hyp_sub + ins
-
-        print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
-    return float(tot_err_rate)
+                self.words[ref_word][0] += 1
+                self.num_corr += 1
+        self.ref_len += len(ref)
+        self.utt_details.append(_per_utt_details(ali))
+
+    def update(self, results: Iterable[Tuple[List[str], List[str]]]) -> None:
+        '''Add a batch of (ref_words, hyp_words) pairs.'''
+        if self._pool is None:
+            for ref, hyp in results:
+                self.add(ref, hyp)
+            return
+        self._pending.append(
+            self._pool.apply_async(_compute_error_stats, (list(results),)))
+        # Merge finished batches in order to bound the memory used.
+        while self._pending and self._pending[0].ready():
+            self._add(self._pending.pop(0).get())
+
+    def merge(self, other: 'ErrorStats') -> None:
+        '''Add the statistics of `other`, whose utterances come after
+        those of `self`.'''
+        self.wait()
+        other.wait()
+        self._add(other)
+
+    def _add(self, other: 'ErrorStats') -> None:
+        for k, v in other.subs.items():
+            self.subs[k] += v
+        for k, v in other.ins.items():
+            self.ins[k] += v
+        for k, v in other.dels.items():
+            self.dels[k] += v
+        for k, v in other.words.items():
+            counts = self.words[k]
+            for i in range(len(counts)):
+                counts[i] += v[i]
+        self.num_corr += other.num_corr
+        self.ref_len += other.ref_len
+        self.utt_details.extend(other.utt_details)
+
+    def wait(self) -> None:
+        '''Wait for the batches that are being aligned in the pool.'''
+        pending, self._pending = self._pending, []
+        for result in pending:
+            self._add(result.get())
+
+    def write(self, f: TextIO, test_set_name: str) -> float:
+        '''Write the report of :func:`write_error_stats` to `f` and
+        return the WER in percent.'''
+        self.wait()
+        subs, ins, dels = self.subs, self.ins, self.dels
+        ref_len = self.ref_len
+        num_corr = self.num_corr
+        sub_errs = sum(subs.values())
+        ins_errs = sum(ins.values())
+        del_errs = sum(dels.values())
+        tot_errs = sub_errs + ins_errs + del_errs
+        tot_err_rate = '%.2f' % (100.0 * tot_errs / ref_len)
+
+        logging.info(
+            f'[{test_set_name}] %WER {tot_errs / ref_len:.2%} '
+            f'[{tot_errs} / {ref_len}, {ins_errs} ins, {del_errs} del, {sub_errs} sub ]'
+        )
+
+        print(f"%WER = {tot_err_rate}", file=f)
+        print(f"Errors: {ins_errs} insertions, {del_errs} deletions, {sub_errs} substitutions, over {ref_len} reference words ({num_corr} correct)",
+              file=f)
+        print("Search below for sections starting with PER-UTT DETAILS:, SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
+              file=f)
+
+        print("", file=f)
+        print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
+        for line in self.utt_details:
+            print(line, file=f)
+
+
+        print("", file=f)
+        print("SUBSTITUTIONS: count ref -> hyp", file=f)
+
+        for count,(ref,hyp) in sorted([(v,k) for k,v in subs.items()], reverse=True):
+            print(f"{count}   {ref} -> {hyp}", file=f)
+
+        print("", file=f)
+        print("DELETIONS: count ref", file=f)
+        for count,ref in sorted([(v,k) for k,v in dels.items()], reverse=True):
+            print(f"{count}   {ref}", file=f)
+
+        print("", file=f)
+        print("INSERTIONS: count hyp", file=f)
+        for count,hyp in sorted([(v,k) for k,v in ins.items()], reverse=True):
+            print(f"{count}   {hyp}", file=f)
+
+        print("", file=f)
+        print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
+        for _,word,counts in sorted([(sum(v[1:]),k,v) for k,v in self.words.items()], reverse=True):
+            (corr, ref_sub, hyp_sub, ins, dels) = counts
+            tot_errs = ref_sub + hyp_sub + ins + dels
+            ref_count = corr + ref_sub + dels
+            hyp_count = corr + hyp_sub + ins
+
+            print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
+        return float(tot_err_rate)
+
+
+def _compute_error_stats(results: List[Tuple[List[str], List[str]]]) -> ErrorStats:
+    stats = ErrorStats()
+    stats.update(results)
+    return stats
+
+
+def write_error_stats(f: TextIO, test_set_name: str, results: List[Tuple[str,str]]) -> float:
+    return _compute_error_stats(results).write(f, test_set_name)
@@ -1,11 +1,12 @@
 import argparse
 import logging
+import random
 from pathlib import Path
 from typing import List, Union
 
 from torch.utils.data import DataLoader
 
-from lhotse import Fbank, FbankConfig, load_manifest
+from lhotse import CutSet, Fbank, FbankConfig, load_manifest
 from lhotse.dataset import BucketingSampler, CutConcatenate, CutMix, K2SpeechRecognitionDataset, PrecomputedFeatures, \
     SingleCutSampler, \
     SpecAugment
@@ -101,6 +102,20 @@ class AsrDataModule(DataModule):
                  'to validate it. It should be disabled when using Apache Arrow manifests '
                  'to avoid an excessive starting time of the script with datasets>1000h.'
             )
+        group.add_argument(
+            '--valid-subset-duration',
+            type=float,
+            default=0.0,
+            help='If positive, validate on a random subset of the dev cuts '
+                 'with about this total duration (in seconds) instead of on all of them. '
+                 'The subset is the same for every validation and every run with the same seed.'
+            )
+        group.add_argument(
+            '--valid-subset-seed',
+            type=int,
+            default=0,
+            help='The random seed used to select the dev cuts for --valid-subset-duration.'
+            )
 
     def train_dataloaders(self) -> DataLoader:
         logging.info("About to get train cuts")
@@ -178,9 +193,33 @@ class AsrDataModule(DataModule):
         )
         return train_dl
 
+    def valid_subset(self, cuts: CutSet) -> CutSet:
+        '''Return a random subset of `cuts` whose total duration does not
+        exceed --valid-subset-duration, or `cuts` if it is not positive.
+
+        The selection only depends on the cut IDs and --valid-subset-seed,
+        so it does not change between validations, runs or processes.
+        '''
+        max_duration = self.args.valid_subset_duration
+        if max_duration <= 0:
+            return cuts
+        cut_ids = sorted(cuts.ids)
+        random.Random(self.args.valid_subset_seed).shuffle(cut_ids)
+        selected = []
+        duration = 0.0
+        for cut_id in cut_ids:
+            cut_duration = cuts[cut_id].duration
+            if duration + cut_duration > max_duration:
+                continue
+            selected.append(cut_id)
+            duration += cut_duration
+        logging.info(f'Validating on {len(selected)} of {len(cut_ids)} dev cuts '
+                     f'({duration:.1f} seconds)')
+        return cuts.subset(cut_ids=selected)
+
     def valid_dataloaders(self) -> DataLoader:
         logging.info("About to get dev cuts")
-        cuts_valid = self.valid_cuts()
+        cuts_valid = self.valid_subset(self.valid_cuts())
 
         transforms = [ ]
         if self.args.concatenate_cuts:
@@ -0,0 +1,183 @@
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import k2
+import torch
+
+from snowfall.decoding.lm_rescore import compute_am_scores
+from snowfall.decoding.lm_rescore import compute_lm_scores
+from snowfall.decoding.nbest import Nbest
+from snowfall.models.transformer import Transformer
+from snowfall.models.transformer import get_hierarchical_targets
+
+
+@torch.no_grad()
+def compute_attention_scores(model: Transformer,
+                             memory: torch.Tensor,
+                             memory_mask: Optional[torch.Tensor],
+                             nbest: Nbest,
+                             path_to_memory_map: torch.Tensor,
+                             lexicon: Optional[k2.Fsa] = None,
+                             max_paths_per_batch: Optional[int] = None
+                            ) -> torch.Tensor:
+    '''Compute the attention decoder scores of the paths of an n-best list.
+
+    The encoder output is not recomputed; the columns of `memory` are
+    gathered for the paths and all paths are scored with one padded
+    decoder forward pass.
+
+    Args:
+      model:
+        A model with an attention decoder.
+      memory:
+        The encoder output of dimension (input_length, batch_size, d_model),
+        i.e., the second return value of `model(feature, supervisions)`.
+      memory_mask:
+        The third return value of `model(feature, supervisions)`.
+      nbest:
+        The n-best list.
+      path_to_memory_map:
+        A 1-D torch.Tensor. path_to_memory_map[i] is the column of `memory`
+        that the i-th path of `nbest` is scored against.
+      lexicon:
+        If not None, it has words as labels and decoder tokens
+        (e.g., phones) as aux_labels and it is used to convert the word
+        sequences to decoder token sequences. If None, the word IDs are
+        used as decoder tokens (e.g., for BPE models).
+      max_paths_per_batch:
+        If not None, the decoder is run on at most this many paths at a
+        time to limit memory use.
+    Returns:
+      Return a 1-D torch.Tensor containing the log-probability of each path
+      given by the attention decoder.
+    '''
+    num_paths = nbest.num_paths
+    if num_paths == 0:
+        return torch.zeros(0, dtype=memory.dtype, device=memory.device)
+
+    word_seqs = k2.ragged.to_list(nbest.word_seqs)
+    token_ids = get_hierarchical_targets(word_seqs, lexicon)
+
+    path_to_memory_map = path_to_memory_map.to(device=memory.device,
+                                               dtype=torch.int64)
+    if max_paths_per_batch is None:
+        max_paths_per_batch = num_paths
+
+    ans = []
+    for start in range(0, num_paths, max_paths_per_batch):
+        end = min(start + max_paths_per_batch, num_paths)
+        indexes = path_to_memory_map[start:end]
+        mask = None
+        if memory_mask is not None:
+            mask = memory_mask.index_select(0, indexes)
+        nll = model.decoder_nll(memory.index_select(1, indexes), mask,
+                                token_ids[start:end])
+        ans.append(-nll)
+    return torch.cat(ans)
+
+
+@torch.no_grad()
+def rescore_with_attention_decoder(
+        lats: k2.Fsa,
+        num_paths: int,
+        model: Transformer,
+        memory: torch.Tensor,
+        memory_mask: Optional[torch.Tensor],
+        sequence_idx: torch.Tensor,
+        att_scale_list: List[float],
+        lexicon: Optional[k2.Fsa] = None,
+        G: Optional[k2.Fsa] = None,
+        lm_scale_list: Optional[List[float]] = None,
+        use_top_k: bool = False,
+        max_paths_per_batch: Optional[int] = None) -> Dict[str, k2.Fsa]:
+    '''Decode using n-best list rescored with the attention decoder and,
+    optionally, an n-gram LM.
+
+    For each path of the n-best list, the AM score, the attention decoder
+    score and, if `G` is given, the LM score are computed. The total score
+    is
+
+        (am_scores + att_scale * att_scores) / lm_scale + lm_scores
+
+    with LM rescoring and `am_scores + att_scale * att_scores` without.
+    The path with the greatest total score within a sequence is used as the
+    decoding output.
+
+    Args:
+      lats:
+        An FsaVec. It can be the output of `k2.intersect_dense_pruned`.
+      num_paths:
+        It is the size `n` in `n-best` list.
+      model:
+        The model that produced `memory`. It must have an attention decoder.
+      memory:
+        The encoder output of dimension (input_length, batch_size, d_model).
+      memory_mask:
+        Mask tensor of dimension (batch_size, input_length) or None.
+      sequence_idx:
+        A 1-D torch.Tensor. sequence_idx[i] is the column of `memory`
+        of the i-th FSA in `lats`, i.e., the first column of the
+        supervision segments used to compute `lats`.
+      att_scale_list:
+        A list containing scales of the attention decoder scores.
+      lexicon:
+        See :func:`compute_attention_scores`.
+      G:
+        If not None, an FsaVec containing one Fsa representing the LM.
+      lm_scale_list:
+        Required if `G` is not None. A list containing lm_scale values.
+      use_top_k:
+        See :meth:`snowfall.decoding.nbest.Nbest.from_lattice`.
+      max_paths_per_batch:
+        See :func:`compute_attention_scores`.
+    Returns:
+      A dict of FsaVec, whose key is `att_scale_xxx` (or
+      `lm_scale_xxx_att_scale_yyy` with LM rescoring) and the value
+      represents the best decoding path for each sequence in the lattice.
+    '''
+    assert len(lats.shape) == 3
+    assert hasattr(lats, 'aux_labels')
+
+    nbest = Nbest.from_lattice(lats, num_paths, use_top_k=use_top_k)
+
+    word_fsas_with_epsilon_loops = nbest.word_fsas_with_epsilon_loops()
+
+    am_scores = compute_am_scores(lats, word_fsas_with_epsilon_loops,
+                                  nbest.path_to_seq_map)
+
+    path_to_memory_map = sequence_idx.to(lats.device)[
+        nbest.path_to_seq_map.to(torch.int64)]
+    att_scores = compute_attention_scores(
+        model,
+        memory,
+        memory_mask,
+        nbest,
+        path_to_memory_map,
+        lexicon=lexicon,
+        max_paths_per_batch=max_paths_per_batch).to(am_scores)
+
+    att_scales = torch.tensor(att_scale_list,
+                              dtype=am_scores.dtype,
+                              device=am_scores.device)
+    # scores[i][j] is the score of the j-th path with the i-th att_scale
+    scores = am_scores + att_scales.unsqueeze(1) * att_scores
+
+    if G is None:
+        keys = [f'att_scale_{att_scale}' for att_scale in att_scale_list]
+        return nbest.select_best_paths(lats, scores, keys)
+
+    assert lm_scale_list is not None
+    lm_scores = compute_lm_scores(G, word_fsas_with_epsilon_loops)
+    lm_scales = torch.tensor(lm_scale_list,
+                             dtype=am_scores.dtype,
+                             device=am_scores.device)
+    # tot_scores[i][j][k] is the total score of the k-th path with
+    # the i-th lm_scale and the j-th att_scale
+    tot_scores = scores.unsqueeze(0) / lm_scales.view(-1, 1, 1) + lm_scores
+    keys = [
+        f'lm_scale_{lm_scale}_att_scale_{att_scale}'
+        for lm_scale in lm_scale_list for att_scale in att_scale_list
+    ]
+    return nbest.select_best_paths(lats,
+                                   tot_scores.view(len(keys), -1), keys)
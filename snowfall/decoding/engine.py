@@ -0,0 +1,420 @@
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import k2
+import numpy as np
+import torch
+
+from snowfall.common import ErrorStats
+from snowfall.common import get_ragged_texts
+from snowfall.common import ragged_to_words
+from snowfall.decoding.attention_rescore import rescore_with_attention_decoder
+from snowfall.decoding.graph import prepare_HLG
+from snowfall.decoding.lm_rescore import DEFAULT_MAX_ARCS_PER_SEQ
+from snowfall.decoding.lm_rescore import LatticePruningStats
+from snowfall.decoding.lm_rescore import rescore_with_n_best_list
+from snowfall.decoding.lm_rescore import rescore_with_whole_lattice
+from snowfall.decoding.nbest import nbest_decoding
+from snowfall.decoding.pipeline import DecodingPipeline
+from snowfall.models import AcousticModel
+from snowfall.models.transformer import Transformer
+
+DEFAULT_LM_SCALES = [0.8, 0.9, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 2.0]
+DEFAULT_ATT_SCALES = [0.0, 0.1, 0.3, 0.5, 0.7, 1.0]
+
+
+def get_supervision_segments(supervisions: Dict[str, torch.Tensor],
+                             subsampling_factor: int = 4,
+                             conv_subsampling: bool = True
+                            ) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''Build the supervision segments of the network output of a batch.
+
+    Args:
+      supervisions:
+        The `supervisions` of a batch from
+        :class:`lhotse.dataset.K2SpeechRecognitionDataset`.
+      subsampling_factor:
+        The ratio of the input frame rate to the output frame rate.
+      conv_subsampling:
+        If True, the network subsamples with two convolutions of stride 2
+        without padding (e.g., :class:`snowfall.models.transformer.Transformer`),
+        so the frame indexes are mapped with ((t - 1) // 2 - 1) // 2.
+        Otherwise, they are divided by `subsampling_factor`.
+    Returns:
+      Return a tuple (supervision_segments, indices). supervision_segments
+      is a torch.int32 tensor of shape (num_supervisions, 3) sorted by
+      decreasing number of frames, as required by `k2.DenseFsaVec`;
+      supervision_segments[i] is the row indices[i] of the unsorted one.
+    '''
+    start_frame = supervisions['start_frame']
+    num_frames = supervisions['num_frames']
+    if conv_subsampling:
+        assert subsampling_factor == 4
+        start_frame = ((start_frame - 1) // 2 - 1) // 2
+        num_frames = ((num_frames - 1) // 2 - 1) // 2
+    else:
+        start_frame = torch.floor_divide(start_frame, subsampling_factor)
+        num_frames = torch.floor_divide(num_frames, subsampling_factor)
+
+    supervision_segments = torch.stack(
+        (supervisions['sequence_idx'], start_frame, num_frames),
+        1).to(torch.int32)
+    supervision_segments = torch.clamp(supervision_segments, min=0)
+    indices = torch.argsort(supervision_segments[:, 2], descending=True)
+    return supervision_segments[indices], indices
+
+
+class DecodingEngine(object):
+    '''Decodes batches from any :class:`snowfall.data.AsrDataModule` with
+    an HLG and, optionally, rescores the lattices.
+
+    The model and the graphs are moved to `device` and prepared once, in
+    the constructor, so a long-lived process can decode many test sets
+    without reloading them.
+
+    The strategy is one of:
+
+        - `1best`: the shortest path of the lattice.
+        - `nbest`: n-best list decoding, see
+          :func:`snowfall.decoding.nbest.nbest_decoding`.
+        - `nbest-lm`: n-best list rescoring with `G`.
+        - `whole-lattice`: whole lattice rescoring with `G`.
+        - `attention`: n-best list rescoring with the attention decoder of
+          the model and, if `G` is given, with `G`.
+
+    Usage::
+
+        engine = DecodingEngine(model, HLG, strategy='whole-lattice', G=G,
+                                device='cuda')
+        for test_set, dl in zip(test_sets, datamodule.test_dataloaders()):
+            results = engine.decode_dataset(dl, words)
+    '''
+
+    STRATEGIES = ('1best', 'nbest', 'nbest-lm', 'whole-lattice', 'attention')
+
+    def __init__(self,
+                 model: AcousticModel,
+                 HLG: k2.Fsa,
+                 strategy: str = '1best',
+                 G: Optional[k2.Fsa] = None,
+                 lexicon: Optional[k2.Fsa] = None,
+                 device: Union[str, torch.device] = 'cpu',
+                 search_beam: float = 20.0,
+                 output_beam_size: float = 8.0,
+                 min_active_states: int = 30,
+                 max_active_states: int = 10000,
+                 num_paths: int = 100,
+                 use_top_k: bool = False,
+                 lm_scale_list: Optional[List[float]] = None,
+                 att_scale_list: Optional[List[float]] = None,
+                 max_arcs_per_seq: Optional[int] = DEFAULT_MAX_ARCS_PER_SEQ,
+                 conv_subsampling: Optional[bool] = None):
+        '''
+        Args:
+          model:
+            The acoustic model. It is moved to `device` and put in
+            evaluation mode.
+          HLG:
+            The decoding graph, e.g., from
+            :func:`snowfall.decoding.graph.load_HLG`.
+          strategy:
+            One of :attr:`STRATEGIES`.
+          G:
+            An FsaVec containing the LM, e.g., from
+            :func:`snowfall.decoding.graph.load_G`. Required by `nbest-lm`
+            and `whole-lattice`, optional for `attention` and ignored
+            otherwise. Epsilon self-loops are added for `whole-lattice`.
+          lexicon:
+            Used only by `attention`. See
+            :func:`snowfall.decoding.attention_rescore.compute_attention_scores`.
+          device:
+            The device to decode on.
+          search_beam, output_beam_size, min_active_states, max_active_states:
+            The arguments of `k2.intersect_dense_pruned`.
+          num_paths:
+            The size `n` of n-best lists.
+          use_top_k:
+            If True, n-best lists contain the `num_paths` best distinct
+            word sequences instead of `num_paths` random paths.
+          lm_scale_list:
+            The LM scales to try. Defaults to :data:`DEFAULT_LM_SCALES`.
+          att_scale_list:
+            The attention decoder scales to try. Defaults to
+            :data:`DEFAULT_ATT_SCALES`.
+          max_arcs_per_seq:
+            Used only by `whole-lattice`. If not None, lattices with more
+            arcs than this are pruned before rescoring. See
+            :func:`snowfall.decoding.lm_rescore.rescore_with_whole_lattice`.
+          conv_subsampling:
+            See :func:`get_supervision_segments`. If None, it is True for
+            :class:`snowfall.models.transformer.Transformer` and its
+            subclasses.
+        '''
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f'Unsupported decoding strategy: {strategy}. '
+                             f'Choose one of {self.STRATEGIES}')
+        if strategy in ('nbest-lm', 'whole-lattice') and G is None:
+            raise ValueError(f'Decoding strategy {strategy} requires G')
+        if strategy != 'whole-lattice' and strategy != '1best' \
+                and num_paths < 1:
+            raise ValueError(f'Decoding strategy {strategy} requires '
+                             f'num_paths > 0')
+        if strategy == 'attention' and getattr(
+                model, 'decoder_num_class', None) is None:
+            raise ValueError('Decoding strategy attention requires a model '
+                             'with an attention decoder')
+
+        self.device = torch.device(device)
+        self.strategy = strategy
+        self.model = model.to(self.device)
+        self.model.eval()
+
+        self.HLG = prepare_HLG(HLG.to(self.device))
+
+        if strategy in ('1best', 'nbest'):
+            G = None
+        if G is not None:
+            G = G.to(self.device)
+            if strategy == 'whole-lattice':
+                # Add epsilon self-loops to G as we will compose
+                # it with the whole lattice later
+                G = k2.arc_sort(k2.add_epsilon_self_loops(G))
+            # G.lm_scores is used to replace HLG.lm_scores during
+            # LM rescoring.
+            G.lm_scores = G.scores.clone()
+        self.G = G
+
+        self.lexicon = lexicon.to(self.device) if lexicon is not None else None
+
+        self.search_beam = search_beam
+        self.output_beam_size = output_beam_size
+        self.min_active_states = min_active_states
+        self.max_active_states = max_active_states
+        self.num_paths = num_paths
+        self.use_top_k = use_top_k
+        self.lm_scale_list = list(
+            lm_scale_list if lm_scale_list is not None else DEFAULT_LM_SCALES)
+        self.att_scale_list = list(att_scale_list if att_scale_list
+                                   is not None else DEFAULT_ATT_SCALES)
+        self.max_arcs_per_seq = max_arcs_per_seq
+
+        if conv_subsampling is None:
+            conv_subsampling = isinstance(model, Transformer)
+        self.conv_subsampling = conv_subsampling
+
+    @torch.no_grad()
+    def forward(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        '''Run the neural network on one batch.
+
+        It can be overlapped with :meth:`search` of the previous batch
+        (see :class:`snowfall.decoding.pipeline.DecodingPipeline`).
+
+        Returns:
+          Return a dict with the network output and the sorted supervision
+          segments, which is the input of :meth:`search`.
+        '''
+        feature = batch['inputs']
+        assert feature.ndim == 3
+        feature = feature.to(self.device, non_blocking=True)
+
+        # at entry, feature is [N, T, C]
+        feature = feature.permute(0, 2, 1)  # now feature is [N, C, T]
+
+        supervisions = batch['supervisions']
+
+        if isinstance(self.model, Transformer):
+            nnet_output, encoder_memory, memory_mask = self.model(
+                feature, supervisions)
+        else:
+            nnet_output = self.model(feature)
+            if isinstance(nnet_output, tuple):
+                nnet_output = nnet_output[0]
+            encoder_memory, memory_mask = None, None
+        # nnet_output is [N, C, T]
+
+        nnet_output = nnet_output.permute(0, 2, 1)
+        # now nnet_output is [N, T, C]
+
+        supervision_segments, indices = get_supervision_segments(
+            supervisions,
+            subsampling_factor=getattr(self.model, 'subsampling_factor', 4),
+            conv_subsampling=self.conv_subsampling)
+
+        return {
+            'nnet_output': nnet_output,
+            'encoder_memory': encoder_memory,
+            'memory_mask': memory_mask,
+            'supervision_segments': supervision_segments,
+            'indices': indices,
+        }
+
+    @torch.no_grad()
+    def search(self,
+               forward_output: Dict[str, Any],
+               pruning_stats: Optional[LatticePruningStats] = None
+              ) -> Dict[str, k2.RaggedInt]:
+        '''
+        Search the decoding graph with the network output of one batch and
+        return the result in a dict. The dict has the
+        following format:
+
+            - key: It indicates the setting used for decoding. For example,
+                   if no rescoring is used, the key is the string
+                   `no_rescore`. If LM rescoring is used, the key is the
+                   string `lm_scale_xxx`, where `xxx` is the value of
+                   `lm_scale`. An example key is `lm_scale_0.7`
+            - value: It contains the decoding result, a k2.RaggedInt with
+                     axes [utt][word]. `value.dim0()` equals to batch size.
+                     `value[i]` contains the word IDs decoded for the i-th
+                     utterance in the given batch.
+
+        Args:
+          forward_output:
+            The return value of :meth:`forward`.
+          pruning_stats:
+            If not None, it accumulates the pruning statistics of whole
+            lattice rescoring.
+        '''
+        nnet_output = forward_output['nnet_output']
+        supervision_segments = forward_output['supervision_segments']
+        indices = forward_output['indices']
+
+        dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
+
+        lattices = k2.intersect_dense_pruned(self.HLG, dense_fsa_vec,
+                                             self.search_beam,
+                                             self.output_beam_size,
+                                             self.min_active_states,
+                                             self.max_active_states)
+
+        if self.strategy == '1best':
+            best_paths = k2.shortest_path(lattices, use_double_scores=True)
+            return {'no_rescore': get_ragged_texts(best_paths, indices)}
+
+        if self.strategy == 'nbest':
+            best_paths = nbest_decoding(lattices, self.num_paths,
+                                        self.use_top_k)
+            if self.use_top_k:
+                key = f'no_rescore-top-{self.num_paths}'
+            else:
+                key = f'no_rescore-{self.num_paths}'
+            return {key: get_ragged_texts(best_paths, indices)}
+
+        if self.strategy == 'attention':
+            best_paths_dict = rescore_with_attention_decoder(
+                lattices,
+                self.num_paths,
+                model=self.model,
+                memory=forward_output['encoder_memory'],
+                memory_mask=forward_output['memory_mask'],
+                sequence_idx=supervision_segments[:, 0],
+                att_scale_list=self.att_scale_list,
+                lexicon=self.lexicon,
+                G=self.G,
+                lm_scale_list=self.lm_scale_list,
+                use_top_k=self.use_top_k)
+        elif self.strategy == 'whole-lattice':
+            best_paths_dict = rescore_with_whole_lattice(
+                lattices,
+                self.G,
+                self.lm_scale_list,
+                max_arcs_per_seq=self.max_arcs_per_seq,
+                pruning_stats=pruning_stats)
+        else:
+            best_paths_dict = rescore_with_n_best_list(
+                lattices,
+                self.G,
+                self.num_paths,
+                self.lm_scale_list,
+                use_top_k=self.use_top_k)
+        # best_paths_dict is a dict
+        #  - key: lm_scale_xxx, where xxx is the value of lm_scale. An example
+        #         key is lm_scale_1.2
+        #  - value: it is the best path obtained using the corresponding lm
+        #           scale from the dict key.
+        return {
+            key: get_ragged_texts(best_paths, indices)
+            for key, best_paths in best_paths_dict.items()
+        }
+
+    def decode_batch(self, batch: Dict[str, Any]) -> Dict[str, k2.RaggedInt]:
+        '''Decode one batch. See :meth:`search` for the return value.'''
+        return self.search(self.forward(batch))
+
+    def decode(self,
+               dataloader: Iterable[Dict[str, Any]],
+               postprocess: Optional[Callable[[Dict[str, Any], Dict[str, k2.RaggedInt]], Any]] = None,
+               pruning_stats: Optional[LatticePruningStats] = None
+              ) -> Iterator[Any]:
+        '''Decode all batches of `dataloader` with a
+        :class:`snowfall.decoding.pipeline.DecodingPipeline`.
+
+        Yields:
+          The return value of `postprocess(batch, search_output)`, or of
+          :meth:`search` if `postprocess` is None, for each batch, in order.
+        '''
+        def search(batch, forward_output):
+            return self.search(forward_output, pruning_stats)
+
+        pipeline = DecodingPipeline(self.forward,
+                                    search,
+                                    postprocess,
+                                    device=self.device)
+        return pipeline(dataloader)
+
+    def decode_dataset(
+            self,
+            dataloader: torch.utils.data.DataLoader,
+            words: np.ndarray,
+            error_stats: Optional[Dict[str, ErrorStats]] = None,
+            pruning_stats: Optional[LatticePruningStats] = None
+    ) -> Dict[str, List[Tuple[List[str], List[str]]]]:
+        '''Decode a test set.
+
+        Args:
+          dataloader:
+            A dataloader whose batches have the transcripts in
+            `batch['supervisions']['text']`.
+          words:
+            The return value of :func:`snowfall.common.get_word_table`.
+          error_stats:
+            If not None, the results of each batch are also added to
+            error_stats[key] as soon as they are available.
+          pruning_stats:
+            See :meth:`search`.
+        Returns:
+          Return a dict whose key is a key of :meth:`search` and the value
+          is a list of tuples (ref_words, hyp_words).
+        '''
+        tot_num_cuts = len(dataloader.dataset.cuts)
+        num_cuts = 0
+        results = defaultdict(list)
+
+        def postprocess(batch, hyps_dict):
+            # Runs in a worker thread while the next batch is searched.
+            texts = batch['supervisions']['text']
+            ans = dict()
+            for key, hyps in hyps_dict.items():
+                hyps = ragged_to_words(hyps, words)
+                assert len(hyps) == len(texts)
+                ans[key] = [(text.split(' '), hyp)
+                            for text, hyp in zip(texts, hyps)]
+            return ans
+
+        for batch_idx, batch_results in enumerate(
+                self.decode(dataloader, postprocess, pruning_stats)):
+            for key, this_batch in batch_results.items():
+                results[key].extend(this_batch)
+                if error_stats is not None:
+                    error_stats[key].update(this_batch)
+
+            if batch_idx % 10 == 0:
+                logging.info(
+                    'batch {}, cuts processed until now is {}/{} ({:.6f}%)'.
+                    format(batch_idx, num_cuts, tot_num_cuts,
+                           float(num_cuts) / tot_num_cuts * 100))
+
+            num_cuts += len(next(iter(batch_results.values())))
+
+        return results
@@ -1,42 +1,18 @@
 import logging
+import weakref
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Optional, Union
 
 import k2
 import torch
 from k2 import Fsa
 
+from snowfall.common import Pathlike
+from snowfall.training.graph_cache import GraphCache, fsa_fingerprint
 
-def compile_HLG(
-        L: Fsa,
-        G: Fsa,
-        H: Fsa,
-        labels_disambig_id_start: int,
-        aux_labels_disambig_id_start: int
-) -> Fsa:
-    """
-    Creates a decoding graph using a lexicon fst ``L`` and language model fsa ``G``.
-    Involves arc sorting, intersection, determinization, removal of disambiguation symbols
-    and adding epsilon self-loops.
 
-    Args:
-        L:
-            An ``Fsa`` that represents the lexicon (L), i.e. has phones as ``symbols``
-                and words as ``aux_symbols``.
-        G:
-            An ``Fsa`` that represents the language model (G), i.e. it's an acceptor
-            with words as ``symbols``.
-        H:  An ``Fsa`` that represents a specific topology used to convert the network
-            outputs to a sequence of phones.
-            Typically, it's a CTC topology fst, in which when 0 appears on the left
-            side, it represents the blank symbol; when it appears on the right side,
-            it indicates an epsilon.
-        labels_disambig_id_start:
-            An integer ID corresponding to the first disambiguation symbol in the
-            phonetic alphabet.
-        aux_labels_disambig_id_start:
-            An integer ID corresponding to the first disambiguation symbol in the
-            words vocabulary.
-    :return:
-    """
+def _compose_LG(L: Fsa, G: Fsa) -> Fsa:
     L = k2.arc_sort(L)
     G = k2.arc_sort(G)
     # Attach a new attribute `lm_scores` so that we can recover
@@ -50,14 +26,19 @@ def compile_HLG(
     LG = k2.compose(L, G)
     logging.info(f'LG shape = {LG.shape}')
     logging.info("Connecting L*G")
-    LG = k2.connect(LG)
-    logging.info(f'LG shape = {LG.shape}')
+    return k2.connect(LG)
+
+
+def _determinize_LG(LG: Fsa) -> Fsa:
     logging.info("Determinizing L*G")
     LG = k2.determinize(LG)
     logging.info(f'LG shape = {LG.shape}')
     logging.info("Connecting det(L*G)")
-    LG = k2.connect(LG)
-    logging.info(f'LG shape = {LG.shape}')
+    return k2.connect(LG)
+
+
+def _remove_epsilon_LG(LG: Fsa, labels_disambig_id_start: int,
+                       aux_labels_disambig_id_start: int) -> Fsa:
     logging.info("Removing disambiguation symbols on L*G")
     LG.labels[LG.labels >= labels_disambig_id_start] = 0
     if isinstance(LG.aux_labels, torch.Tensor):
@@ -69,12 +50,13 @@ def compile_HLG(
     logging.info(f'LG shape = {LG.shape}')
     logging.info("Connecting rm-eps(det(L*G))")
     LG = k2.connect(LG)
-    logging.info(f'LG shape = {LG.shape}')
     LG.aux_labels = k2.ragged.remove_values_eq(LG.aux_labels, 0)
 
     logging.info("Arc sorting LG")
-    LG = k2.arc_sort(LG)
+    return k2.arc_sort(LG)
+
 
+def _compose_HLG(H: Fsa, LG: Fsa) -> Fsa:
     logging.info("Composing ctc_topo LG")
     HLG = k2.compose(H, LG, inner_labels='phones')
 
@@ -86,5 +68,256 @@ def compile_HLG(
     logging.info(
         f'LG is arc sorted: {(HLG.properties & k2.fsa_properties.ARC_SORTED) != 0}'
     )
+    return HLG
+
+
+def _rm_eps_key(labels_disambig_id_start: int,
+                aux_labels_disambig_id_start: int) -> str:
+    # The disambiguation IDs only affect this stage,
+    # so they are part of its key only.
+    return f'rm-eps(det(L*G)) {labels_disambig_id_start} {aux_labels_disambig_id_start}'
+
 
+def compile_LG(
+        L: Fsa,
+        G: Fsa,
+        labels_disambig_id_start: int,
+        aux_labels_disambig_id_start: int,
+        cache_dir: Optional[Pathlike] = None
+) -> Fsa:
+    """
+    Creates ``rm-eps(det(L*G))`` with disambiguation symbols removed and arcs
+    sorted, which is the part of :func:`compile_HLG` that does not depend
+    on ``H``.
+
+    The intermediate results ``L*G``, ``det(L*G)`` and ``rm-eps(det(L*G))``
+    are stored in ``cache_dir`` if it is not None, keyed by the fingerprint
+    of ``L`` and ``G``. A later call with the same ``L`` and ``G``
+    loads the latest stage available instead of recomputing it.
+
+    See :func:`compile_HLG` for the meaning of the arguments.
+    """
+    cache = None
+    if cache_dir is not None:
+        logging.info("Fingerprinting L and G")
+        cache = GraphCache(cache_dir, fsa_fingerprint(L, G))
+
+    def run_stage(key: str, compute: Callable[[], Fsa]) -> Fsa:
+        fsa = cache.get(key) if cache is not None else None
+        if fsa is not None:
+            logging.info(f'Loaded cached {key}')
+        else:
+            fsa = compute()
+            if cache is not None:
+                cache.put(key, fsa)
+        logging.info(f'{key} shape = {fsa.shape}')
+        return fsa
+
+    return run_stage(
+        _rm_eps_key(labels_disambig_id_start, aux_labels_disambig_id_start),
+        lambda: _remove_epsilon_LG(
+            run_stage('det(L*G)',
+                      lambda: _determinize_LG(
+                          run_stage('L*G', lambda: _compose_LG(L, G)))),
+            labels_disambig_id_start, aux_labels_disambig_id_start))
+
+
+def compile_HLG(
+        L: Fsa,
+        G: Fsa,
+        H: Fsa,
+        labels_disambig_id_start: int,
+        aux_labels_disambig_id_start: int,
+        cache_dir: Optional[Pathlike] = None
+) -> Fsa:
+    """
+    Creates a decoding graph using a lexicon fst ``L`` and language model fsa ``G``.
+    Involves arc sorting, intersection, determinization, removal of disambiguation symbols
+    and adding epsilon self-loops.
+
+    Args:
+        L:
+            An ``Fsa`` that represents the lexicon (L), i.e. has phones as ``symbols``
+                and words as ``aux_symbols``.
+        G:
+            An ``Fsa`` that represents the language model (G), i.e. it's an acceptor
+            with words as ``symbols``.
+        H:  An ``Fsa`` that represents a specific topology used to convert the network
+            outputs to a sequence of phones.
+            Typically, it's a CTC topology fst, in which when 0 appears on the left
+            side, it represents the blank symbol; when it appears on the right side,
+            it indicates an epsilon.
+        labels_disambig_id_start:
+            An integer ID corresponding to the first disambiguation symbol in the
+            phonetic alphabet.
+        aux_labels_disambig_id_start:
+            An integer ID corresponding to the first disambiguation symbol in the
+            words vocabulary.
+        cache_dir:
+            If not None, a directory where the intermediate graphs built from
+            ``L`` and ``G`` are cached (see :func:`compile_LG`), so that
+            changing only ``H`` does not redo the determinization of ``L*G``.
+    :return:
+    """
+    LG = compile_LG(L=L,
+                    G=G,
+                    labels_disambig_id_start=labels_disambig_id_start,
+                    aux_labels_disambig_id_start=aux_labels_disambig_id_start,
+                    cache_dir=cache_dir)
+    return _compose_HLG(H, LG)
+
+
+# The graphs returned by prepare_HLG() and load_HLG(). prepare_HLG() returns
+# them as is: the graphs of load_HLG() are cached and shared, so they must
+# not be modified.
+_prepared_HLGs = weakref.WeakSet()
+
+
+def prepare_HLG(HLG: Fsa) -> Fsa:
+    """
+    Applies the post-processing that decoding needs to a graph returned by
+    :func:`compile_HLG`: epsilons (0s) are removed from the ragged
+    ``aux_labels``, ``lm_scores`` is attached if it is missing, the arcs
+    are sorted and gradients are disabled.
+
+    A graph that has already been prepared, i.e., one returned by this
+    function or by :func:`load_HLG` (or moved with ``.to()`` to the device
+    it is already on), is returned as is, without any work or modification.
+
+    Args:
+        HLG:
+            The decoding graph. It is modified in-place if possible.
+    :return:
+        Returns the prepared graph.
+    """
+    if HLG in _prepared_HLGs:
+        return HLG
+    if isinstance(HLG.aux_labels, k2.RaggedInt):
+        HLG.aux_labels = k2.ragged.remove_values_eq(HLG.aux_labels, 0)
+    if not hasattr(HLG, 'lm_scores'):
+        HLG.lm_scores = HLG.scores.clone()
+    if (HLG.properties & k2.fsa_properties.ARC_SORTED) == 0:
+        HLG = k2.arc_sort(HLG)
+    HLG.requires_grad_(False)
+    _prepared_HLGs.add(HLG)
+    return HLG
+
+
+def save_HLG(HLG: Fsa, filename: Pathlike) -> None:
+    """
+    Saves ``HLG`` after :func:`prepare_HLG` so that :func:`load_HLG`
+    does not need to post-process it again.
+
+    The file contains ``{'fsa': HLG.as_dict(), 'prepared': True}``.
+    Files written by ``torch.save(HLG.as_dict(), filename)``
+    can still be read by :func:`load_HLG`.
+    """
+    HLG = prepare_HLG(HLG.to('cpu'))
+    torch.save({'fsa': HLG.as_dict(), 'prepared': True}, filename)
+
+
+@lru_cache(maxsize=None)
+def _load_HLG(filename: str, device: str, share_memory: bool) -> Fsa:
+    logging.debug(f'Loading {filename}')
+    d = torch.load(filename, map_location='cpu')
+    if d.get('prepared', False):
+        d = d['fsa']
+        prepared = True
+    else:
+        logging.warning(f'{filename} has not been saved by save_HLG(); '
+                        f'post-processing it on every load. '
+                        f'Re-save it with save_HLG() to avoid that.')
+        prepared = False
+    if share_memory:
+        for value in d.values():
+            if isinstance(value, torch.Tensor):
+                value.share_memory_()
+    HLG = Fsa.from_dict(d).to(device)
+    if prepared:
+        _prepared_HLGs.add(HLG)
+    else:
+        HLG = prepare_HLG(HLG)
     return HLG
+
+
+def load_HLG(filename: Pathlike,
+             device: Union[str, torch.device] = 'cpu',
+             share_memory: bool = False) -> Fsa:
+    """
+    Loads a decoding graph ready to be used with
+    ``k2.intersect_dense_pruned``.
+
+    The graph is read from disk only the first time it is requested for
+    a given ``(filename, device)``; later calls in the same process return
+    the same (read-only) object.
+
+    Args:
+        filename:
+            A file written by :func:`save_HLG` or by
+            ``torch.save(HLG.as_dict(), filename)``.
+        device:
+            The device to move the graph to.
+        share_memory:
+            If True and ``device`` is the CPU, the tensors of the graph are
+            moved to shared memory, so that worker processes created with
+            ``torch.multiprocessing`` use the graph without copying it.
+            Note that torch.load() cannot memory-map files in the PyTorch
+            versions we support, so each process that calls this function
+            itself still reads the whole file.
+    :return:
+        Returns the prepared graph.
+    """
+    return _load_HLG(str(Path(filename).resolve()), str(torch.device(device)),
+                     share_memory)
+
+
+def load_G(lang_dir: Pathlike,
+           first_word_disambig_id: int,
+           device: Union[str, torch.device] = 'cpu',
+           name: str = 'G_4_gram') -> Fsa:
+    """
+    Loads an n-gram LM for rescoring lattices produced with an HLG.
+
+    The LM is read from ``<lang_dir>/<name>.pt`` if it exists. Otherwise, it
+    is read from ``<name>.fst.pt`` (written by ``snowfall lm arpa2fsa``) or
+    ``<name>.fst.txt`` (OpenFst text format), converted, and saved to
+    ``<name>.pt`` for the next time.
+
+    Args:
+        lang_dir:
+            The directory containing the LM.
+        first_word_disambig_id:
+            The ID of ``#0``. Arcs entering the back-off states have this
+            label; it is replaced with 0.
+        device:
+            The device to move the LM to.
+        name:
+            The name of the LM files without extensions.
+    :return:
+        Returns an arc-sorted FsaVec containing one acceptor. Epsilon
+        self-loops and ``lm_scores`` are not added.
+    """
+    lang_dir = Path(lang_dir)
+    if (lang_dir / f'{name}.pt').exists():
+        logging.debug(f'Loading pre-compiled {name}.pt')
+        d = torch.load(lang_dir / f'{name}.pt', map_location='cpu')
+        return Fsa.from_dict(d).to(device)
+
+    if (lang_dir / f'{name}.fst.pt').exists():
+        # Written by `snowfall lm arpa2fsa`, see run.sh
+        logging.debug(f'Loading {name}.fst.pt')
+        G = Fsa.from_dict(torch.load(lang_dir / f'{name}.fst.pt'))
+    else:
+        logging.debug(f'Loading {name}.fst.txt')
+        with open(lang_dir / f'{name}.fst.txt') as f:
+            G = Fsa.from_openfst(f.read(), acceptor=False)
+    # G.aux_labels is not needed in later computations, so
+    # remove it here.
+    del G.aux_labels
+    # CAUTION(fangjun): The following line is crucial.
+    # Arcs entering the back-off state have label equal to #0.
+    # We have to change it to 0 here.
+    G.labels[G.labels >= first_word_disambig_id] = 0
+    G = k2.arc_sort(k2.create_fsa_vec([G]))
+    torch.save(G.as_dict(), lang_dir / f'{name}.pt')
+    return G.to(device)
@@ -3,53 +3,275 @@
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Sequence
 
+import logging
 import math
 
 import k2
 import torch
 
+from snowfall.common import get_num_arcs_per_fsa
+from snowfall.common import invert_permutation
+from snowfall.common import split_into_sub_batches
+from snowfall.decoding.nbest import Nbest
 
-def _intersect_device(a_fsas: k2.Fsa, b_fsas: k2.Fsa, b_to_a_map: torch.Tensor,
-                      sorted_match_a: bool):
+
+class IntersectBatchSizer(object):
+    '''Chooses the sub-batch sizes of :func:`_intersect_device`.
+
+    The cost of intersecting the i-th FSA of `b_fsas` is estimated as
+    `fan_out * num_arcs(b_fsas[i])`, the expected number of arcs of the
+    result. The size of `a_fsas` is not used: an n-gram LM or a lattice
+    matched against a path or a pruned lattice produces an output
+    proportional to the latter, while the product of both sizes would
+    overestimate it by orders of magnitude. A sub-batch may use a total
+    cost of `free_memory * memory_fraction / bytes_per_arc`.
+
+    `fan_out` is calibrated from the arc counts of the results: it follows
+    the largest ratio of output to input arcs seen recently, and it is
+    doubled after a CUDA OOM error before the sub-batch is retried.
+
+    The ratio depends on the FSAs being intersected, so each call site
+    should have its own instance. One instance keeps what it learned
+    across calls, so it adapts to the lattices of a test set within the
+    first batch.
+    '''
+
+    def __init__(self,
+                 fan_out: float = 8.0,
+                 max_cost: Optional[float] = None,
+                 bytes_per_arc: float = 64.0,
+                 memory_fraction: float = 0.5,
+                 decay: float = 0.9):
+        '''
+        Args:
+          fan_out:
+            The initial estimate of the number of output arcs per arc of
+            `b_fsas`.
+          max_cost:
+            If not None, the budget, in output arcs, of a sub-batch.
+            Otherwise, it is derived from the free memory of the device.
+            On CPU, if it is None, no splitting is done.
+          bytes_per_arc:
+            Estimated device memory used per output arc.
+          memory_fraction:
+            The fraction of the free device memory that may be used.
+          decay:
+            A value in (0, 1). When the observed ratio is lower than
+            `fan_out`, `fan_out` moves towards it by a factor `1 - decay`,
+            so that a single large output keeps the estimate high for a
+            while.
+        '''
+        assert fan_out > 0
+        assert 0 < decay < 1
+        self.fan_out = fan_out
+        self.max_cost = max_cost
+        self.bytes_per_arc = bytes_per_arc
+        self.memory_fraction = memory_fraction
+        self.decay = decay
+
+    def budget(self, device: torch.device) -> float:
+        if self.max_cost is not None:
+            return self.max_cost
+        if device.type == 'cuda':
+            # torch.cuda.mem_get_info() is not available in torch 1.8.
+            # Memory reserved by the caching allocator can be reused,
+            # so only count what is allocated.
+            free = (torch.cuda.get_device_properties(device).total_memory -
+                    torch.cuda.memory_allocated(device))
+            return free * self.memory_fraction / self.bytes_per_arc
+        return math.inf
+
+    def costs(self, b_arcs: torch.Tensor) -> List[float]:
+        '''Return the estimated cost of each FSA given its number of arcs.'''
+        return (b_arcs.to(torch.float64) * self.fan_out).tolist()
+
+    def on_success(self, num_input_arcs: int, num_output_arcs: int) -> None:
+        if num_input_arcs <= 0:
+            return
+        ratio = num_output_arcs / num_input_arcs
+        if ratio >= self.fan_out:
+            self.fan_out = ratio
+        else:
+            self.fan_out = self.decay * self.fan_out + (1 - self.decay) * ratio
+
+    def on_oom(self) -> None:
+        self.fan_out *= 2
+        logging.info(f'CUDA OOM in intersection; retrying with fan_out '
+                     f'{self.fan_out:.3g}')
+
+
+# The default number of arcs above which a lattice is pruned before
+# rescoring it with the whole lattice.
+DEFAULT_MAX_ARCS_PER_SEQ = 100000
+
+# One sizer per call site, since the fan-out of the intersection differs
+# between them.
+_am_scores_batch_sizer = IntersectBatchSizer()
+_lm_scores_batch_sizer = IntersectBatchSizer()
+_whole_lattice_batch_sizer = IntersectBatchSizer()
+
+
+def _is_oom(e: RuntimeError) -> bool:
+    return 'out of memory' in str(e)
+
+
+def _intersect_device(a_fsas: k2.Fsa,
+                      b_fsas: k2.Fsa,
+                      b_to_a_map: torch.Tensor,
+                      sorted_match_a: bool,
+                      batch_sizer: IntersectBatchSizer):
     '''This is a wrapper of k2.intersect_device and its purpose is to split
     b_fsas into several batches and process each batch separately to avoid
     CUDA OOM error.
 
-    The arguments and return value of this function are the same as
-    k2.intersect_device.
+    The sub-batches are sized by `batch_sizer` from the number of arcs of
+    `b_fsas` and the free device memory.
+
+    The other arguments and the return value of this function are the same
+    as k2.intersect_device.
     '''
-    # NOTE: You can decrease batch_size in case of CUDA out of memory error.
-    batch_size = 500
     num_fsas = b_fsas.shape[0]
-    if num_fsas <= batch_size:
+    if num_fsas == 0:
         return k2.intersect_device(a_fsas,
                                    b_fsas,
                                    b_to_a_map=b_to_a_map,
                                    sorted_match_a=sorted_match_a)
 
-    num_batches = int(math.ceil(float(num_fsas) / batch_size))
-    splits = []
-    for i in range(num_batches):
-        start = i * batch_size
-        end = min(start + batch_size, num_fsas)
-        splits.append((start, end))
+    b_arcs = get_num_arcs_per_fsa(b_fsas).cpu()
 
     ans = []
-    for start, end in splits:
-        indexes = torch.arange(start, end).to(b_to_a_map)
-
-        fsas = k2.index(b_fsas, indexes)
-        b_to_a = k2.index(b_to_a_map, indexes)
-        path_lats = k2.intersect_device(a_fsas,
-                                        fsas,
-                                        b_to_a_map=b_to_a,
-                                        sorted_match_a=sorted_match_a)
+    start = 0
+    while start < num_fsas:
+        splits = split_into_sub_batches(batch_sizer.costs(b_arcs[start:]),
+                                        batch_sizer.budget(a_fsas.device))
+        end = start + splits[1]
+        if start == 0 and end == num_fsas:
+            fsas = b_fsas
+            b_to_a = b_to_a_map
+        else:
+            fsas = k2.index_fsa(
+                b_fsas,
+                torch.arange(start, end, dtype=torch.int32,
+                             device=b_to_a_map.device))
+            b_to_a = b_to_a_map[start:end]
+        try:
+            path_lats = k2.intersect_device(a_fsas,
+                                            fsas,
+                                            b_to_a_map=b_to_a,
+                                            sorted_match_a=sorted_match_a)
+        except RuntimeError as e:
+            if not _is_oom(e) or end - start == 1:
+                raise
+            del fsas, b_to_a
+            torch.cuda.empty_cache()
+            batch_sizer.on_oom()
+            continue
+        batch_sizer.on_success(int(b_arcs[start:end].sum()),
+                               path_lats.arcs.num_elements())
         ans.append(path_lats)
+        start = end
 
+    if len(ans) == 1:
+        return ans[0]
     return k2.cat(ans)
 
 
+class LatticePruningStats(object):
+    '''Accumulates statistics of :func:`prune_to_arc_budget` over the
+    batches of a test set.'''
+
+    def __init__(self):
+        self.num_seqs = 0
+        self.num_pruned_seqs = 0
+        self.num_over_budget_seqs = 0
+        self.num_arcs_before = 0
+        self.num_arcs_after = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            'num_seqs': self.num_seqs,
+            'num_pruned_seqs': self.num_pruned_seqs,
+            'num_over_budget_seqs': self.num_over_budget_seqs,
+            'num_arcs_before': self.num_arcs_before,
+            'num_arcs_after': self.num_arcs_after,
+        }
+
+    def __str__(self) -> str:
+        ratio = self.num_arcs_after / max(self.num_arcs_before, 1)
+        return (f'pruned {self.num_pruned_seqs}/{self.num_seqs} lattices, '
+                f'{self.num_over_budget_seqs} still over budget; '
+                f'num_arcs {self.num_arcs_before} -> {self.num_arcs_after} '
+                f'({ratio:.2%})')
+
+
+def prune_to_arc_budget(lats: k2.Fsa,
+                        max_arcs_per_seq: int,
+                        thresholds: Sequence[float] = (1e-5, 1e-4, 1e-3, 1e-2,
+                                                   5e-2),
+                        stats: Optional[LatticePruningStats] = None
+                       ) -> k2.Fsa:
+    '''Prune the lattices that have more than `max_arcs_per_seq` arcs.
+
+    Each lattice over the budget is pruned with `k2.prune_on_arc_post`
+    using the thresholds in `thresholds` in turn, stopping as soon as it
+    fits. Lattices within the budget are not modified.
+
+    Args:
+      lats:
+        An FsaVec.
+      max_arcs_per_seq:
+        The maximum number of arcs of each lattice.
+      thresholds:
+        The arc posterior thresholds to try, in increasing order.
+      stats:
+        If not None, it is updated with the statistics of this call.
+    Returns:
+      Return an FsaVec with the same number of FSAs as `lats`, in
+      the same order.
+    '''
+    assert len(lats.shape) == 3
+    num_arcs = get_num_arcs_per_fsa(lats)
+    num_arcs_before = num_arcs.sum().item()
+    pruned = torch.zeros_like(num_arcs, dtype=torch.bool)
+
+    for threshold in thresholds:
+        over = num_arcs > max_arcs_per_seq
+        if not over.any():
+            break
+        pruned |= over
+        over_indexes = torch.nonzero(over).squeeze(1)
+        keep_indexes = torch.nonzero(~over).squeeze(1)
+        over_lats = k2.prune_on_arc_post(
+            k2.index_fsa(lats, over_indexes.to(torch.int32)), threshold,
+            True)
+        if keep_indexes.numel() == 0:
+            lats = over_lats
+        else:
+            keep_lats = k2.index_fsa(lats, keep_indexes.to(torch.int32))
+            # Restore the original order of the lattices.
+            new2old = torch.cat([keep_indexes, over_indexes])
+            lats = k2.index_fsa(
+                k2.cat([keep_lats, over_lats]),
+                invert_permutation(new2old).to(torch.int32))
+        num_arcs = get_num_arcs_per_fsa(lats)
+
+    num_over_budget = (num_arcs > max_arcs_per_seq).sum().item()
+    if num_over_budget > 0:
+        logging.warning(f'{num_over_budget} lattices still have more than '
+                        f'{max_arcs_per_seq} arcs after pruning with '
+                        f'threshold {thresholds[-1]}')
+
+    if stats is not None:
+        stats.num_seqs += lats.shape[0]
+        stats.num_pruned_seqs += pruned.sum().item()
+        stats.num_over_budget_seqs += num_over_budget
+        stats.num_arcs_before += num_arcs_before
+        stats.num_arcs_after += num_arcs.sum().item()
+    return lats
+
+
 def compute_am_scores(lats: k2.Fsa, word_fsas_with_epsilon_loops: k2.Fsa,
                       path_to_seq_map: torch.Tensor) -> torch.Tensor:
     '''Compute AM scores of n-best lists (represented as word_fsas).
@@ -57,7 +279,8 @@ def compute_am_scores(lats: k2.Fsa, word_fsas_with_epsilon_loops: k2.Fsa,
     Args:
       lats:
         An FsaVec, which is the output of `k2.intersect_dense_pruned`.
-        It must have the attribute `lm_scores`.
+        If it has the attribute `lm_scores`, it is subtracted from the
+        scores; otherwise, its scores are taken to be AM scores.
       word_fsas_with_epsilon_loops:
         An FsaVec representing a n-best list. Note that it has been processed
         by `k2.add_epsilon_self_loops`.
@@ -71,7 +294,6 @@ def compute_am_scores(lats: k2.Fsa, word_fsas_with_epsilon_loops: k2.Fsa,
     '''
     device = lats.device
     assert len(lats.shape) == 3
-    assert hasattr(lats, 'lm_scores')
 
     # k2.compose() currently does not support b_to_a_map. To void
     # replicating `lats`, we use k2.intersect_device here.
@@ -91,21 +313,124 @@ def compute_am_scores(lats: k2.Fsa, word_fsas_with_epsilon_loops: k2.Fsa,
     am_path_lats = _intersect_device(inverted_lats,
                                      word_fsas_with_epsilon_loops,
                                      b_to_a_map=path_to_seq_map,
-                                     sorted_match_a=True)
+                                     sorted_match_a=True,
+                                     batch_sizer=_am_scores_batch_sizer)
 
     am_path_lats = k2.top_sort(k2.connect(am_path_lats))
 
-    # The `scores` of every arc consists of `am_scores` and `lm_scores`
-    am_path_lats.scores = am_path_lats.scores - am_path_lats.lm_scores
+    if hasattr(am_path_lats, 'lm_scores'):
+        # The `scores` of every arc consists of `am_scores` and `lm_scores`
+        am_path_lats.scores = am_path_lats.scores - am_path_lats.lm_scores
 
     am_scores = am_path_lats.get_tot_scores(True, True)
 
     return am_scores
 
 
+def compute_lm_scores(G: k2.Fsa,
+                      word_fsas_with_epsilon_loops: k2.Fsa) -> torch.Tensor:
+    '''Compute LM scores of n-best lists (represented as word_fsas).
+
+    Args:
+      G:
+        An FsaVec representing the language model (LM). Note that it
+        is an FsaVec, but it contains only one Fsa.
+      word_fsas_with_epsilon_loops:
+        An FsaVec representing a n-best list. Note that it has been processed
+        by `k2.add_epsilon_self_loops`.
+    Returns:
+      Return a 1-D torch.Tensor containing the LM scores of each path.
+      `ans.numel() == word_fsas_with_epsilon_loops.shape[0]`
+    '''
+    num_paths = word_fsas_with_epsilon_loops.shape[0]
+    b_to_a_map = torch.zeros(num_paths,
+                             dtype=torch.int32,
+                             device=word_fsas_with_epsilon_loops.device)
+    lm_path_lats = _intersect_device(G,
+                                     word_fsas_with_epsilon_loops,
+                                     b_to_a_map=b_to_a_map,
+                                     sorted_match_a=True,
+                                     batch_sizer=_lm_scores_batch_sizer)
+    lm_path_lats = k2.top_sort(k2.connect(lm_path_lats))
+    return lm_path_lats.get_tot_scores(use_double_scores=True,
+                                       log_semiring=False)
+
+
+def _sweep_lm_scales(lats: k2.Fsa,
+                     lm_scale_list: List[float],
+                     max_arcs: int = 20000000) -> Dict[str, k2.Fsa]:
+    '''Find the best path of each lattice with each lm_scale.
+
+    Instead of running `k2.shortest_path` once for each lm_scale, the
+    lattices are replicated once per lm_scale into a single FsaVec whose
+    arc scores are computed in one go, and `k2.shortest_path` is run once
+    on it. If the replicated FsaVec would have more than `max_arcs` arcs,
+    the lm_scales are processed in chunks.
+
+    Args:
+      lats:
+        An FsaVec with attribute `lm_scores`. Its `scores` contain
+        the AM scores plus `lm_scores`.
+      lm_scale_list:
+        A list containing lm_scale values.
+      max_arcs:
+        The maximum number of arcs of the replicated FsaVec.
+    Returns:
+      A dict of FsaVec, whose key is a lm_scale and the value represents the
+      best decoding path for each sequence in the lattice.
+    '''
+    device = lats.device
+    num_seqs = lats.shape[0]
+    num_arcs = lats.scores.numel()
+    chunk_size = max(1, max_arcs // max(num_arcs, 1))
+
+    #
+    # The following implements
+    # scores = (scores - lm_scores)/lm_scale + lm_scores
+    #        = scores/lm_scale + lm_scores*(1 - 1/lm_scale)
+    #
+    saved_am_scores = lats.scores - lats.lm_scores
+    lm_scores = lats.lm_scores
+
+    ans = dict()
+    for start in range(0, len(lm_scale_list), chunk_size):
+        lm_scales = lm_scale_list[start:start + chunk_size]
+        num_scales = len(lm_scales)
+        if num_scales == 1:
+            replicated = lats
+        else:
+            # The FSAs of the replicated FsaVec are ordered by lm_scale,
+            # so its arcs are `num_scales` copies of the arcs of `lats`.
+            indexes = torch.arange(num_seqs, dtype=torch.int32,
+                                   device=device).repeat(num_scales)
+            replicated = k2.index_fsa(lats, indexes)
+
+        scales = torch.tensor(lm_scales,
+                              dtype=saved_am_scores.dtype,
+                              device=device).unsqueeze(1)
+        replicated.scores = (saved_am_scores.unsqueeze(0) / scales +
+                             lm_scores).reshape(-1)
+
+        best_paths = k2.shortest_path(replicated, use_double_scores=True)
+        for i, lm_scale in enumerate(lm_scales):
+            key = f'lm_scale_{lm_scale}'
+            if num_scales == 1:
+                ans[key] = best_paths
+            else:
+                ans[key] = k2.index_fsa(
+                    best_paths,
+                    torch.arange(i * num_seqs, (i + 1) * num_seqs,
+                                 dtype=torch.int32,
+                                 device=device))
+    return ans
+
+
 @torch.no_grad()
-def rescore_with_n_best_list(lats: k2.Fsa, G: k2.Fsa, num_paths: int,
-                             lm_scale_list: List[float]) -> Dict[str, k2.Fsa]:
+def rescore_with_n_best_list(lats: k2.Fsa,
+                             G: k2.Fsa,
+                             num_paths: int,
+                             lm_scale_list: List[float],
+                             use_top_k: bool = False) -> Dict[str, k2.Fsa]:
     '''Decode using n-best list with LM rescoring.
 
     `lats` is a decoding lattice, which has 3 axes. This function first
@@ -116,6 +441,11 @@ def rescore_with_n_best_list(lats: k2.Fsa, G: k2.Fsa, num_paths: int,
     The path with the greatest `tot_scores` within a sequence is used
     as the decoding output.
 
+    If `use_top_k` is True, the paths are instead the `num_paths` best
+    distinct word sequences of each lattice, obtained with
+    :func:`snowfall.decoding.nbest.get_top_k_word_seqs`, so the result
+    is deterministic.
+
     Args:
       lats:
         An FsaVec. It can be the output of `k2.intersect_dense_pruned`.
@@ -126,6 +456,10 @@ def rescore_with_n_best_list(lats: k2.Fsa, G: k2.Fsa, num_paths: int,
         It is the size `n` in `n-best` list.
       lm_scale_list:
         A list containing lm_scale values.
+      use_top_k:
+        If True, use the top-k distinct word sequences instead of
+        random paths. The returned best paths then have word IDs as
+        both labels and aux_labels.
     Returns:
       A dict of FsaVec, whose key is a lm_scale and the value represents the
       best decoding path for each sequence in the lattice.
@@ -140,111 +474,37 @@ def rescore_with_n_best_list(lats: k2.Fsa, G: k2.Fsa, num_paths: int,
     assert G.device == device
     assert hasattr(G, 'aux_labels') is False
 
-    # First, extract `num_paths` paths for each sequence.
-    # paths is a k2.RaggedInt with axes [seq][path][arc_pos]
-    paths = k2.random_paths(lats, num_paths=num_paths, use_double_scores=True)
-
-    # word_seqs is a k2.RaggedInt sharing the same shape as `paths`
-    # but it contains word IDs. Note that it also contains 0s and -1s.
-    # The last entry in each sublist is -1.
-    word_seqs = k2.index(lats.aux_labels, paths)
+    nbest = Nbest.from_lattice(lats, num_paths, use_top_k=use_top_k)
 
-    # Remove epsilons and -1 from word_seqs
-    word_seqs = k2.ragged.remove_values_leq(word_seqs, 0)
-
-    # Remove repeated sequences to avoid redundant computation later.
-    #
-    # unique_word_seqs is still a k2.RaggedInt with 3 axes [seq][path][word]
-    # except that there are no repeated paths with the same word_seq
-    # within a seq.
-    #
-    # num_repeats is also a k2.RaggedInt with 2 axes containing the
-    # multiplicities of each path.
-    # num_repeats.num_elements() == unique_word_seqs.num_elements()
-    #
-    # Since k2.ragged.unique_sequences will reorder paths within a seq,
-    # `new2old` is a 1-D torch.Tensor mapping from the output path index
-    # to the input path index.
-    # new2old.numel() == unique_word_seqs.num_elements()
-    unique_word_seqs, num_repeats, new2old = k2.ragged.unique_sequences(
-        word_seqs, need_num_repeats=True, need_new2old_indexes=True)
-
-    seq_to_path_shape = k2.ragged.get_layer(unique_word_seqs.shape(), 0)
-
-    # path_to_seq_map is a 1-D torch.Tensor.
-    # path_to_seq_map[i] is the seq to which the i-th path
-    # belongs.
-    path_to_seq_map = seq_to_path_shape.row_ids(1)
-
-    # Remove the seq axis.
-    # Now unique_word_seqs has only two axes [path][word]
-    unique_word_seqs = k2.ragged.remove_axis(unique_word_seqs, 0)
-
-    # word_fsas is an FsaVec with axes [path][state][arc]
-    word_fsas = k2.linear_fsa(unique_word_seqs)
-
-    word_fsas_with_epsilon_loops = k2.add_epsilon_self_loops(word_fsas)
+    word_fsas_with_epsilon_loops = nbest.word_fsas_with_epsilon_loops()
 
     am_scores = compute_am_scores(lats, word_fsas_with_epsilon_loops,
-                                  path_to_seq_map)
-
-    # Now compute lm_scores
-    b_to_a_map = torch.zeros_like(path_to_seq_map)
-    lm_path_lats = _intersect_device(G,
-                                     word_fsas_with_epsilon_loops,
-                                     b_to_a_map=b_to_a_map,
-                                     sorted_match_a=True)
-    lm_path_lats = k2.top_sort(k2.connect(lm_path_lats))
-    lm_scores = lm_path_lats.get_tot_scores(use_double_scores=True, log_semiring=False)
-
-    ans = dict()
-    for lm_scale in lm_scale_list:
-        tot_scores = am_scores / lm_scale + lm_scores
-
-        # Remember that we used `k2.ragged.unique_sequences` to remove repeated
-        # paths to avoid redundant computation in `k2.intersect_device`.
-        # Now we use `num_repeats` to correct the scores for each path.
-        #
-        # NOTE(fangjun): It is commented out as it leads to a worse WER
-        # tot_scores = tot_scores * num_repeats.values()
-
-        # TODO(fangjun): We may need to add `k2.RaggedDouble`
-        ragged_tot_scores = k2.RaggedFloat(seq_to_path_shape,
-                                           tot_scores.to(torch.float32))
-        argmax_indexes = k2.ragged.argmax_per_sublist(ragged_tot_scores)
-
-        # Use k2.index here since argmax_indexes' dtype is torch.int32
-        best_path_indexes = k2.index(new2old, argmax_indexes)
-
-        paths_2axes = k2.ragged.remove_axis(paths, 0)
-
-        # best_path is a k2.RaggedInt with 2 axes [path][arc_pos]
-        best_paths = k2.index(paths_2axes, best_path_indexes)
-
-        # labels is a k2.RaggedInt with 2 axes [path][phone_id]
-        # Note that it contains -1s.
-        labels = k2.index(lats.labels.contiguous(), best_paths)
-
-        labels = k2.ragged.remove_values_eq(labels, -1)
+                                  nbest.path_to_seq_map)
 
-        # lats.aux_labels is a k2.RaggedInt tensor with 2 axes, so
-        # aux_labels is also a k2.RaggedInt with 2 axes
-        aux_labels = k2.index(lats.aux_labels, best_paths.values())
+    lm_scores = compute_lm_scores(G, word_fsas_with_epsilon_loops)
 
-        best_path_fsas = k2.linear_fsa(labels)
-        best_path_fsas.aux_labels = aux_labels
-
-        key = f'lm_scale_{lm_scale}'
-        ans[key] = best_path_fsas
-
-    return ans
+    # tot_scores[i][j] is the total score of the j-th path with
+    # the i-th lm_scale.
+    #
+    # NOTE(fangjun): Scaling the scores by the number of times each path
+    # was sampled leads to a worse WER, so it is not done.
+    lm_scales = torch.tensor(lm_scale_list,
+                             dtype=am_scores.dtype,
+                             device=device)
+    tot_scores = am_scores.unsqueeze(0) / lm_scales.unsqueeze(1) + lm_scores
 
+    keys = [f'lm_scale_{lm_scale}' for lm_scale in lm_scale_list]
+    return nbest.select_best_paths(lats, tot_scores, keys)
 
 
 @torch.no_grad()
-def rescore_with_whole_lattice(lats: k2.Fsa, G_with_epsilon_loops: k2.Fsa,
-                               lm_scale_list: List[float]
-                              ) -> Dict[str, k2.Fsa]:
+def rescore_with_whole_lattice(
+        lats: k2.Fsa,
+        G_with_epsilon_loops: k2.Fsa,
+        lm_scale_list: List[float],
+        max_arcs_per_seq: Optional[int] = DEFAULT_MAX_ARCS_PER_SEQ,
+        pruning_stats: Optional[LatticePruningStats] = None
+) -> Dict[str, k2.Fsa]:
     '''Use whole lattice to rescore.
 
     Args:
@@ -255,6 +515,16 @@ def rescore_with_whole_lattice(lats: k2.Fsa, G_with_epsilon_loops: k2.Fsa,
         is an FsaVec, but it contains only one Fsa.
       lm_scale_list:
         A list containing lm_scale values.
+      max_arcs_per_seq:
+        If not None, each lattice with more arcs than this is pruned with
+        :func:`prune_to_arc_budget` before the intersection.
+        If None, the lattices are not pruned.
+        In both cases, the intersection is split into sub-batches only if
+        the lattices, times the number of rescored arcs per lattice arc
+        seen so far, do not fit in the free device memory.
+      pruning_stats:
+        If not None and `max_arcs_per_seq` is not None, it is updated with
+        the pruning statistics of this batch.
     Returns:
       A dict of FsaVec, whose key is a lm_scale and the value represents the
       best decoding path for each sequence in the lattice.
@@ -278,25 +548,18 @@ def rescore_with_whole_lattice(lats: k2.Fsa, G_with_epsilon_loops: k2.Fsa,
     num_seqs = lats.shape[0]
 
     b_to_a_map = torch.zeros(num_seqs, device=device, dtype=torch.int32)
-    try:
-        rescoring_lats = k2.intersect_device(G_with_epsilon_loops,
-                                             inverted_lats,
-                                             b_to_a_map,
-                                             sorted_match_a=True)
-    except RuntimeError as e:
-        print(f'Caught exception:\n{e}\n')
-        print(f'Number of FSAs: {inverted_lats.shape[0]}')
-        print('num_arcs before pruning: ', inverted_lats.arcs.num_elements())
-
-        # NOTE(fangjun): The choice of the threshold 0.01 is arbitrary here
-        # to avoid OOM. We may need to fine tune it.
-        inverted_lats = k2.prune_on_arc_post(inverted_lats, 0.001, True)
-        print('num_arcs after pruning: ', inverted_lats.arcs.num_elements())
-
-        rescoring_lats = k2.intersect_device(G_with_epsilon_loops,
-                                             inverted_lats,
-                                             b_to_a_map,
-                                             sorted_match_a=True)
+    if max_arcs_per_seq is not None:
+        inverted_lats = prune_to_arc_budget(inverted_lats,
+                                            max_arcs_per_seq,
+                                            stats=pruning_stats)
+    # The sub-batches are sized from the arc counts of the lattices.
+    # The pruning bounds them, and thus the size of the rescored
+    # lattices, so usually the whole batch fits.
+    rescoring_lats = _intersect_device(G_with_epsilon_loops,
+                                       inverted_lats,
+                                       b_to_a_map,
+                                       sorted_match_a=True,
+                                       batch_sizer=_whole_lattice_batch_sizer)
 
     rescoring_lats = k2.top_sort(k2.connect(rescoring_lats))
 
@@ -304,18 +567,4 @@ def rescore_with_whole_lattice(lats: k2.Fsa, G_with_epsilon_loops: k2.Fsa,
     # and word IDs as aux_labels.
     inv_lats = k2.invert(rescoring_lats)
 
-    ans = dict()
-    #
-    # The following implements
-    # scores = (scores - lm_scores)/lm_scale + lm_scores
-    #        = scores/lm_scale + lm_scores*(1 - 1/lm_scale)
-    #
-    saved_am_scores = inv_lats.scores - inv_lats.lm_scores
-    for lm_scale in lm_scale_list:
-        am_scores = saved_am_scores / lm_scale
-        inv_lats.scores = am_scores + inv_lats.lm_scores
-
-        best_paths = k2.shortest_path(inv_lats, use_double_scores=True)
-        key = f'lm_scale_{lm_scale}'
-        ans[key] = best_paths
-    return ans
+    return _sweep_lm_scales(inv_lats, lm_scale_list)
@@ -0,0 +1,382 @@
+import heapq
+import itertools
+from typing import Dict, List, Optional
+
+import k2
+import torch
+
+
+def _word_acceptors(lats: k2.Fsa) -> k2.Fsa:
+    '''Convert lattices to deterministic acceptors over word IDs.
+
+    Each word sequence of `lats` corresponds to exactly one path of the
+    returned FsaVec, whose score is the best score of the word sequence
+    in `lats` (in the tropical semiring). The returned FsaVec is on CPU,
+    connected and top-sorted.
+    '''
+    # lats has phone IDs as labels and word IDs as aux_labels.
+    # After inversion, the labels are word IDs.
+    word_lats = k2.invert(lats.to('cpu'))
+    # Drop all attributes; only labels and scores are needed.
+    word_lats = k2.Fsa(word_lats.arcs)
+    word_lats = k2.connect(word_lats)
+    word_lats = k2.remove_epsilon(word_lats)
+    word_lats = k2.determinize(word_lats)
+    return k2.top_sort(k2.connect(word_lats))
+
+
+def _top_k_paths(arc_begin: List[int], dest: List[int], labels: List[int],
+                 scores: List[float], backward: List[float], k: int
+                ) -> List[List[int]]:
+    '''Return the labels of the `k` best paths of a single deterministic
+    acceptor, best first.
+
+    It is an A* search from the start state, using the backward scores,
+    which are the exact best scores to the final state, as the heuristic.
+    So complete paths are popped in decreasing order of score. Ties are
+    broken by insertion order, which makes the result deterministic.
+    '''
+    num_states = len(arc_begin) - 1
+    if num_states == 0:
+        return []
+    final_state = num_states - 1
+    counter = itertools.count()
+    # Each entry is (-estimated_total_score, tie_breaker, state,
+    # score_so_far, words), where words is a linked list (word, words)
+    # of the labels so far in reverse order.
+    queue = [(-backward[0], next(counter), 0, 0.0, None)]
+    ans = []
+    while queue and len(ans) < k:
+        _, _, state, score, words = heapq.heappop(queue)
+        if state == final_state:
+            path = []
+            while words is not None:
+                path.append(words[0])
+                words = words[1]
+            ans.append(path[::-1])
+            continue
+        for a in range(arc_begin[state], arc_begin[state + 1]):
+            next_state = dest[a]
+            next_score = score + scores[a]
+            next_words = words if labels[a] == -1 else (labels[a], words)
+            heapq.heappush(queue, (-(next_score + backward[next_state]),
+                                   next(counter), next_state, next_score,
+                                   next_words))
+    return ans
+
+
+@torch.no_grad()
+def get_top_k_word_seqs(lats: k2.Fsa, num_paths: int) -> k2.RaggedInt:
+    '''Return up to `num_paths` distinct word sequences of each lattice,
+    in decreasing order of their best path score.
+
+    Unlike `k2.random_paths` followed by `k2.ragged.unique_sequences`,
+    the result contains no duplicates, does not depend on random
+    sampling and is ordered by score.
+
+    Args:
+      lats:
+        An FsaVec, e.g., the output of `k2.intersect_dense_pruned`.
+        Its `aux_labels` contain word IDs.
+      num_paths:
+        The maximum number of word sequences per lattice.
+    Returns:
+      Return a k2.RaggedInt with 3 axes [seq][path][word] on the device
+      of `lats`. It contains no 0s or -1s.
+    '''
+    assert len(lats.shape) == 3
+    assert hasattr(lats, 'aux_labels')
+    device = lats.device
+
+    word_lats = _word_acceptors(lats)
+    backward = word_lats.get_backward_scores(use_double_scores=True,
+                                             log_semiring=False).tolist()
+    arcs = word_lats.arcs.values()[:, :3].tolist()
+    scores = word_lats.scores.tolist()
+    shape = word_lats.arcs.shape()
+    state_splits = shape.row_splits(1).tolist()
+    arc_splits = shape.row_splits(2).tolist()
+
+    seq_splits = [0]
+    path_splits = [0]
+    words = []
+    for i in range(len(state_splits) - 1):
+        state_begin, state_end = state_splits[i], state_splits[i + 1]
+        arc_begin = arc_splits[state_begin:state_end + 1]
+        arc_offset = arc_begin[0]
+        fsa_arcs = arcs[arc_offset:arc_begin[-1]]
+        paths = _top_k_paths(
+            arc_begin=[a - arc_offset for a in arc_begin],
+            dest=[arc[1] for arc in fsa_arcs],
+            labels=[arc[2] for arc in fsa_arcs],
+            scores=scores[arc_offset:arc_begin[-1]],
+            backward=backward[state_begin:state_end],
+            k=num_paths)
+        for path in paths:
+            words.extend(path)
+            path_splits.append(len(words))
+        seq_splits.append(len(path_splits) - 1)
+
+    def to_tensor(values: List[int]) -> torch.Tensor:
+        return torch.tensor(values, dtype=torch.int32, device=device)
+
+    seq_to_path = k2.ragged.create_ragged_shape2(to_tensor(seq_splits),
+                                                 None,
+                                                 len(path_splits) - 1)
+    path_to_word = k2.ragged.create_ragged_shape2(to_tensor(path_splits),
+                                                  None, len(words))
+    return k2.RaggedInt(
+        k2.ragged.compose_ragged_shapes(seq_to_path, path_to_word),
+        to_tensor(words))
+
+
+def word_seqs_to_fsas(word_seqs: k2.RaggedInt) -> k2.Fsa:
+    '''Build linear FSAs from word sequences, e.g., the best paths selected
+    from the output of :func:`get_top_k_word_seqs`.
+
+    Args:
+      word_seqs:
+        A k2.RaggedInt with 2 axes [path][word].
+    Returns:
+      Return an FsaVec whose labels and aux_labels are word IDs, so that
+      it can be passed to :func:`snowfall.common.get_texts`.
+    '''
+    fsas = k2.linear_fsa(word_seqs)
+    fsas.aux_labels = fsas.labels.clone()
+    return fsas
+
+
+class Nbest(object):
+    '''An n-best list of distinct word sequences for each lattice of a
+    batch.
+
+    It is the common input of the n-best rescoring methods, which compute
+    one or more scores for each path and then select the best path of
+    each sequence with :meth:`argmax`.
+    '''
+
+    def __init__(self,
+                 word_seqs: k2.RaggedInt,
+                 paths: Optional[k2.RaggedInt] = None,
+                 new2old: Optional[torch.Tensor] = None):
+        '''
+        Args:
+          word_seqs:
+            A k2.RaggedInt with 3 axes [seq][path][word]. The paths of a
+            seq must be distinct.
+          paths:
+            If not None, a k2.RaggedInt with 3 axes [seq][path][arc_pos]
+            containing the arc indexes in the lattices of the sampled paths.
+          new2old:
+            Required if `paths` is not None. It maps the index of a path in
+            `word_seqs` to the index of a path in `paths`.
+        '''
+        assert (paths is None) == (new2old is None)
+        # seq_to_path_shape has 2 axes [seq][path]
+        self.seq_to_path_shape = k2.ragged.get_layer(word_seqs.shape(), 0)
+        # path_to_seq_map[i] is the seq to which the i-th path belongs.
+        self.path_to_seq_map = self.seq_to_path_shape.row_ids(1)
+        # word_seqs has 2 axes [path][word]
+        self.word_seqs = k2.ragged.remove_axis(word_seqs, 0)
+        self.paths = paths
+        self.new2old = new2old
+
+    @staticmethod
+    def from_lattice(lats: k2.Fsa,
+                     num_paths: int,
+                     use_top_k: bool = False) -> 'Nbest':
+        '''Extract an n-best list from lattices.
+
+        Args:
+          lats:
+            An FsaVec with word IDs as aux_labels, e.g., the output of
+            `k2.intersect_dense_pruned`.
+          num_paths:
+            The number of paths to sample if `use_top_k` is False;
+            otherwise the maximum number of paths per lattice.
+          use_top_k:
+            If True, use :func:`get_top_k_word_seqs`. Otherwise, sample
+            paths with `k2.random_paths` and remove duplicates.
+        '''
+        if use_top_k:
+            return Nbest(get_top_k_word_seqs(lats, num_paths))
+
+        # First, extract `num_paths` paths for each sequence.
+        # paths is a k2.RaggedInt with axes [seq][path][arc_pos]
+        paths = k2.random_paths(lats,
+                                num_paths=num_paths,
+                                use_double_scores=True)
+
+        # word_seqs is a k2.RaggedInt sharing the same shape as `paths`
+        # but it contains word IDs. Note that it also contains 0s and -1s.
+        # The last entry in each sublist is -1.
+        word_seqs = k2.index(lats.aux_labels, paths)
+
+        # Remove epsilons and -1 from word_seqs
+        word_seqs = k2.ragged.remove_values_leq(word_seqs, 0)
+
+        # Remove repeated sequences to avoid redundant computation later.
+        #
+        # Since k2.ragged.unique_sequences will reorder paths within a seq,
+        # `new2old` is a 1-D torch.Tensor mapping from the output path index
+        # to the input path index.
+        unique_word_seqs, _, new2old = k2.ragged.unique_sequences(
+            word_seqs, need_num_repeats=False, need_new2old_indexes=True)
+        return Nbest(unique_word_seqs, paths, new2old)
+
+    @property
+    def num_paths(self) -> int:
+        return self.path_to_seq_map.numel()
+
+    def word_fsas_with_epsilon_loops(self) -> k2.Fsa:
+        '''Return an FsaVec with axes [path][state][arc] containing
+        the word sequences, with epsilon self-loops added.'''
+        return k2.add_epsilon_self_loops(k2.linear_fsa(self.word_seqs))
+
+    def argmax(self, scores: torch.Tensor) -> torch.Tensor:
+        '''Batched version of `k2.ragged.argmax_per_sublist`.
+
+        Args:
+          scores:
+            A 2-D torch.Tensor of shape [num_rows, self.num_paths]. Each row
+            contains a score for every path, e.g., the total scores with
+            a given lm_scale.
+        Returns:
+          Return a 2-D torch.Tensor of dtype torch.int64 and shape
+          [num_rows, num_seqs] containing the index of the path with
+          the greatest score of each seq for each row, or -1 if the seq
+          has no path.
+        '''
+        row_splits = self.seq_to_path_shape.row_splits(1).to(torch.int64)
+        num_rows, num_paths = scores.shape
+        assert num_paths == self.num_paths
+        num_seqs = row_splits.numel() - 1
+        lengths = row_splits[1:] - row_splits[:-1]
+        if num_paths == 0:
+            return torch.full((num_rows, num_seqs), -1,
+                              dtype=torch.int64,
+                              device=scores.device)
+
+        path_to_seq = self.path_to_seq_map.to(torch.int64)
+        pos = torch.arange(num_paths,
+                           device=scores.device) - row_splits[path_to_seq]
+
+        padded = torch.full((num_rows, num_seqs, int(lengths.max().item())),
+                            float('-inf'),
+                            dtype=scores.dtype,
+                            device=scores.device)
+        padded[:, path_to_seq, pos] = scores
+        ans = padded.argmax(dim=-1) + row_splits[:-1]
+        return torch.where(lengths > 0, ans, torch.full_like(ans, -1))
+
+    def best_paths(self, lats: k2.Fsa, indexes: torch.Tensor) -> k2.Fsa:
+        '''Build the best paths selected by :meth:`argmax`.
+
+        Args:
+          lats:
+            The lattices from which this n-best list was extracted.
+          indexes:
+            A 1-D torch.Tensor containing path indexes, e.g., a row of the
+            return value of :meth:`argmax`.
+        Returns:
+          Return an FsaVec with one linear FSA per entry of `indexes`,
+          which can be passed to :func:`snowfall.common.get_texts`.
+        '''
+        indexes = indexes.to(torch.int32)
+        if self.paths is None:
+            return word_seqs_to_fsas(k2.index(self.word_seqs, indexes))
+
+        # Since we invoked `k2.ragged.unique_sequences`, which reorders
+        # the index from `paths`, we use `new2old`
+        # here to convert indexes to the indexes into `paths`.
+        #
+        # Use k2.index here since indexes' dtype is torch.int32
+        best_path_indexes = k2.index(self.new2old, indexes)
+
+        paths_2axes = k2.ragged.remove_axis(self.paths, 0)
+
+        # best_paths is a k2.RaggedInt with 2 axes [path][arc_pos]
+        best_paths = k2.index(paths_2axes, best_path_indexes)
+
+        # labels is a k2.RaggedInt with 2 axes [path][phone_id]
+        # Note that it contains -1s.
+        labels = k2.index(lats.labels.contiguous(), best_paths)
+
+        labels = k2.ragged.remove_values_eq(labels, -1)
+
+        # lats.aux_labels is a k2.RaggedInt tensor with 2 axes, so
+        # aux_labels is also a k2.RaggedInt with 2 axes
+        aux_labels = k2.index(lats.aux_labels, best_paths.values())
+
+        best_path_fsas = k2.linear_fsa(labels)
+        best_path_fsas.aux_labels = aux_labels
+        return best_path_fsas
+
+    def select_best_paths(self, lats: k2.Fsa, scores: torch.Tensor,
+                          keys: List[str]) -> Dict[str, k2.Fsa]:
+        '''Return the best path of each seq for each row of `scores`.
+
+        The best paths are built only once for each distinct path that is
+        selected, since different rows usually select the same path for
+        most seqs.
+
+        Args:
+          lats:
+            The lattices from which this n-best list was extracted.
+          scores:
+            A 2-D torch.Tensor of shape [len(keys), self.num_paths].
+          keys:
+            The keys of the returned dict, one for each row of `scores`.
+        Returns:
+          A dict of FsaVec, whose key is from `keys` and the value
+          represents the best decoding path for each sequence in the lattice.
+        '''
+        assert scores.shape[0] == len(keys)
+        argmax_indexes = self.argmax(scores)
+        selected, row_to_selected = torch.unique(argmax_indexes,
+                                                 return_inverse=True)
+        best_path_fsas = self.best_paths(lats, selected)
+        ans = dict()
+        for i, key in enumerate(keys):
+            ans[key] = k2.index_fsa(best_path_fsas,
+                                    row_to_selected[i].to(torch.int32))
+        return ans
+
+
+def nbest_decoding(lats: k2.Fsa,
+                   num_paths: int,
+                   use_top_k: bool = False) -> k2.Fsa:
+    '''
+    (Ideas of this function are from Dan)
+
+    It implements something like CTC prefix beam search using n-best lists
+
+    The basic idea is to first extra n-best paths from the given lattice,
+    build a word seqs from these paths, and compute the total scores
+    of these sequences in the log-semiring. The one with the max score
+    is used as the decoding output.
+
+    If `use_top_k` is True, the n-best paths are the `num_paths` best
+    distinct word sequences instead of random samples.
+    '''
+    nbest = Nbest.from_lattice(lats, num_paths, use_top_k=use_top_k)
+
+    word_fsas_with_epsilon_loops = nbest.word_fsas_with_epsilon_loops()
+
+    # lats has phone IDs as labels and word IDs as aux_labels.
+    # inv_lats has word IDs as labels and phone IDs as aux_labels
+    inv_lats = k2.invert(lats)
+    inv_lats = k2.arc_sort(inv_lats) # no-op if inv_lats is already arc-sorted
+
+    path_lats = k2.intersect_device(inv_lats,
+                                    word_fsas_with_epsilon_loops,
+                                    b_to_a_map=nbest.path_to_seq_map,
+                                    sorted_match_a=True)
+    # path_lats has word IDs as labels and phone IDs as aux_labels
+
+    path_lats = k2.top_sort(k2.connect(path_lats.to('cpu')).to(lats.device))
+
+    tot_scores = path_lats.get_tot_scores(True, True)
+
+    argmax_indexes = nbest.argmax(tot_scores.unsqueeze(0))[0]
+    return nbest.best_paths(lats, argmax_indexes)
@@ -0,0 +1,139 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+import torch
+
+
+def _record_stream(value: Any, stream: torch.cuda.Stream) -> None:
+    '''Mark the CUDA tensors in `value` as used on `stream`, so that the
+    caching allocator does not reuse their memory while `stream` may
+    still access it.'''
+    if isinstance(value, torch.Tensor):
+        if value.is_cuda:
+            value.record_stream(stream)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _record_stream(v, stream)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _record_stream(v, stream)
+
+
+class DecodingPipeline(object):
+    '''Overlaps the neural network forward pass of the next batch with the
+    FSA-based search of the current batch.
+
+    Decoding a batch is split into three stages:
+
+        - `forward(batch)` runs the neural network. On CUDA, it is
+          launched on a separate stream, one batch ahead of the search.
+          Since kernel launches are asynchronous, the GPU computes it
+          while the host is busy with the k2 search of the previous batch.
+        - `search(batch, forward_output)` runs the lattice search and
+          rescoring on the current stream, after waiting for the forward
+          pass of its batch.
+        - `postprocess(batch, search_output)`, if given, runs in a pool of
+          CPU threads, e.g., to convert word IDs to text and to score the
+          hypotheses. Its results are returned in the order of the batches.
+
+    Usage::
+
+        pipeline = DecodingPipeline(forward, search, postprocess, device)
+        for result in pipeline(dataloader):
+            ...
+    '''
+
+    def __init__(self,
+                 forward: Callable[[Any], Any],
+                 search: Callable[[Any, Any], Any],
+                 postprocess: Optional[Callable[[Any, Any], Any]] = None,
+                 device: Union[str, torch.device] = 'cpu',
+                 num_postprocess_workers: int = 1,
+                 max_pending_postprocess: int = 4):
+        '''
+        Args:
+          forward:
+            It takes a batch and returns the output of the neural network.
+            It must not synchronize with the host more than necessary,
+            otherwise there is nothing to overlap.
+          search:
+            It takes a batch and the return value of `forward` for it.
+          postprocess:
+            If not None, it takes a batch and the return value of `search`
+            for it. It is run in a thread pool.
+          device:
+            The device of the neural network. If it is not a CUDA device,
+            the stages are run one after another.
+          num_postprocess_workers:
+            Number of threads running `postprocess`.
+          max_pending_postprocess:
+            The maximum number of batches waiting for `postprocess`; the
+            search blocks when it is reached, which bounds the memory used.
+        '''
+        self.forward = forward
+        self.search = search
+        self.postprocess = postprocess
+        self.device = torch.device(device)
+        self.num_postprocess_workers = num_postprocess_workers
+        self.max_pending_postprocess = max_pending_postprocess
+
+    def _forward_ahead(self, batches: Iterator[Any]) -> Iterator[Any]:
+        '''Yield (batch, forward_output), having started the forward pass of
+        the next batch before yielding the current one.'''
+        if self.device.type != 'cuda':
+            for batch in batches:
+                yield batch, self.forward(batch)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        current_stream = torch.cuda.current_stream(self.device)
+
+        def launch(batch):
+            # The inputs may have been produced on the current stream.
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                output = self.forward(batch)
+                done = torch.cuda.Event()
+                done.record(stream)
+            return batch, output, done
+
+        pending = None
+        for batch in batches:
+            launched = launch(batch)
+            if pending is not None:
+                yield self._wait(pending, current_stream)
+            pending = launched
+        if pending is not None:
+            yield self._wait(pending, current_stream)
+
+    @staticmethod
+    def _wait(pending, current_stream: torch.cuda.Stream):
+        batch, output, done = pending
+        current_stream.wait_event(done)
+        _record_stream(output, current_stream)
+        return batch, output
+
+    def __call__(self, dataloader: Iterable[Any]) -> Iterator[Any]:
+        '''Decode all batches of `dataloader`.
+
+        Yields:
+          The return value of `postprocess` (or `search` if `postprocess`
+          is None) for each batch, in order.
+        '''
+        if self.postprocess is None:
+            for batch, output in self._forward_ahead(iter(dataloader)):
+                yield self.search(batch, output)
+            return
+
+        with ThreadPoolExecutor(self.num_postprocess_workers) as executor:
+            futures = deque()
+            for batch, output in self._forward_ahead(iter(dataloader)):
+                result = self.search(batch, output)
+                futures.append(executor.submit(self.postprocess, batch,
+                                               result))
+                while futures and (futures[0].done() or len(futures) >
+                                   self.max_pending_postprocess):
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
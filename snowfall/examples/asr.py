@@ -1,6 +1,6 @@
 import logging
 import re
-from typing import List, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import k2
 import numpy as np
@@ -8,13 +8,14 @@ import torch
 
 from lhotse import CutSet, Fbank, FbankConfig
 from lhotse.cut import Cut, MixedCut
-from lhotse.dataset import K2SpeechRecognitionDataset, OnTheFlyFeatures
+from lhotse.dataset import OnTheFlyFeatures
 from lhotse.supervision import AlignmentItem
 from lhotse.utils import fastcopy
-from snowfall.common import Pathlike, average_checkpoint, get_texts
+from snowfall.common import Pathlike, average_checkpoint, get_word_table, ragged_to_words
+from snowfall.decoding.engine import DecodingEngine
+from snowfall.decoding.graph import load_HLG
 from snowfall.lexicon import Lexicon
 from snowfall.models.conformer import Conformer
-from snowfall.objectives import encode_supervisions
 from snowfall.training.mmi_graph import MmiTrainingGraphCompiler, create_bigram_phone_lm
 
 
@@ -36,11 +37,11 @@ class ASR:
             device: torch.device = 'cpu',
             sampling_rate: int = 16000,
     ):
-        if isinstance(device, str):
-            self.device = torch.device(device)
+        self.device = torch.device(device)
 
         self.sampling_rate = sampling_rate
         self.extractor = Fbank(FbankConfig(num_mel_bins=80))
+        self.otf = OnTheFlyFeatures(self.extractor)
         self.lexicon = Lexicon(lang_dir)
         phone_ids = self.lexicon.phone_symbols()
         self.P = create_bigram_phone_lm(phone_ids)
@@ -70,15 +71,23 @@ class ASR:
         for p in self.model.parameters():
             p.requires_grad_(False)
         self.compiler = MmiTrainingGraphCompiler(lexicon=self.lexicon, device=self.device, P=self.P)
-        self.HLG = k2.Fsa.from_dict(torch.load(lang_dir / 'HLG.pt')).to(self.device)
+        self.HLG = load_HLG(lang_dir / 'HLG.pt', self.device)
+        self.words = get_word_table(self.lexicon.words)
+        # Default pruning/beam search params from snowfall. It also moves
+        # the model to the device.
+        self.engine = DecodingEngine(self.model,
+                                     self.HLG,
+                                     strategy='1best',
+                                     device=self.device,
+                                     output_beam_size=8.0,
+                                     conv_subsampling=True)
 
     def compute_features(self, cuts: Union[Cut, CutSet]) -> torch.Tensor:
         if isinstance(cuts, Cut):
             cuts = CutSet.from_cuts([cuts])
         assert cuts[0].sampling_rate == self.sampling_rate, f'{cuts[0].sampling_rate} != {self.sampling_rate}'
-        otf = OnTheFlyFeatures(self.extractor)
         # feats: (batch, seq_len, n_feats)
-        feats, _ = otf(cuts)
+        feats, _ = self.otf(cuts)
         return feats
 
     def compute_posteriors(self, cuts: Union[Cut, CutSet]) -> torch.Tensor:
@@ -90,11 +99,10 @@ class ASR:
         if isinstance(cuts, Cut):
             cuts = CutSet.from_cuts([cuts])
         assert cuts[0].sampling_rate == self.sampling_rate, f'{cuts[0].sampling_rate} != {self.sampling_rate}'
-        otf = OnTheFlyFeatures(self.extractor)
         # feats: (batch, seq_len, n_feats)
-        feats, _ = otf(cuts)
+        feats, _ = self.otf(cuts)
         # feats: (batch, n_feats, seq_len)
-        feats = feats.permute(0, 2, 1)
+        feats = feats.permute(0, 2, 1).to(self.device)
 
         # Compute AM posteriors
         # posteriors: (batch, n_phones, ~seq_len / 4)
@@ -102,46 +110,43 @@ class ASR:
         # returns: (batch, ~seq_len / 4, n_phones)
         return posteriors.permute(0, 2, 1)
 
+    def make_batch(self, cuts: CutSet) -> Dict[str, Any]:
+        """
+        Compute the features of ``cuts`` and return a batch in the format of
+        :class:`lhotse.dataset.K2SpeechRecognitionDataset`, without sorting
+        or shuffling the cuts. The supervisions are in the order of the cuts.
+        """
+        for cut in cuts:
+            # The features of all the cuts are computed at self.sampling_rate.
+            assert cut.sampling_rate == self.sampling_rate, \
+                f'{cut.id}: {cut.sampling_rate} != {self.sampling_rate}'
+        # feats: (batch, seq_len, n_feats)
+        feats, _ = self.otf(cuts)
+        supervisions = self.otf.supervision_intervals(cuts)
+        supervisions['text'] = [sup.text for cut in cuts for sup in cut.supervisions]
+        return {'inputs': feats, 'supervisions': supervisions}
+
+    def decode_batch(self, batch: Dict[str, Any]) -> List[List[str]]:
+        """
+        Decode a batch returned by :meth:`make_batch` and return the words of each supervision,
+        in the order of ``batch['supervisions']``.
+        """
+        hyps = self.engine.decode_batch(batch)['no_rescore']
+        return ragged_to_words(hyps, self.words)
+
     def decode(self, cuts: Union[Cut, CutSet]) -> List[Tuple[List[str], List[str]]]:
         """
         Perform decoding with an n-gram language model (HLG graph).
         Doesn't support rescoring at this time.
+
+        :return: a list of ``(ref_words, hyp_words)``, one for each supervision of ``cuts``, in order.
         """
         if isinstance(cuts, Cut):
             cuts = CutSet.from_cuts([cuts])
-        word_results = []
-        # Hacky way to get batch quickly... we may need to improve on this.
-        batch = K2SpeechRecognitionDataset(
-            cuts,
-            input_strategy=OnTheFlyFeatures(self.extractor),
-            check_inputs=False
-        )[list(cuts.ids)]
-        features = batch['inputs'].permute(0, 2, 1).to(self.device)  # (B, T, F) -> (B, F, T)
-        supervision_segments, texts = encode_supervisions(batch['supervisions'])
-
-        # Forward pass through the acoustic model
-        posteriors, _, _ = self.model(features)
-        posteriors = posteriors.permute(0, 2, 1)  # (B, F, T) -> (B, T, F)
-
-        # Wrapping into k2 "dense FSA" (representing PPG as a dense graph)
-        dense_fsa_vec = k2.DenseFsaVec(posteriors, supervision_segments)
-
-        # The actual decoding starts here:
-        # First, we intersect the HLG and the PPG
-        # with default pruning/beam search params from snowfall
-        # The result is a batch of graphs (lattices)
-        lattices = k2.intersect_dense_pruned(self.HLG, dense_fsa_vec, 20.0, 8, 30, 10000)
-        # ... then we find the shortest paths in the lattices ...
-        best_paths = k2.shortest_path(lattices, use_double_scores=True)
-        # ... and convert them to words with a convenience wrapper from snowfall
-        hyps = get_texts(best_paths, torch.arange(len(texts)))
-
-        # Here we read out the words from the best path graphs
-        for i in range(len(texts)):
-            hyp_words = [self.lexicon.words.get(x) for x in hyps[i]]
-            ref_words = texts[i].split(' ')
-            word_results.append((ref_words, hyp_words))
-        return word_results
+        batch = self.make_batch(cuts)
+        hyps = self.decode_batch(batch)
+        texts = batch['supervisions']['text']
+        return [(text.split(' '), hyp_words) for text, hyp_words in zip(texts, hyps)]
 
     def align(self, cuts: Union[Cut, CutSet]) -> torch.Tensor:
         """
@@ -162,9 +167,8 @@ class ASR:
 
         cuts = cuts.map_supervisions(self.normalize_text)
 
-        otf = OnTheFlyFeatures(self.extractor)
-        feats, _ = otf(cuts)
-        feats = feats.permute(0, 2, 1)
+        feats, _ = self.otf(cuts)
+        feats = feats.permute(0, 2, 1).to(self.device)
         texts = [' '.join(s.text for s in cut.supervisions) for cut in cuts]
 
         # Compute AM posteriors
@@ -0,0 +1,239 @@
+import asyncio
+import itertools
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+from lhotse import CutSet, Recording, SupervisionSegment
+from lhotse.cut import Cut
+from lhotse.utils import fastcopy
+from snowfall.common import Pathlike
+from snowfall.examples.asr import ASR
+
+
+def cut_from_audio(path: Pathlike, cut_id: Optional[str] = None) -> Cut:
+    """
+    Create a cut spanning a whole (mono) audio file, with a single supervision without text,
+    so that it can be passed to :meth:`AsrServer.transcribe`.
+    """
+    recording = Recording.from_file(path, recording_id=cut_id)
+    return Cut(
+        id=recording.id,
+        start=0,
+        duration=recording.duration,
+        channel=0,
+        recording=recording,
+        supervisions=[
+            SupervisionSegment(
+                id=recording.id,
+                recording_id=recording.id,
+                start=0,
+                duration=recording.duration
+            )
+        ]
+    )
+
+
+@dataclass
+class _Request:
+    cut: Cut
+    future: asyncio.Future
+
+
+class AsrServer:
+    """
+    A long-lived decoding service on top of :class:`~snowfall.examples.asr.ASR`.
+
+    Requests are put into an asyncio queue and gathered into batches whose total duration
+    is at most ``max_duration`` seconds. A batch is closed as soon as it is full or ``max_delay``
+    seconds after its first request arrived, whichever happens first, so that a lone request
+    is not kept waiting for more traffic. The model, the HLG and the feature extractor stay
+    resident in the ``ASR`` object.
+
+    The features of a batch are computed in a separate thread while the previous batch is
+    being decoded; decoding itself is done by a single thread.
+
+    In-process usage::
+
+        >>> async with AsrServer(asr) as server:
+        ...     hyps = await server.transcribe(cut)
+
+    It can also serve other processes over a Unix socket, see :meth:`serve_unix`.
+    """
+
+    def __init__(
+            self,
+            asr: ASR,
+            max_duration: float = 200.0,
+            max_delay: float = 0.05,
+            max_pending_batches: int = 2,
+    ):
+        """
+        :param asr: the recognizer.
+        :param max_duration: the maximum total duration of the cuts in a batch, in seconds.
+            A single cut longer than that is decoded alone.
+        :param max_delay: how long, in seconds, the first request of a batch may wait
+            for more requests.
+        :param max_pending_batches: the maximum number of batches being prepared or decoded;
+            new requests are queued, but not batched, when it is reached.
+        """
+        self.asr = asr
+        self.max_duration = max_duration
+        self.max_delay = max_delay
+        self.max_pending_batches = max_pending_batches
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+        self._ids = itertools.count()
+        self._feature_executor: Optional[ThreadPoolExecutor] = None
+        self._decode_executor: Optional[ThreadPoolExecutor] = None
+
+    async def start(self) -> None:
+        assert self._batcher is None, 'The server has already been started.'
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending_batches)
+        self._feature_executor = ThreadPoolExecutor(1)
+        self._decode_executor = ThreadPoolExecutor(1)
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+
+    async def stop(self) -> None:
+        """Decode the requests received so far and stop."""
+        if self._batcher is None:
+            return
+        await self._queue.put(None)
+        await self._batcher
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        self._feature_executor.shutdown()
+        self._decode_executor.shutdown()
+        self._batcher = None
+
+    async def __aenter__(self) -> 'AsrServer':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.stop()
+
+    async def transcribe(self, cut: Cut) -> List[List[str]]:
+        """
+        Decode a cut.
+
+        :return: a list with the decoded words of each supervision of ``cut``, in order.
+        :raises ValueError: if the sampling rate of ``cut`` is not that of the recognizer.
+            It is checked here, so that a bad request fails alone instead of failing
+            the batch it would have been put into.
+        """
+        assert self._batcher is not None, 'The server has not been started.'
+        if cut.sampling_rate != self.asr.sampling_rate:
+            raise ValueError(f'Cut {cut.id} has a sampling rate of {cut.sampling_rate} Hz, '
+                             f'but the recognizer expects {self.asr.sampling_rate} Hz.')
+        # Cut IDs have to be unique within a CutSet, and clients may send the same one twice.
+        cut = fastcopy(cut, id=f'{cut.id}_{next(self._ids)}')
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put(_Request(cut=cut, future=future))
+        return await future
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        carry = None
+        stopping = False
+        while not stopping:
+            request = carry if carry is not None else await self._queue.get()
+            carry = None
+            if request is None:
+                break
+            requests = [request]
+            duration = request.cut.duration
+            deadline = loop.time() + self.max_delay
+            while duration < self.max_duration:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                if duration + request.cut.duration > self.max_duration:
+                    # It starts the next batch.
+                    carry = request
+                    break
+                requests.append(request)
+                duration += request.cut.duration
+
+            await self._slots.acquire()
+            task = asyncio.ensure_future(self._process(requests))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, requests: List[_Request]) -> None:
+        loop = asyncio.get_event_loop()
+        try:
+            cuts = CutSet.from_cuts(r.cut for r in requests)
+            batch = await loop.run_in_executor(self._feature_executor, self.asr.make_batch, cuts)
+            hyps = await loop.run_in_executor(self._decode_executor, self.asr.decode_batch, batch)
+        except Exception as e:
+            logging.exception(f'Failed to decode a batch of {len(requests)} cuts')
+            for r in requests:
+                if not r.future.done():
+                    r.future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        begin = 0
+        for r in requests:
+            end = begin + len(r.cut.supervisions)
+            if not r.future.done():
+                r.future.set_result(hyps[begin:end])
+            begin = end
+
+    async def serve_unix(self, path: Pathlike) -> asyncio.AbstractServer:
+        """
+        Serve requests over a Unix socket at ``path``. The server has to be started.
+
+        The protocol is line-based JSON. A request is ``{"id": ..., "audio": "/path/to/audio.wav"}``
+        and the response is ``{"id": ..., "text": "..."}``, or ``{"id": ..., "error": "..."}``
+        if it failed. A client may send several requests without waiting; the responses are
+        written as soon as they are ready, so they may come in a different order.
+        """
+        return await asyncio.start_unix_server(self._handle_client, path=str(path))
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        pending = set()
+
+        async def respond(line: bytes) -> None:
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                # Reading the audio header may block, e.g., on a network file system.
+                cut = await asyncio.get_event_loop().run_in_executor(
+                    None, cut_from_audio, request['audio'])
+                hyps = await self.transcribe(cut)
+                response = {'id': request_id, 'text': ' '.join(' '.join(words) for words in hyps)}
+            except Exception as e:
+                response = {'id': request_id, 'error': str(e)}
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(respond(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending)
+        finally:
+            writer.close()
@@ -1,6 +1,10 @@
+import hashlib
 import re
 
+from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
 
 import logging
 
@@ -9,6 +13,8 @@ from pathlib import Path
 
 import k2
 
+from snowfall.common import Pathlike
+
 
 class Lexicon:
     def __init__(self, lang_dir: Path):
@@ -52,3 +58,107 @@ class Lexicon:
         return ans
 
 
+class VocabularyIndex(object):
+    '''Converts batches of transcripts to word IDs.
+
+    A k2.SymbolTable is queried one word at a time through its methods.
+    This class copies its symbol-to-ID mapping into a plain dict once,
+    so that a whole batch can be converted with a single pass of dict
+    lookups, and returns the result as a k2.RaggedInt that can be passed
+    directly to :func:`k2.linear_fsa`.
+
+    Converted transcripts are memoized. If `cache_file` is given, the
+    memo is loaded from it at construction and written back by
+    :meth:`save`, so that it can be kept next to the cut manifests and
+    reused across epochs and runs.
+    '''
+
+    def __init__(self,
+                 words: k2.SymbolTable,
+                 oov: str = '<UNK>',
+                 cache_file: Optional[Pathlike] = None):
+        '''
+        Args:
+          words:
+            The word symbol table.
+          oov:
+            Out of vocabulary word. Words not in `words` are mapped to it.
+          cache_file:
+            Optional path of a file holding previously converted
+            transcripts. It is ignored if it was created with a
+            different symbol table or OOV word.
+        '''
+        assert oov in words
+        self.word2id: Dict[str, int] = dict(words._sym2id)
+        self.oov_id = self.word2id[oov]
+
+        h = hashlib.sha1(f'{oov}\n'.encode('utf-8'))
+        for word, i in sorted(self.word2id.items()):
+            h.update(f'{word} {i}\n'.encode('utf-8'))
+        self.fingerprint = h.hexdigest()
+
+        self.cache_file = Path(cache_file) if cache_file is not None else None
+        self.cache: Dict[str, List[int]] = dict()
+        self._num_saved = 0
+        if self.cache_file is not None and self.cache_file.is_file():
+            d = torch.load(self.cache_file)
+            if d.get('fingerprint') == self.fingerprint:
+                self.cache = d['word_ids']
+                self._num_saved = len(self.cache)
+                logging.info(f'Loaded word IDs of {len(self.cache)} '
+                             f'transcripts from {self.cache_file}')
+            else:
+                logging.warning(f'Ignoring {self.cache_file}: it was created '
+                                f'with a different symbol table')
+
+    def word_ids(self, text: str) -> List[int]:
+        '''Return the word IDs of a transcript whose words are separated
+        by spaces.'''
+        ans = self.cache.get(text)
+        if ans is None:
+            get = self.word2id.get
+            oov_id = self.oov_id
+            ans = [get(word, oov_id) for word in text.split(' ')]
+            self.cache[text] = ans
+        return ans
+
+    def to_ragged(self,
+                  texts: Iterable[str],
+                  device: Optional[torch.device] = None) -> k2.RaggedInt:
+        '''Convert a batch of transcripts to word IDs.
+
+        Args:
+          texts:
+            Each element is a transcript containing words separated by
+            spaces.
+          device:
+            The device of the returned tensor.
+        Returns:
+          Return a k2.RaggedInt with 2 axes [transcript][word].
+        '''
+        values = []
+        row_splits = [0]
+        for text in texts:
+            values.extend(self.word_ids(text))
+            row_splits.append(len(values))
+        row_splits = torch.tensor(row_splits, dtype=torch.int32, device=device)
+        values = torch.tensor(values, dtype=torch.int32, device=device)
+        shape = k2.ragged.create_ragged_shape2(row_splits, None, values.numel())
+        return k2.RaggedInt(shape, values)
+
+    def save(self) -> None:
+        '''Write the memoized transcripts to `cache_file`, if any.
+
+        It does nothing if nothing new was converted since the last save.
+        '''
+        if self.cache_file is None or len(self.cache) == self._num_saved:
+            return
+        tmp_file = self.cache_file.with_suffix('.tmp')
+        torch.save({
+            'fingerprint': self.fingerprint,
+            'word_ids': self.cache
+        }, tmp_file)
+        tmp_file.replace(self.cache_file)
+        self._num_saved = len(self.cache)
+        logging.info(f'Saved word IDs of {len(self.cache)} transcripts '
+                     f'to {self.cache_file}')
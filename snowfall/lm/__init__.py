@@ -0,0 +1,2 @@
+from .arpa import arpa_to_fsa
+from .kneser_ney import KneserNeyLm
@@ -0,0 +1,397 @@
+import logging
+import mmap
+import re
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import k2
+import numpy as np
+import torch
+
+from snowfall.common import Pathlike
+
+# ARPA files store log10 probabilities; k2 scores are natural logs.
+LOG_10 = 2.30258509299404568402
+
+# Sections are parsed in chunks of roughly this many bytes.
+CHUNK_SIZE = 32 * 1024 * 1024
+
+_word2id: Dict[str, int] = {}
+
+
+def _init_worker(word2id: Dict[str, int]) -> None:
+    global _word2id
+    _word2id = word2id
+
+
+def _parse_chunk(
+        args: Tuple[str, int, int, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    '''Parse the n-grams of one order between two byte offsets of an ARPA
+    file. It runs in a worker process.
+
+    Returns:
+      Return a tuple (word_ids, logprobs, backoffs, num_oov_ngrams).
+      word_ids has shape [N, order]; n-grams containing words that are not
+      in the symbol table are dropped and only counted.
+    '''
+    filename, start, end, order = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf-8').splitlines()
+
+    word_ids = []
+    logprobs = []
+    backoffs = []
+    num_oov = 0
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        assert order + 1 <= len(fields) <= order + 2, \
+            f'Invalid arpa line: {line}'
+        ids = [_word2id.get(w, -1) for w in fields[1:order + 1]]
+        if -1 in ids:
+            num_oov += 1
+            continue
+        word_ids.append(ids)
+        logprobs.append(float(fields[0]))
+        backoffs.append(float(fields[order + 1]) if len(fields) ==
+                        order + 2 else 0.0)
+    return (np.array(word_ids, dtype=np.int64).reshape(-1, order),
+            np.array(logprobs, dtype=np.float64) * LOG_10,
+            np.array(backoffs, dtype=np.float64) * LOG_10, num_oov)
+
+
+def _find_sections(filename: Pathlike) -> Dict[int, Tuple[int, int]]:
+    '''Return the byte range of the body of each `\\N-grams:` section,
+    indexed by N.'''
+    sections = dict()
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        # Every section header is a line starting with a backslash.
+        starts = [0] if m[:1] == b'\\' else []
+        pos = m.find(b'\n\\')
+        while pos >= 0:
+            starts.append(pos + 1)
+            pos = m.find(b'\n\\', pos + 1)
+        headers = []
+        for start in starts:
+            line_end = m.find(b'\n', start)
+            if line_end < 0:
+                line_end = len(m)
+            headers.append((start, line_end, m[start:line_end].strip()))
+    for (_, line_end, name), (next_start, _, _) in zip(headers, headers[1:]):
+        match = re.match(rb'\\(\d+)-grams:$', name)
+        if match:
+            sections[int(match.group(1))] = (line_end + 1, next_start)
+    assert sections, f'No n-gram sections found in {filename}'
+    return sections
+
+
+def _split_section(filename: Pathlike, start: int,
+                   end: int) -> List[Tuple[int, int]]:
+    '''Split a byte range into chunks that end at line boundaries.'''
+    chunks = []
+    with open(filename, 'rb') as f:
+        while start < end:
+            chunk_end = min(start + CHUNK_SIZE, end)
+            if chunk_end < end:
+                f.seek(chunk_end)
+                chunk_end = min(chunk_end + len(f.readline()), end)
+            chunks.append((start, chunk_end))
+            start = chunk_end
+    return chunks
+
+
+class _NgramTable(object):
+    '''The n-grams of one order, sorted by (rank of history, last word).'''
+
+    def __init__(self, word_ids: np.ndarray, logprobs: np.ndarray,
+                 backoffs: np.ndarray, keys: np.ndarray,
+                 history_ranks: np.ndarray):
+        indexes = np.argsort(keys, kind='stable')
+        self.word_ids = word_ids[indexes]
+        self.logprobs = logprobs[indexes]
+        self.backoffs = backoffs[indexes]
+        self.keys = keys[indexes]
+        # Rank of the history (the first order-1 words) in the table of
+        # the previous order; -1 for unigrams.
+        self.history_ranks = history_ranks[indexes]
+        # Filled in by :func:`_build_arcs`; -1 for n-grams without a state.
+        self.states = np.full(len(self.keys), -1, dtype=np.int64)
+
+
+class _NgramLookup(object):
+    '''Maps word-ID tuples to their rank in the n-gram table of their
+    order. All lookups are vectorized over rows.'''
+
+    def __init__(self, vocab_size: int):
+        self.vocab_size = vocab_size
+        self.tables: List[_NgramTable] = []
+
+    def add(self, word_ids: np.ndarray, logprobs: np.ndarray,
+            backoffs: np.ndarray) -> int:
+        '''Add the table of the next order. N-grams whose history is not
+        an n-gram of the previous order are dropped, as they cannot be
+        reached. Return the number of dropped n-grams.'''
+        order = len(self.tables) + 1
+        assert word_ids.shape[1] == order
+        if order == 1:
+            history_ranks = np.full(len(word_ids), -1, dtype=np.int64)
+            keys = word_ids[:, 0].copy()
+            keep = np.ones(len(word_ids), dtype=bool)
+        else:
+            history_ranks = self.rank(word_ids[:, :-1])
+            keep = history_ranks >= 0
+            keys = history_ranks * self.vocab_size + word_ids[:, -1]
+        self.tables.append(
+            _NgramTable(word_ids[keep], logprobs[keep], backoffs[keep],
+                        keys[keep], history_ranks[keep]))
+        return int((~keep).sum())
+
+    def rank(self, word_ids: np.ndarray) -> np.ndarray:
+        '''Return the rank of each row of `word_ids` in the table of order
+        `word_ids.shape[1]`, or -1 if it is not an n-gram of the LM.'''
+        ranks = np.full(len(word_ids), -1, dtype=np.int64)
+        for order in range(1, word_ids.shape[1] + 1):
+            if order == 1:
+                keys = word_ids[:, 0]
+            else:
+                keys = ranks * self.vocab_size + word_ids[:, order - 1]
+            table = self.tables[order - 1]
+            if len(table.keys) == 0:
+                return np.full(len(word_ids), -1, dtype=np.int64)
+            pos = np.searchsorted(table.keys, keys)
+            pos = np.minimum(pos, len(table.keys) - 1)
+            found = table.keys[pos] == keys
+            if order > 1:
+                found &= ranks >= 0
+            ranks = np.where(found, pos, -1)
+        return ranks
+
+    def backoff_states(self, word_ids: np.ndarray,
+                       null_state: int) -> np.ndarray:
+        '''Return the state of the longest history that is a suffix of each
+        row of `word_ids`, or `null_state` if there is none.'''
+        states = np.full(len(word_ids), null_state, dtype=np.int64)
+        max_len = min(word_ids.shape[1], len(self.tables))
+        # From the shortest suffix to the longest one, so that the
+        # longest suffix with a state wins.
+        for length in range(1, max_len + 1):
+            ranks = self.rank(word_ids[:, word_ids.shape[1] - length:])
+            found = ranks >= 0
+            suffix_states = np.where(
+                found, self.tables[length - 1].states[np.maximum(ranks, 0)],
+                -1)
+            states = np.where(suffix_states >= 0, suffix_states, states)
+        return states
+
+
+def _build_arcs(lookup: _NgramLookup, bos_id: int, eos_id: int,
+                disambig_id: int) -> Tuple[np.ndarray, np.ndarray, int]:
+    '''Build the arcs of G with the same topology as Kaldi's arpa2fst.
+
+    Returns:
+      Return a tuple (arcs, scores, num_states). arcs has shape [N, 3]
+      containing (src_state, dest_state, label) sorted by src_state;
+      the final state is num_states - 1 and is entered by arcs with
+      label -1.
+    '''
+    tables = lookup.tables
+    highest_order = len(tables)
+
+    # States: the null history, then <s>, then every n-gram below the
+    # highest order that does not end in </s> (<s> unigram excluded).
+    null_state = 0
+    num_states = 1
+    start_state = null_state
+    for order, table in enumerate(tables[:-1], start=1):
+        has_state = table.word_ids[:, -1] != eos_id
+        if order == 1:
+            is_bos = table.word_ids[:, 0] == bos_id
+            assert is_bos.any(), 'The LM has no <s> unigram'
+            table.states[is_bos] = num_states
+            start_state = num_states
+            num_states += 1
+            has_state &= ~is_bos
+        n = int(has_state.sum())
+        table.states[has_state] = np.arange(num_states, num_states + n)
+        num_states += n
+    final_state = num_states
+    num_states += 1
+
+    srcs: List[np.ndarray] = []
+    dests: List[np.ndarray] = []
+    labels: List[np.ndarray] = []
+    scores: List[np.ndarray] = []
+
+    def add_arcs(src, dest, label, score):
+        keep = src >= 0
+        srcs.append(src[keep])
+        dests.append(np.broadcast_to(dest, src.shape)[keep])
+        labels.append(np.broadcast_to(label, src.shape)[keep])
+        scores.append(score[keep])
+
+    for order, table in enumerate(tables, start=1):
+        if order == 1:
+            src = np.full(len(table.keys), null_state, dtype=np.int64)
+        else:
+            # -1 if the history ends in </s>; such n-grams are dropped.
+            src = tables[order - 2].states[table.history_ranks]
+        words = table.word_ids[:, -1]
+        is_eos = words == eos_id
+        is_bos = words == bos_id
+
+        # </s> is replaced by a final arc from the history state.
+        add_arcs(np.where(is_eos, src, -1), final_state, -1,
+                 table.logprobs)
+
+        if order < highest_order:
+            dest = table.states
+        else:
+            dest = lookup.backoff_states(table.word_ids[:, 1:], null_state)
+        add_arcs(np.where(is_eos | is_bos, -1, src), dest, words,
+                 table.logprobs)
+
+        if order < highest_order:
+            has_state = table.states >= 0
+            backoff_dest = lookup.backoff_states(table.word_ids[:, 1:],
+                                                 null_state)
+            add_arcs(np.where(has_state, table.states, -1), backoff_dest,
+                     disambig_id, table.backoffs)
+
+    src = np.concatenate(srcs)
+    indexes = np.argsort(src, kind='stable')
+    arcs = np.stack([src, np.concatenate(dests),
+                     np.concatenate(labels)], axis=1)[indexes]
+    scores = np.concatenate(scores)[indexes]
+
+    # k2 requires the start state to be state 0.
+    if start_state != 0:
+        perm = np.arange(num_states)
+        perm[[0, start_state]] = perm[[start_state, 0]]
+        arcs[:, :2] = perm[arcs[:, :2]]
+        indexes = np.argsort(arcs[:, 0], kind='stable')
+        arcs = arcs[indexes]
+        scores = scores[indexes]
+    return arcs, scores, num_states
+
+
+def arpa_to_fsa(filename: Pathlike,
+                symbol_table: k2.SymbolTable,
+                disambig_symbol: str = '#0',
+                max_order: Optional[int] = None,
+                bos: str = '<s>',
+                eos: str = '</s>',
+                num_jobs: int = 8) -> k2.Fsa:
+    '''Convert an ARPA language model into a k2 FSA.
+
+    The result is equivalent to running Kaldi's arpa2fst (or kaldilm) with
+    `--disambig-symbol` and `--read-symbol-table` and loading the output
+    with `k2.Fsa.from_openfst(..., acceptor=False)`, without writing or
+    parsing any FST text: the sections of the ARPA file are parsed in
+    parallel and the arcs are built with array operations. State
+    numbers may differ from those of arpa2fst.
+
+    N-grams containing words that are not in `symbol_table` are skipped.
+
+    Args:
+      filename:
+        The ARPA file.
+      symbol_table:
+        The word symbol table, e.g., words.txt. It must contain
+        `disambig_symbol`.
+      disambig_symbol:
+        The label of the back-off arcs.
+      max_order:
+        If not None, n-grams of higher order are ignored.
+      bos:
+        The begin-of-sentence symbol.
+      eos:
+        The end-of-sentence symbol.
+      num_jobs:
+        Number of processes used for parsing.
+    Returns:
+      Return an FSA with `aux_labels` equal to its labels. Save it with
+      `torch.save(G.as_dict(), filename)`.
+    '''
+    sections = _find_sections(filename)
+    highest_order = max(sections)
+    if max_order is not None:
+        highest_order = min(highest_order, max_order)
+    assert sorted(sections)[:highest_order] == list(
+        range(1, highest_order + 1)), f'Missing sections: {sorted(sections)}'
+
+    word2id = {symbol_table.get(i): i for i in symbol_table.ids}
+    # <s> and </s> need not be in the symbol table; they never
+    # appear as labels.
+    bos_id = word2id.setdefault(bos, -2)
+    eos_id = word2id.setdefault(eos, -3)
+
+    ngrams = []
+    with Pool(num_jobs, initializer=_init_worker,
+              initargs=(word2id,)) as pool:
+        for order in range(1, highest_order + 1):
+            start, end = sections[order]
+            chunks = [(str(filename), chunk_start, chunk_end, order)
+                      for chunk_start, chunk_end in _split_section(
+                          filename, start, end)]
+            results = pool.map(_parse_chunk, chunks)
+            word_ids = np.concatenate([r[0] for r in results]) \
+                if results else np.zeros((0, order), dtype=np.int64)
+            logprobs = np.concatenate([r[1] for r in results] + [[]])
+            backoffs = np.concatenate([r[2] for r in results] + [[]])
+            num_oov = sum(r[3] for r in results)
+            logging.info(f'{order}-grams: {len(word_ids)} read, '
+                         f'{num_oov} with OOV words skipped')
+            ngrams.append((word_ids, logprobs, backoffs))
+
+    return ngrams_to_fsa(ngrams,
+                         bos_id=bos_id,
+                         eos_id=eos_id,
+                         disambig_id=word2id[disambig_symbol],
+                         vocab_size=max(symbol_table.ids) + 1)
+
+
+def ngrams_to_fsa(ngrams: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+                  bos_id: int, eos_id: int, disambig_id: int,
+                  vocab_size: int) -> k2.Fsa:
+    '''Build G from the n-grams of a back-off LM. See :func:`arpa_to_fsa`.
+
+    Args:
+      ngrams:
+        ngrams[i] contains the (i+1)-grams as a tuple (word_ids, logprobs,
+        backoffs), where word_ids has shape [N, i+1]; logprobs and backoffs
+        are natural logs with shape [N].
+      bos_id:
+        The ID of <s>. It may be -2 if <s> is not in the symbol table.
+      eos_id:
+        The ID of </s>. It may be -3 if </s> is not in the symbol table.
+      disambig_id:
+        The label of the back-off arcs.
+      vocab_size:
+        One more than the largest word ID.
+    Returns:
+      Return an FSA with `aux_labels` equal to its labels.
+    '''
+    # Shift the IDs so that <s> and </s> are non-negative in the tables.
+    offset = 3
+    lookup = _NgramLookup(vocab_size + offset)
+    for order, (word_ids, logprobs, backoffs) in enumerate(ngrams, start=1):
+        num_orphans = lookup.add(word_ids + offset, logprobs, backoffs)
+        if num_orphans > 0:
+            logging.info(f'{order}-grams: {num_orphans} without '
+                         f'a history skipped')
+
+    arcs, scores, _ = _build_arcs(lookup, bos_id + offset, eos_id + offset,
+                                  disambig_id + offset)
+    labels = np.where(arcs[:, 2] == -1, -1, arcs[:, 2] - offset)
+    scores = torch.from_numpy(scores.astype(np.float32))
+    arcs = torch.from_numpy(
+        np.stack([arcs[:, 0], arcs[:, 1], labels],
+                 axis=1).astype(np.int32))
+    arcs = torch.cat([arcs, scores.view(torch.int32).unsqueeze(1)], dim=1)
+    G = k2.Fsa(arcs.contiguous())
+    G.aux_labels = G.labels.clone()
+    return G
@@ -0,0 +1,383 @@
+import logging
+import math
+import os
+import re
+from multiprocessing import Pool
+from typing import List, Optional, TextIO, Tuple
+
+import k2
+import numpy as np
+
+from snowfall.common import Pathlike
+from snowfall.lm.arpa import LOG_10, ngrams_to_fsa
+
+# The text is counted in chunks of roughly this many bytes.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Same conventions as local/make_kn_lm.py: the corpus is read as latin-1,
+# so that any byte stream works, and only spaces and tabs separate words.
+ENCODING = 'latin-1'
+STRIP_CHARS = ' \t\r\n'
+WHITESPACE = re.compile('[ \t]+')
+NEWLINE = re.compile('\r\n|\r|\n')
+
+# Word IDs of <s> and </s> in every vocabulary built here.
+BOS_ID = 0
+EOS_ID = 1
+
+
+class _Counts(object):
+    '''Distinct n-grams of one order with their counts.
+
+    `first_pos` is the position of the first occurrence of each n-gram. It
+    is used to write the ARPA file in the same order as make_kn_lm.py,
+    which follows the insertion order of Python dicts.
+    '''
+
+    def __init__(self, word_ids: np.ndarray, counts: np.ndarray,
+                 first_pos: np.ndarray):
+        self.word_ids = word_ids
+        self.counts = counts
+        self.first_pos = first_pos
+
+    @staticmethod
+    def from_occurrences(word_ids: np.ndarray,
+                         positions: np.ndarray,
+                         counts: Optional[np.ndarray] = None) -> '_Counts':
+        if counts is None:
+            counts = np.ones(len(word_ids), dtype=np.int64)
+        rows, inverse = np.unique(word_ids, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        first_pos = np.full(len(rows), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_pos, inverse, positions)
+        return _Counts(rows, np.bincount(inverse, weights=counts,
+                                         minlength=len(rows)).astype(np.int64),
+                       first_pos)
+
+    @staticmethod
+    def merge(counts: List['_Counts']) -> '_Counts':
+        return _Counts.from_occurrences(
+            np.concatenate([c.word_ids for c in counts]),
+            np.concatenate([c.first_pos for c in counts]),
+            np.concatenate([c.counts for c in counts]))
+
+
+def _count_chunk(
+        args: Tuple[str, int, int, int, int]) -> Tuple[List[str], List[_Counts]]:
+    '''Count the n-grams of all orders in a byte range of the corpus. It
+    runs in a worker process.
+
+    Returns:
+      Return a tuple (words, counts), where words maps the local word IDs
+      used in counts to words, and counts[n] contains the (n+1)-grams.
+    '''
+    filename, start, end, ngram_order, chunk_index = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(ENCODING)
+    lines = NEWLINE.split(text)
+    if lines[-1] == '':
+        lines.pop()
+
+    word2id = {'<s>': BOS_ID, '</s>': EOS_ID}
+    sentences = []
+    for line in lines:
+        line = line.strip(STRIP_CHARS)
+        words = WHITESPACE.split(line) if line != '' else []
+        sentences.append([BOS_ID] +
+                         [word2id.setdefault(w, len(word2id))
+                          for w in words] + [EOS_ID])
+
+    # Positions are ordered by chunk, then by token within the chunk.
+    lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+    tokens = np.array([w for s in sentences for w in s], dtype=np.int64)
+    sentence_ends = np.repeat(np.cumsum(lengths), lengths)
+    positions = np.arange(len(tokens), dtype=np.int64)
+
+    counts = []
+    for n in range(1, ngram_order + 1):
+        # n-grams starting at each position that fit in the sentence
+        starts = positions[positions + n <= sentence_ends]
+        word_ids = np.stack([tokens[starts + i] for i in range(n)], axis=1)
+        counts.append(
+            _Counts.from_occurrences(word_ids, (chunk_index << 40) + starts))
+    words = [None] * len(word2id)
+    for w, i in word2id.items():
+        words[i] = w
+    return words, counts
+
+
+def _split_file(filename: Pathlike) -> List[Tuple[int, int]]:
+    '''Split a file into byte ranges that end at line boundaries.'''
+    chunks = []
+    size = os.path.getsize(filename)
+    start = 0
+    with open(filename, 'rb') as f:
+        while start < size:
+            end = min(start + CHUNK_SIZE, size)
+            if end < size:
+                f.seek(end)
+                end = min(end + len(f.readline()), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+class _Table(object):
+    '''The n-grams of one order, sorted by (rank of history, last word), so
+    that n-grams with the same history are contiguous.'''
+
+    def __init__(self, counts: _Counts, history_ranks: np.ndarray,
+                 vocab_size: int):
+        keys = history_ranks * vocab_size + counts.word_ids[:, -1]
+        indexes = np.argsort(keys, kind='stable')
+        self.keys = keys[indexes]
+        self.word_ids = counts.word_ids[indexes]
+        self.counts = counts.counts[indexes]
+        self.first_pos = counts.first_pos[indexes]
+        self.history_ranks = history_ranks[indexes]
+        self.num_histories = (int(self.history_ranks.max()) + 1
+                              if len(keys) > 0 else 0)
+
+
+class KneserNeyLm(object):
+    '''A back-off, unmodified Kneser-Ney LM estimated like
+    local/make_kn_lm.py, i.e., like srilm's
+
+        ngram-count -order N -kn-modify-counts-at-end -ukndiscount \\
+            -gt1min 0 -gt2min 0 ... -gtNmin 0
+
+    but with n-gram counts kept in sorted integer arrays and counting
+    sharded over processes.
+
+    Usage::
+
+        lm = KneserNeyLm.from_text('corpus.txt', ngram_order=4)
+        lm.write_arpa('lm.arpa')
+        G = lm.to_fsa(symbol_table)
+    '''
+
+    def __init__(self, words: List[str], counts: List[_Counts]):
+        '''
+        Args:
+          words:
+            Maps the word IDs used in `counts` to words. words[BOS_ID] is
+            <s> and words[EOS_ID] is </s>.
+          counts:
+            counts[n] contains the distinct (n+1)-grams of the corpus.
+        '''
+        self.words = words
+        self.ngram_order = len(counts)
+        assert self.ngram_order >= 2
+        vocab_size = len(words)
+
+        self.tables: List[_Table] = []
+        for n, c in enumerate(counts):
+            if n == 0:
+                history_ranks = np.zeros(len(c.counts), dtype=np.int64)
+            else:
+                history_ranks = self._rank(c.word_ids[:, :-1])
+                # The history of an n-gram always occurs in the corpus.
+                assert (history_ranks >= 0).all()
+            self.tables.append(_Table(c, history_ranks, vocab_size))
+
+        self._compute_discounting_constants()
+        self._compute_f()
+        self._compute_bow()
+
+    @staticmethod
+    def from_text(filename: Pathlike,
+                  ngram_order: int = 4,
+                  num_jobs: int = 8) -> 'KneserNeyLm':
+        '''Count the n-grams of a text file and estimate the LM.
+
+        Every line is a sentence; <s> and </s> are added around it.
+        '''
+        chunks = _split_file(filename)
+        word2id = {'<s>': BOS_ID, '</s>': EOS_ID}
+        merged: List[List[_Counts]] = [[] for _ in range(ngram_order)]
+        with Pool(num_jobs) as pool:
+            results = pool.imap(_count_chunk, [
+                (str(filename), start, end, ngram_order, i)
+                for i, (start, end) in enumerate(chunks)
+            ])
+            for i, (words, counts) in enumerate(results):
+                # Map the local word IDs of the chunk to global ones.
+                local_to_global = np.array(
+                    [word2id.setdefault(w, len(word2id)) for w in words],
+                    dtype=np.int64)
+                for n, c in enumerate(counts):
+                    merged[n].append(
+                        _Counts(local_to_global[c.word_ids], c.counts,
+                                c.first_pos))
+                    # Merge now and then to bound the memory used by
+                    # duplicates across chunks.
+                    if len(merged[n]) >= num_jobs:
+                        merged[n] = [_Counts.merge(merged[n])]
+                logging.info(f'Counted {i + 1}/{len(chunks)} chunks')
+        if not chunks:
+            logging.warning(f'{filename} is empty')
+        counts = [
+            _Counts.merge(m) if m else _Counts(
+                np.zeros((0, n + 1), dtype=np.int64),
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            for n, m in enumerate(merged)
+        ]
+        words = [None] * len(word2id)
+        for w, i in word2id.items():
+            words[i] = w
+        return KneserNeyLm(words, counts)
+
+    def _rank(self, word_ids: np.ndarray) -> np.ndarray:
+        '''Return the index of each row of `word_ids` in the table of its
+        order, or -1 if it is not there.'''
+        vocab_size = len(self.words)
+        ranks = np.zeros(len(word_ids), dtype=np.int64)
+        for n in range(word_ids.shape[1]):
+            table = self.tables[n]
+            keys = ranks * vocab_size + word_ids[:, n]
+            if len(table.keys) == 0:
+                return np.full(len(word_ids), -1, dtype=np.int64)
+            pos = np.minimum(np.searchsorted(table.keys, keys),
+                             len(table.keys) - 1)
+            ranks = np.where((ranks >= 0) & (table.keys[pos] == keys), pos,
+                             -1)
+        return ranks
+
+    def _compute_discounting_constants(self) -> None:
+        # D_N = n1_N / (n1_N + 2 * n2_N), where nk_N is the number of
+        # distinct N-grams seen k times. There is no discounting for
+        # unigrams.
+        self.d = [0.0]
+        for table in self.tables[1:]:
+            n1 = int((table.counts == 1).sum())
+            n2 = int((table.counts == 2).sum())
+            assert n1 + 2 * n2 > 0
+            self.d.append(n1 * 1.0 / (n1 + 2 * n2))
+
+    def _compute_f(self) -> None:
+        # f(a_z) = (c(a_z) - D) / c(a_)       for highest order n-grams and
+        #                                     histories starting with <s>
+        # f(_z)  = (n(*_z) - D) / n(*_*)      for lower order n-grams
+        # where n(*_z) is the number of distinct words preceding _z.
+        for n, table in enumerate(self.tables):
+            total = np.bincount(table.history_ranks,
+                                weights=table.counts,
+                                minlength=table.num_histories)
+            f = np.maximum(table.counts - self.d[n],
+                           0) / total[table.history_ranks]
+            if n + 1 < self.ngram_order:
+                # Every (n+2)-gram v_z contributes one distinct left
+                # context v to the (n+1)-gram _z.
+                longer = self.tables[n + 1]
+                contexts = np.bincount(self._rank(longer.word_ids[:, 1:]),
+                                       minlength=len(table.counts))
+                contexts_total = np.bincount(table.history_ranks,
+                                             weights=contexts,
+                                             minlength=table.num_histories)
+                h = contexts_total[table.history_ranks]
+                f = np.where(
+                    h > 0,
+                    np.maximum(contexts - self.d[n], 0) / np.maximum(h, 1),
+                    f)
+            table.f = f
+
+    def _compute_bow(self) -> None:
+        # bow(a_) = (1 - Sum_Z1 f(a_z)) / (1 - Sum_Z1 f(_z))
+        # where Z1 is the set of words z with c(a_z) > 0. Only n-grams that
+        # are the history of a longer n-gram have one, i.e., not those of
+        # the highest order or ending in </s>.
+        for n, table in enumerate(self.tables):
+            table.bow = np.full(len(table.counts), np.nan)
+            if n + 1 == self.ngram_order:
+                continue
+            longer = self.tables[n + 1]
+            # Sum in the order in which make_kn_lm.py does, so that
+            # the results are bit-exact.
+            order = np.argsort(longer.first_pos, kind='stable')
+            history_ranks = longer.history_ranks[order]
+            sum_f_a_z = np.bincount(history_ranks,
+                                    weights=longer.f[order],
+                                    minlength=len(table.counts))
+            lower_f = table.f[self._rank(longer.word_ids[order, 1:])]
+            sum_f_z = np.bincount(history_ranks,
+                                  weights=lower_f,
+                                  minlength=len(table.counts))
+            has_bow = table.word_ids[:, -1] != EOS_ID
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bow = (1.0 - sum_f_a_z) / (1.0 - sum_f_z)
+            assert np.isfinite(bow[has_bow]).all(), \
+                f'Back-off weight of {n + 1}-grams is not finite'
+            table.bow[has_bow] = bow[has_bow]
+
+    def _ordered(self, n: int) -> np.ndarray:
+        '''Indexes of the (n+1)-grams in the order make_kn_lm.py writes
+        them: histories by first occurrence, then words by first
+        occurrence.'''
+        table = self.tables[n]
+        history_first_pos = np.full(table.num_histories,
+                                    np.iinfo(np.int64).max,
+                                    dtype=np.int64)
+        np.minimum.at(history_first_pos, table.history_ranks, table.first_pos)
+        return np.lexsort(
+            (table.first_pos, history_first_pos[table.history_ranks]))
+
+    def write_arpa(self, filename: Optional[Pathlike] = None,
+                   f: Optional[TextIO] = None) -> None:
+        '''Write the LM in ARPA format to `filename`, or to the
+        text stream `f`. The output matches local/make_kn_lm.py.'''
+        if f is None:
+            with open(filename, 'w', encoding=ENCODING) as f:
+                return self.write_arpa(f=f)
+
+        print('\\data\\', file=f)
+        for n, table in enumerate(self.tables):
+            print(f'ngram {n + 1}={len(table.counts)}', file=f)
+        print('', file=f)
+
+        for n, table in enumerate(self.tables):
+            print(f'\\{n + 1}-grams:', file=f)
+            for i in self._ordered(n).tolist():
+                prob = float(table.f[i])
+                if prob == 0:  # f(<s>) is always 0
+                    prob = 1e-99
+                ngram = ' '.join(self.words[w] for w in table.word_ids[i])
+                line = '{0}\t{1}'.format('%.7f' % math.log10(prob), ngram)
+                bow = table.bow[i]
+                if not np.isnan(bow):
+                    line += '\t{0}'.format('%.7f' % math.log10(bow))
+                print(line, file=f)
+            print('', file=f)
+        print('\\end\\', file=f)
+
+    def to_fsa(self, symbol_table: k2.SymbolTable,
+               disambig_symbol: str = '#0') -> k2.Fsa:
+        '''Return G as :func:`snowfall.lm.arpa_to_fsa` builds it from the
+        output of :meth:`write_arpa`, without writing the ARPA file. Scores
+        are rounded to the precision of the ARPA file.
+
+        N-grams containing words that are not in `symbol_table`
+        are skipped.'''
+        word2id = {symbol_table.get(i): i for i in symbol_table.ids}
+        bos_id = word2id.setdefault(self.words[BOS_ID], -2)
+        eos_id = word2id.setdefault(self.words[EOS_ID], -3)
+        id_map = np.array([word2id.get(w, -1) for w in self.words],
+                          dtype=np.int64)
+
+        ngrams = []
+        for table in self.tables:
+            word_ids = id_map[table.word_ids]
+            keep = (word_ids != -1).all(axis=1)
+            # Round like the ARPA file does.
+            with np.errstate(invalid='ignore'):
+                logprobs = np.round(
+                    np.log10(np.where(table.f == 0, 1e-99, table.f)),
+                    7) * LOG_10
+                backoffs = np.where(np.isnan(table.bow), 0.0,
+                                    np.round(np.log10(table.bow), 7) * LOG_10)
+            ngrams.append((word_ids[keep], logprobs[keep], backoffs[keep]))
+        return ngrams_to_fsa(ngrams,
+                             bos_id=bos_id,
+                             eos_id=eos_id,
+                             disambig_id=word2id[disambig_symbol],
+                             vocab_size=max(symbol_table.ids) + 1)
@@ -193,6 +193,49 @@ class Transformer(AcousticModel):
 
         return decoder_loss
 
+    def decoder_nll(self, x: Tensor, encoder_mask: Optional[Tensor], token_ids: List[List[int]]) -> Tensor:
+        """
+        Args:
+            x: Tensor of dimension (input_length, batch_size, d_model).
+            encoder_mask: Mask tensor of dimension (batch_size, input_length) or None.
+            token_ids: Token sequences without <sos/eos>, len(token_ids) = batch_size.
+                       The i-th sequence is scored against the i-th column of x.
+
+        Returns:
+            Tensor: Negative log-likelihood of each sequence (including <eos>),
+                    of dimension (batch_size,).
+        """
+        sos_id = self.decoder_num_class - 1
+        eos_id = self.decoder_num_class - 1
+        _sos = torch.tensor([sos_id])
+        _eos = torch.tensor([eos_id])
+        ys = [torch.as_tensor(y, dtype=torch.int64) for y in token_ids]
+        ys_in = [torch.cat([_sos, y], dim=0) for y in ys]
+        ys_out = [torch.cat([y, _eos], dim=0) for y in ys]
+        ys_in_pad = pad_list(ys_in, eos_id).to(x.device)
+        ys_out_pad = pad_list(ys_out, -1).to(x.device)
+
+        tgt_mask = generate_square_subsequent_mask(ys_in_pad.shape[-1]).to(x.device)
+
+        # ys_in_pad is padded with <eos>, so use ys_out_pad for the mask.
+        tgt_key_padding_mask = decoder_padding_mask(ys_out_pad)
+
+        tgt = self.decoder_embed(ys_in_pad)  # (B, T) -> (B, T, F)
+        tgt = self.decoder_pos(tgt)
+        tgt = tgt.permute(1, 0, 2)  # (B, T, F) -> (T, B, F)
+        pred_pad = self.decoder(tgt=tgt,
+                                memory=x,
+                                tgt_mask=tgt_mask,
+                                tgt_key_padding_mask=tgt_key_padding_mask,
+                                memory_key_padding_mask=encoder_mask)  # (T, B, F)
+        pred_pad = pred_pad.permute(1, 0, 2)  # (T, B, F) -> (B, T, F)
+        pred_pad = self.decoder_output_layer(pred_pad)  # (B, T, F)
+        log_probs = nn.functional.log_softmax(pred_pad, dim=-1)
+
+        padding = ys_out_pad == -1
+        nll = -log_probs.gather(-1, ys_out_pad.masked_fill(padding, 0).unsqueeze(-1)).squeeze(-1)
+        return nll.masked_fill(padding, 0.0).sum(dim=1)
+
 
 class TransformerEncoderLayer(nn.Module):
     """
@@ -657,7 +700,9 @@ class LabelSmoothingLoss(nn.Module):
             true_dist = x.clone()
             true_dist.fill_(self.smoothing / (self.size - 1))
             ignore = target == self.padding_idx  # (B,)
-            total = len(target) - ignore.sum().item()
+            # Keep it as a tensor: calling .item() here would synchronize
+            # with the device on every batch.
+            total = len(target) - ignore.sum()
             target = target.masked_fill(ignore, 0)  # avoid -1 index
             true_dist.scatter_(1, target.unsqueeze(1), self.confidence)
         kl = self.criterion(torch.log_softmax(x, dim=1), true_dist)
@@ -1,3 +1,3 @@
 from .common import encode_supervisions
 from .ctc import CTCLoss
-from .mmi import LFMMILoss
+from .mmi import LFMMILoss, PrunedBeamTuner
@@ -48,11 +48,14 @@ def get_tot_objf_and_num_frames(
              Returns a tuple of 3 scalar tensors:  (tot_score, ok_frames, all_frames)
         where ok_frames is the frames for successful (finite) segments, and
        all_frames is the frames for all segments (finite or not).
+       All of them are on the device of ``tot_scores``.
+
+    It uses masked sums instead of ``torch.nonzero``, so it does not
+    synchronize the device with the host.
     """
     mask = torch.ne(tot_scores, -math.inf)
-    # finite_indexes is a tensor containing successful segment indexes, e.g.
-    # [ 0 1 3 4 5 ]
-    finite_indexes = torch.nonzero(mask).squeeze(1)
-    ok_frames = frames_per_seq[finite_indexes].sum()
+    frames_per_seq = frames_per_seq.to(tot_scores.device, non_blocking=True)
+    ok_frames = (frames_per_seq * mask).sum()
     all_frames = frames_per_seq.sum()
-    return tot_scores[finite_indexes].sum(), ok_frames, all_frames
+    tot_score = torch.where(mask, tot_scores, torch.zeros_like(tot_scores)).sum()
+    return tot_score, ok_frames, all_frames
@@ -1,21 +1,31 @@
-from typing import List, Tuple
+import logging
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from torch import nn
 
 import k2
 
+from snowfall.common import get_num_arcs_per_fsa, split_into_sub_batches
 from snowfall.objectives.common import get_tot_objf_and_num_frames
 from snowfall.training.mmi_graph import MmiTrainingGraphCompiler
+from snowfall.training.profiler import active_profiler, profile_count, profile_stage
+
+
+def _count_lattice_arcs(name: str, lats: k2.Fsa) -> None:
+    '''Add the number of arcs of `lats` to the profiler counter `name`,
+    if the step is being profiled.'''
+    if active_profiler() is not None:
+        profile_count(name, get_num_arcs_per_fsa(lats).sum())
 
 
 def _compute_mmi_loss_exact_optimized(
-        nnet_output: torch.Tensor,
-        texts: List[str],
-        supervision_segments: torch.Tensor,
-        graph_compiler: MmiTrainingGraphCompiler,
-        den_scale: float = 1.0
-) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        num_graphs: k2.Fsa,
+        den_graph: k2.Fsa,
+        dense_fsa_vec: k2.DenseFsaVec,
+        num_den_indexes: torch.Tensor,
+        a_to_b_map: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
     '''
     The function name contains `exact`, which means it uses a version of
     intersection without pruning.
@@ -27,127 +37,103 @@ def _compute_mmi_loss_exact_optimized(
       It is faster at the cost of using more memory.
 
     Args:
-      nnet_output:
-        A 3-D tensor of shape [N, T, C]
-      texts:
-        The transcript. Each element consists of space(s) separated words.
-      supervision_segments:
-        A 2-D tensor that will be passed to :func:`k2.DenseFsaVec`.
-      graph_compiler:
-        Used to build num_graphs and den_graphs
-      den_scale:
-        The scale applied to the denominator tot_scores.
+      num_graphs:
+        The numerator graphs. An FsaVec with one FSA per sequence in
+        `dense_fsa_vec`.
+      den_graph:
+        The denominator graph. An FsaVec containing a single FSA whose
+        aux_labels are a k2.RaggedInt (the aux_labels of num_graphs are
+        ragged, and k2.cat() requires them to be of the same type).
+      dense_fsa_vec:
+        The neural network output.
+      num_den_indexes:
+        [0, num_fsas, 1, num_fsas, 2, num_fsas, ... ] on the same device
+        as `num_graphs`. See :meth:`LFMMILoss.get_num_den_indexes`.
+      a_to_b_map:
+        [0, 0, 1, 1, 2, 2, ... ] on the same device as `num_graphs`.
+    Returns:
+      Return a tuple (num_tot_scores, den_tot_scores), each a 1-D tensor
+      with one entry per sequence.
     '''
-    num_graphs, den_graphs = graph_compiler.compile(texts,
-                                                    replicate_den=False)
-
-    dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
-
-    device = num_graphs.device
-
-    num_fsas = num_graphs.shape[0]
-    assert dense_fsa_vec.dim0() == num_fsas
+    assert dense_fsa_vec.dim0() == num_graphs.shape[0]
+    assert den_graph.shape[0] == 1
 
-    assert den_graphs.shape[0] == 1
-
-    # the aux_labels of num_graphs is k2.RaggedInt
-    # but it is torch.Tensor for den_graphs.
-    #
-    # The following converts den_graphs.aux_labels
-    # from torch.Tensor to k2.RaggedInt so that
-    # we can use k2.append() later
-    den_graphs.convert_attr_to_ragged_(name='aux_labels')
-
-    # The motivation to concatenate num_graphs and den_graphs
+    # The motivation to concatenate num_graphs and den_graph
     # is to reduce the number of calls to k2.intersect_dense.
-    num_den_graphs = k2.cat([num_graphs, den_graphs])
+    num_den_graphs = k2.cat([num_graphs, den_graph])
 
     # NOTE: The a_to_b_map in k2.intersect_dense must be sorted
     # so the following reorders num_den_graphs.
-    #
-    # The following code computes a_to_b_map
-
-    # [0, 1, 2, ... ]
-    num_graphs_indexes = torch.arange(num_fsas, dtype=torch.int32)
-
-    # [num_fsas, num_fsas, num_fsas, ... ]
-    den_graphs_indexes = torch.tensor([num_fsas] * num_fsas, dtype=torch.int32)
-
-    # [0, num_fsas, 1, num_fsas, 2, num_fsas, ... ]
-    num_den_graphs_indexes = torch.stack(
-        [num_graphs_indexes, den_graphs_indexes]).t().reshape(-1).to(device)
-
-    num_den_reordered_graphs = k2.index(num_den_graphs, num_den_graphs_indexes)
-
-    # [[0, 1, 2, ...]]
-    a_to_b_map = torch.arange(num_fsas, dtype=torch.int32).reshape(1, -1)
-
-    # [[0, 1, 2, ...]] -> [0, 0, 1, 1, 2, 2, ... ]
-    a_to_b_map = a_to_b_map.repeat(2, 1).t().reshape(-1).to(device)
+    num_den_reordered_graphs = k2.index(num_den_graphs, num_den_indexes)
 
     num_den_lats = k2.intersect_dense(num_den_reordered_graphs,
                                       dense_fsa_vec,
                                       output_beam=10.0,
                                       a_to_b_map=a_to_b_map)
 
+    if active_profiler() is not None:
+        # num and den lattices are interleaved.
+        num_arcs = get_num_arcs_per_fsa(num_den_lats)
+        profile_count('num_lattice_arcs', num_arcs[::2].sum())
+        profile_count('den_lattice_arcs', num_arcs[1::2].sum())
+
     num_den_tot_scores = num_den_lats.get_tot_scores(log_semiring=True,
                                                      use_double_scores=True)
 
     num_tot_scores = num_den_tot_scores[::2]
     den_tot_scores = num_den_tot_scores[1::2]
-
-    tot_scores = num_tot_scores - den_scale * den_tot_scores
-    tot_score, tot_frames, all_frames = get_tot_objf_and_num_frames(
-        tot_scores, supervision_segments[:, 2])
-    return tot_score, tot_frames, all_frames
+    return num_tot_scores, den_tot_scores
 
 
 def _compute_mmi_loss_exact_non_optimized(
-        nnet_output: torch.Tensor,
-        texts: List[str],
-        supervision_segments: torch.Tensor,
-        graph_compiler: MmiTrainingGraphCompiler,
-        den_scale: float = 1.0
-) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        num_graphs: k2.Fsa,
+        den_graph: k2.Fsa,
+        dense_fsa_vec: k2.DenseFsaVec,
+        den_indexes: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
     '''
     See :func:`_compute_mmi_loss_exact_optimized` for the meaning
     of the arguments.
 
     It's more readable, though it invokes k2.intersect_dense twice.
 
+    Args:
+      den_indexes:
+        [0, 0, 0, ... ], one entry per sequence, used to replicate
+        `den_graph`.
+
     Note:
       It uses less memory at the cost of speed. It is slower.
     '''
-    num_graphs, den_graphs = graph_compiler.compile(texts,
-                                                    replicate_den=True)
-
-    dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
+    den_graphs = k2.index_fsa(den_graph, den_indexes)
 
     num_lats = k2.intersect_dense(num_graphs, dense_fsa_vec, output_beam=10.0)
     den_lats = k2.intersect_dense(den_graphs, dense_fsa_vec, output_beam=10.0)
 
+    _count_lattice_arcs('num_lattice_arcs', num_lats)
+    _count_lattice_arcs('den_lattice_arcs', den_lats)
+
     num_tot_scores = num_lats.get_tot_scores(log_semiring=True,
                                              use_double_scores=True)
 
     den_tot_scores = den_lats.get_tot_scores(log_semiring=True,
                                              use_double_scores=True)
-
-    tot_scores = num_tot_scores - den_scale * den_tot_scores
-    tot_score, tot_frames, all_frames = get_tot_objf_and_num_frames(
-        tot_scores, supervision_segments[:, 2])
-    return tot_score, tot_frames, all_frames
+    return num_tot_scores, den_tot_scores
 
 
 def _compute_mmi_loss_pruned(
-        nnet_output: torch.Tensor,
-        texts: List[str],
-        supervision_segments: torch.Tensor,
-        graph_compiler: MmiTrainingGraphCompiler,
-        den_scale: float = 1.0
-) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        num_graphs: k2.Fsa,
+        den_graph: k2.Fsa,
+        dense_fsa_vec: k2.DenseFsaVec,
+        search_beam: float = 20.0,
+        output_beam: float = 7.0,
+        min_active_states: int = 30,
+        max_active_states: int = 10000
+) -> Tuple[torch.Tensor, torch.Tensor]:
     '''
     See :func:`_compute_mmi_loss_exact_optimized` for the meaning
-    of the arguments.
+    of the arguments. `search_beam`, `output_beam`, `min_active_states`
+    and `max_active_states` are passed to k2.intersect_dense_pruned.
 
     `pruned` means it uses k2.intersect_dense_pruned
 
@@ -155,37 +141,124 @@ def _compute_mmi_loss_pruned(
       It uses the least amount of memory, but the loss is not exact due
       to pruning.
     '''
-    num_graphs, den_graphs = graph_compiler.compile(texts,
-                                                    replicate_den=False)
-    dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
-
     num_lats = k2.intersect_dense(num_graphs, dense_fsa_vec, output_beam=10.0)
 
-    # the values for search_beam/output_beam/min_active_states/max_active_states
-    # are not tuned. You may want to tune them.
-    den_lats = k2.intersect_dense_pruned(den_graphs,
+    den_lats = k2.intersect_dense_pruned(den_graph,
                                          dense_fsa_vec,
-                                         search_beam=20.0,
-                                         output_beam=7.0,
-                                         min_active_states=30,
-                                         max_active_states=10000)
+                                         search_beam=search_beam,
+                                         output_beam=output_beam,
+                                         min_active_states=min_active_states,
+                                         max_active_states=max_active_states)
+
+    _count_lattice_arcs('num_lattice_arcs', num_lats)
+    _count_lattice_arcs('den_lattice_arcs', den_lats)
 
     num_tot_scores = num_lats.get_tot_scores(log_semiring=True,
                                              use_double_scores=True)
 
     den_tot_scores = den_lats.get_tot_scores(log_semiring=True,
                                              use_double_scores=True)
+    return num_tot_scores, den_tot_scores
+
+
+class PrunedBeamTuner(object):
+    '''Adjusts the beams of the pruned den intersection during training.
 
-    tot_scores = num_tot_scores - den_scale * den_tot_scores
-    tot_score, tot_frames, all_frames = get_tot_objf_and_num_frames(
-        tot_scores, supervision_segments[:, 2])
-    return tot_score, tot_frames, all_frames
+    Every `interval` training calls to :meth:`LFMMILoss.forward`, the den
+    scores are computed both exactly and with pruning for a few sequences.
+    While the difference per frame stays below `tolerance`, the beams are
+    multiplied by `shrink`; once it exceeds `tolerance`, they are divided
+    by it. The beams never leave [min_*_beam, max_*_beam].
+
+    Calls made without grad, e.g., in validation, are not counted and never
+    trigger a check. If `held_out` is True, the loss does not check
+    training batches at all: the caller counts the training steps with
+    :meth:`is_due` and passes the output of the model on a fixed held-out
+    batch to :meth:`LFMMILoss.tune_pruned_beams` (see
+    :class:`snowfall.training.trainer.LFMMIObjective`).
+    '''
+
+    def __init__(self,
+                 interval: int = 500,
+                 tolerance: float = 0.01,
+                 shrink: float = 0.9,
+                 num_sequences: int = 4,
+                 min_search_beam: float = 4.0,
+                 max_search_beam: float = 20.0,
+                 min_output_beam: float = 2.0,
+                 max_output_beam: float = 7.0,
+                 held_out: bool = False):
+        '''
+        Args:
+          interval:
+            Number of forward calls between two checks.
+          tolerance:
+            The largest acceptable value of
+            `(exact_den_score - pruned_den_score) / num_frames`,
+            averaged over the checked sequences.
+          shrink:
+            A value in (0, 1). The factor applied to the beams after
+            a check that passes.
+          num_sequences:
+            Number of sequences used in a check. The shortest sequences of
+            the batch are used so that the exact intersection is cheap.
+          held_out:
+            If True, the checks are run by the caller on a held-out batch
+            instead of on the training batches.
+        '''
+        assert 0 < shrink < 1
+        self.interval = interval
+        self.tolerance = tolerance
+        self.shrink = shrink
+        self.num_sequences = num_sequences
+        self.min_search_beam = min_search_beam
+        self.max_search_beam = max_search_beam
+        self.min_output_beam = min_output_beam
+        self.max_output_beam = max_output_beam
+        self.held_out = held_out
+        self.num_calls = 0
+
+    def is_due(self) -> bool:
+        '''Count a forward call and return True if a check is due.'''
+        self.num_calls += 1
+        return self.interval > 0 and self.num_calls % self.interval == 0
+
+    def update(self, loss: 'LFMMILoss', error: float) -> None:
+        '''Update the beams of `loss` given the error measured with them.'''
+        if error <= self.tolerance:
+            scale = self.shrink
+        else:
+            scale = 1.0 / self.shrink
+        loss.search_beam = min(max(loss.search_beam * scale,
+                                   self.min_search_beam), self.max_search_beam)
+        loss.output_beam = min(max(loss.output_beam * scale,
+                                   self.min_output_beam), self.max_output_beam)
+        logging.info(f'Pruned den intersection error {error:.4f} per frame '
+                     f'(tolerance {self.tolerance}); search_beam is now '
+                     f'{loss.search_beam:.2f}, output_beam is now '
+                     f'{loss.output_beam:.2f}')
 
 
 class LFMMILoss(nn.Module):
     """
     Computes Lattice-Free Maximum Mutual Information (LFMMI) loss.
 
+    The denominator graph is built once by the graph compiler and the
+    index tensors used to interleave it with the numerator graphs are
+    cached on the device per batch size, so an instance should be created
+    once and reused for all batches.
+
+    If `memory_budget` is given, the intersection strategy is chosen per
+    batch instead of by `use_pruned_intersect`. The memory needed by
+    k2.intersect_dense is estimated as `bytes_per_arc` times the number of
+    arcs of the graphs times the number of frames, summed over sequences.
+    The fastest strategy that fits is used, in this order:
+
+      - exact, with num and den graphs in a single intersection
+      - exact, with separate num and den intersections
+      - exact, on sub-batches small enough to fit
+      - pruned den intersection, for a sequence too long to fit by itself
+
     TODO: more detailed description
     """
 
@@ -194,23 +267,277 @@ class LFMMILoss(nn.Module):
             graph_compiler: MmiTrainingGraphCompiler,
             use_pruned_intersect: bool = False,
             den_scale: float = 1.0,
+            memory_budget: Optional[float] = None,
+            bytes_per_arc: float = 64.0,
+            search_beam: float = 20.0,
+            output_beam: float = 7.0,
+            min_active_states: int = 30,
+            max_active_states: int = 10000,
+            beam_tuner: Optional[PrunedBeamTuner] = None,
     ):
+        '''
+        Args:
+          graph_compiler:
+            Used to build num_graphs; it also holds the den graph.
+          use_pruned_intersect:
+            True to use k2.intersect_dense_pruned for the den lattices.
+            Ignored if `memory_budget` is not None.
+          den_scale:
+            The scale applied to the denominator tot_scores.
+          memory_budget:
+            If not None, the number of bytes that one call to
+            k2.intersect_dense may use. See the class docstring.
+          bytes_per_arc:
+            Estimated bytes used by k2.intersect_dense per arc of the
+            graphs per frame. Used only if `memory_budget` is not None.
+          search_beam:
+            Passed to k2.intersect_dense_pruned for the den lattices.
+          output_beam:
+            Passed to k2.intersect_dense_pruned for the den lattices.
+          min_active_states:
+            Passed to k2.intersect_dense_pruned for the den lattices.
+          max_active_states:
+            Passed to k2.intersect_dense_pruned for the den lattices.
+          beam_tuner:
+            If not None, `search_beam` and `output_beam` are adjusted
+            during training. See :class:`PrunedBeamTuner`. It is used
+            only when the den lattices are computed with pruning.
+        '''
         super().__init__()
         self.graph_compiler = graph_compiler
         self.den_scale = den_scale
         self.use_pruned_intersect = use_pruned_intersect
+        self.memory_budget = memory_budget
+        self.bytes_per_arc = bytes_per_arc
+        self.search_beam = search_beam
+        self.output_beam = output_beam
+        self.min_active_states = min_active_states
+        self.max_active_states = max_active_states
+        self.beam_tuner = beam_tuner
+
+        # Maps (num_fsas, device) to the tuple
+        # (num_den_indexes, a_to_b_map, den_indexes).
+        self._indexes: Dict[Tuple[int, torch.device],
+                            Tuple[torch.Tensor, torch.Tensor,
+                                  torch.Tensor]] = dict()
+
+    def get_num_den_indexes(
+            self, num_fsas: int, device: torch.device
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        '''Return the index tensors used to intersect a batch of `num_fsas`
+        numerator graphs together with the denominator graph.
+
+        Returns:
+          A tuple (num_den_indexes, a_to_b_map, den_indexes) of int32
+          tensors on `device`:
+
+            - num_den_indexes is [0, num_fsas, 1, num_fsas, 2, num_fsas, ...]
+            - a_to_b_map is [0, 0, 1, 1, 2, 2, ...]
+            - den_indexes is [0, 0, 0, ...]
+        '''
+        key = (num_fsas, device)
+        if key not in self._indexes:
+            # [0, 1, 2, ... ]
+            num_graphs_indexes = torch.arange(num_fsas,
+                                              dtype=torch.int32,
+                                              device=device)
+
+            # [num_fsas, num_fsas, num_fsas, ... ]
+            den_graphs_indexes = torch.full_like(num_graphs_indexes, num_fsas)
+
+            # [0, num_fsas, 1, num_fsas, 2, num_fsas, ... ]
+            num_den_indexes = torch.stack(
+                [num_graphs_indexes, den_graphs_indexes]).t().reshape(-1)
+
+            # [0, 0, 1, 1, 2, 2, ... ]
+            a_to_b_map = num_graphs_indexes.repeat_interleave(2)
+
+            den_indexes = torch.zeros_like(num_graphs_indexes)
+
+            self._indexes[key] = (num_den_indexes, a_to_b_map, den_indexes)
+        return self._indexes[key]
 
     def forward(self, nnet_output: torch.Tensor, texts: List[str],
                 supervision_segments: torch.Tensor
                ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        if self.use_pruned_intersect:
-            func = _compute_mmi_loss_pruned
+        '''
+        Args:
+          nnet_output:
+            A 3-D tensor of shape [N, T, C]
+          texts:
+            The transcript. Each element consists of space(s) separated words.
+          supervision_segments:
+            A 2-D tensor that will be passed to :func:`k2.DenseFsaVec`.
+        Returns:
+          Returns a tuple of 3 scalar tensors: (tot_score, ok_frames,
+          all_frames). See :func:`get_tot_objf_and_num_frames`.
+        '''
+        with profile_stage('graph_compile'):
+            num_graphs = self.graph_compiler.compile_num_graphs(texts)
+        den_graph = self.graph_compiler.den_graph
+
+        with profile_stage('intersect_dense'):
+            num_tot_scores, den_tot_scores = self._compute_tot_scores(
+                num_graphs, den_graph, nnet_output, supervision_segments)
+
+        tot_scores = num_tot_scores - self.den_scale * den_tot_scores
+        tot_score, tot_frames, all_frames = get_tot_objf_and_num_frames(
+            tot_scores, supervision_segments[:, 2])
+        return tot_score, tot_frames, all_frames
+
+    def _compute_tot_scores(
+            self, num_graphs: k2.Fsa, den_graph: k2.Fsa,
+            nnet_output: torch.Tensor, supervision_segments: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.memory_budget is not None:
+            num_tot_scores, den_tot_scores = self._compute_tot_scores_adaptive(
+                num_graphs, den_graph, nnet_output, supervision_segments)
+        elif self.use_pruned_intersect:
+            # Only training batches are checked: a validation, possibly
+            # running in another thread, must not change the beams.
+            if self.beam_tuner is not None and not self.beam_tuner.held_out \
+                    and nnet_output.requires_grad and self.beam_tuner.is_due():
+                self.tune_pruned_beams(nnet_output, supervision_segments)
+            dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
+            num_tot_scores, den_tot_scores = self._compute_mmi_loss_pruned(
+                num_graphs, den_graph, dense_fsa_vec)
         else:
-            #  func = _compute_mmi_loss_exact_non_optimized
-            func = _compute_mmi_loss_exact_optimized
-
-        return func(nnet_output=nnet_output,
-                    texts=texts,
-                    supervision_segments=supervision_segments,
-                    graph_compiler=self.graph_compiler,
-                    den_scale=self.den_scale)
+            dense_fsa_vec = k2.DenseFsaVec(nnet_output, supervision_segments)
+            num_den_indexes, a_to_b_map, _ = self.get_num_den_indexes(
+                num_graphs.shape[0], num_graphs.device)
+            num_tot_scores, den_tot_scores = _compute_mmi_loss_exact_optimized(
+                num_graphs, den_graph, dense_fsa_vec, num_den_indexes,
+                a_to_b_map)
+        return num_tot_scores, den_tot_scores
+
+    def _compute_tot_scores_adaptive(
+            self, num_graphs: k2.Fsa, den_graph: k2.Fsa,
+            nnet_output: torch.Tensor, supervision_segments: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''Choose an intersection strategy that fits in `self.memory_budget`
+        and return (num_tot_scores, den_tot_scores).
+
+        `supervision_segments` is sorted by decreasing number of frames, so
+        contiguous sub-batches of it can be passed to k2.DenseFsaVec as is.
+        '''
+        budget = self.memory_budget / self.bytes_per_arc
+        device = num_graphs.device
+        num_fsas = num_graphs.shape[0]
+
+        frames = supervision_segments[:, 2].to(torch.int64).cpu()
+        num_arcs = get_num_arcs_per_fsa(num_graphs).cpu()
+        den_arcs = den_graph.arcs.num_elements()
+
+        num_costs = (frames * num_arcs).tolist()
+        den_costs = (frames * den_arcs).tolist()
+        tot_num_cost = sum(num_costs)
+        tot_den_cost = sum(den_costs)
+
+        if tot_num_cost + tot_den_cost <= budget:
+            num_den_indexes, a_to_b_map, _ = self.get_num_den_indexes(
+                num_fsas, device)
+            return _compute_mmi_loss_exact_optimized(
+                num_graphs, den_graph,
+                k2.DenseFsaVec(nnet_output, supervision_segments),
+                num_den_indexes, a_to_b_map)
+
+        if max(tot_num_cost, tot_den_cost) <= budget:
+            _, _, den_indexes = self.get_num_den_indexes(num_fsas, device)
+            return _compute_mmi_loss_exact_non_optimized(
+                num_graphs, den_graph,
+                k2.DenseFsaVec(nnet_output, supervision_segments),
+                den_indexes)
+
+        costs = [n + d for n, d in zip(num_costs, den_costs)]
+        splits = split_into_sub_batches(costs, budget)
+        logging.debug(f'Splitting a batch of {num_fsas} sequences into '
+                      f'{len(splits) - 1} sub-batches for LF-MMI')
+
+        num_tot_scores = []
+        den_tot_scores = []
+        for start, end in zip(splits[:-1], splits[1:]):
+            indexes = torch.arange(start, end, dtype=torch.int32, device=device)
+            sub_num_graphs = k2.index_fsa(num_graphs, indexes)
+            dense_fsa_vec = k2.DenseFsaVec(nnet_output,
+                                           supervision_segments[start:end])
+            if sum(costs[start:end]) <= budget:
+                num_den_indexes, a_to_b_map, _ = self.get_num_den_indexes(
+                    end - start, device)
+                num_tot, den_tot = _compute_mmi_loss_exact_optimized(
+                    sub_num_graphs, den_graph, dense_fsa_vec, num_den_indexes,
+                    a_to_b_map)
+            elif max(num_costs[start], den_costs[start]) <= budget:
+                _, _, den_indexes = self.get_num_den_indexes(1, device)
+                num_tot, den_tot = _compute_mmi_loss_exact_non_optimized(
+                    sub_num_graphs, den_graph, dense_fsa_vec, den_indexes)
+            else:
+                logging.warning(
+                    f'A sequence with {frames[start].item()} frames does not '
+                    f'fit in the memory budget for the exact LF-MMI loss; '
+                    f'using pruned intersection for its den lattice')
+                num_tot, den_tot = self._compute_mmi_loss_pruned(
+                    sub_num_graphs, den_graph, dense_fsa_vec)
+            num_tot_scores.append(num_tot)
+            den_tot_scores.append(den_tot)
+
+        return torch.cat(num_tot_scores), torch.cat(den_tot_scores)
+
+    def _compute_mmi_loss_pruned(
+            self, num_graphs: k2.Fsa, den_graph: k2.Fsa,
+            dense_fsa_vec: k2.DenseFsaVec
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        return _compute_mmi_loss_pruned(
+            num_graphs,
+            den_graph,
+            dense_fsa_vec,
+            search_beam=self.search_beam,
+            output_beam=self.output_beam,
+            min_active_states=self.min_active_states,
+            max_active_states=self.max_active_states)
+
+    @torch.no_grad()
+    def tune_pruned_beams(self, nnet_output: torch.Tensor,
+                          supervision_segments: torch.Tensor) -> float:
+        '''Compare the pruned den scores with the exact ones for the
+        shortest sequences of a batch and let `self.beam_tuner` update the
+        beams. It is called explicitly with a held-out batch if
+        `self.beam_tuner.held_out` is True.
+
+        Args:
+          nnet_output:
+            A 3-D tensor of shape [N, T, C]
+          supervision_segments:
+            A 2-D tensor that will be passed to :func:`k2.DenseFsaVec`.
+            It must be sorted by decreasing number of frames.
+        Returns:
+          Return the measured error per frame.
+        '''
+        assert self.beam_tuner is not None
+        num_sequences = min(self.beam_tuner.num_sequences,
+                            supervision_segments.shape[0])
+        segments = supervision_segments[-num_sequences:]
+        dense_fsa_vec = k2.DenseFsaVec(nnet_output.detach(), segments)
+        den_graph = self.graph_compiler.den_graph
+
+        _, _, den_indexes = self.get_num_den_indexes(num_sequences,
+                                                     den_graph.device)
+        den_lats = k2.intersect_dense(k2.index_fsa(den_graph, den_indexes),
+                                      dense_fsa_vec,
+                                      output_beam=10.0)
+        exact = den_lats.get_tot_scores(log_semiring=True,
+                                        use_double_scores=True)
+
+        den_lats = k2.intersect_dense_pruned(
+            den_graph,
+            dense_fsa_vec,
+            search_beam=self.search_beam,
+            output_beam=self.output_beam,
+            min_active_states=self.min_active_states,
+            max_active_states=self.max_active_states)
+        pruned = den_lats.get_tot_scores(log_semiring=True,
+                                         use_double_scores=True)
+
+        frames = segments[:, 2].to(exact)
+        error = ((exact - pruned).abs() / frames.clamp(min=1)).mean().item()
+        self.beam_tuner.update(self, error)
+        return error
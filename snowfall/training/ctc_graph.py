@@ -3,11 +3,15 @@
 from functools import lru_cache
 from typing import Iterable
 from typing import List
+from typing import Optional
 
 import torch
 import k2
 
+from snowfall.common import Pathlike
 from snowfall.common import get_phone_symbols
+from .graph_cache import GraphCache
+from .graph_cache import fsa_fingerprint
 
 
 def build_ctc_topo(tokens: List[int]) -> k2.Fsa:
@@ -80,7 +84,8 @@ class CtcTrainingGraphCompiler(object):
                  L_inv: k2.Fsa,
                  phones: k2.SymbolTable,
                  words: k2.SymbolTable,
-                 oov: str = '<UNK>'):
+                 oov: str = '<UNK>',
+                 cache_dir: Optional[Pathlike] = None):
         '''
         Args:
           L_inv:
@@ -91,6 +96,12 @@ class CtcTrainingGraphCompiler(object):
           The word symbol table.
         oov:
           Out of vocabulary word.
+        cache_dir:
+          If not None, compiled graphs are also stored in this directory
+          and reused by later runs and by other processes sharing it.
+          Entries are keyed by the transcript and a fingerprint of
+          `L_inv` and the CTC topology, so a changed lexicon or phone set
+          never picks up stale graphs.
         '''
         if L_inv.properties & k2.fsa_properties.ARC_SORTED != 0:
             L_inv = k2.arc_sort(L_inv)
@@ -105,6 +116,11 @@ class CtcTrainingGraphCompiler(object):
         phone_ids_with_blank = [0] + phone_ids
         self.ctc_topo = k2.arc_sort(build_ctc_topo(phone_ids_with_blank))
 
+        self.graph_cache = None
+        if cache_dir is not None:
+            self.graph_cache = GraphCache(
+                cache_dir, fsa_fingerprint(self.ctc_topo, self.L_inv))
+
     def compile(self, texts: Iterable[str]) -> k2.Fsa:
         decoding_graphs = k2.create_fsa_vec(
             [self.compile_one_and_cache(text) for text in texts])
@@ -115,8 +131,17 @@ class CtcTrainingGraphCompiler(object):
 
     @lru_cache(maxsize=100000)
     def compile_one_and_cache(self, text: str) -> k2.Fsa:
-        tokens = (token if token in self.words else self.oov
-                  for token in text.split(' '))
+        tokens = [
+            token if token in self.words else self.oov
+            for token in text.split(' ')
+        ]
+        if self.graph_cache is not None:
+            # Transcripts that differ only in OOV words share a graph.
+            key = ' '.join(tokens)
+            decoding_graph = self.graph_cache.get(key)
+            if decoding_graph is not None:
+                return decoding_graph
+
         word_ids = [self.words[token] for token in tokens]
         label_graph = k2.linear_fsa(word_ids)
         decoding_graph = k2.connect(k2.intersect(label_graph,
@@ -124,4 +149,6 @@ class CtcTrainingGraphCompiler(object):
         decoding_graph = k2.arc_sort(decoding_graph)
         decoding_graph = k2.compose(self.ctc_topo, decoding_graph)
         decoding_graph = k2.connect(decoding_graph)
+        if self.graph_cache is not None:
+            self.graph_cache.put(key, decoding_graph)
         return decoding_graph
@@ -1,4 +1,4 @@
-from typing import Dict, Optional
+from typing import Dict, Iterable, Optional, Tuple
 
 import torch
 from torch import nn
@@ -17,6 +17,35 @@ def linf_norm(x):
     return torch.max(torch.abs(x))
 
 
+def _to_floats(values: Dict[str, torch.Tensor]) -> Dict[str, float]:
+    """
+    Move scalar tensors to the host with one transfer per device,
+    instead of one synchronizing ``.item()`` call per tensor.
+    """
+    by_device = {}
+    for name, val in values.items():
+        by_device.setdefault(val.device, []).append(name)
+    ans = {}
+    for names in by_device.values():
+        floats = torch.stack([values[n].float() for n in names]).tolist()
+        ans.update(zip(names, floats))
+    return {name: ans[name] for name in values}
+
+
+def _measure_norms(named_tensors: Iterable[Tuple[str, torch.Tensor]],
+                   norm: str) -> Dict[str, float]:
+    if norm == 'l1':
+        fn = l1_norm
+    elif norm == 'l2':
+        fn = l2_norm
+    elif norm == 'linf':
+        fn = linf_norm
+    else:
+        raise ValueError(f"Unknown norm type: {norm}")
+    with torch.no_grad():
+        return _to_floats({name: fn(x) for name, x in named_tensors})
+
+
 def measure_weight_norms(model: nn.Module, norm: str = 'l2') -> Dict[str, float]:
     """
     Compute the norms of the model's parameters.
@@ -25,19 +54,7 @@ def measure_weight_norms(model: nn.Module, norm: str = 'l2') -> Dict[str, float]
     :param norm: how to compute the norm. Available values: 'l1', 'l2', 'linf'
     :return: a dict mapping from parameter's name to its norm.
     """
-    with torch.no_grad():
-        norms = {}
-        for name, param in model.named_parameters():
-            if norm == 'l1':
-                val = l1_norm(param)
-            elif norm == 'l2':
-                val = l2_norm(param)
-            elif norm == 'linf':
-                val = linf_norm(param)
-            else:
-                raise ValueError(f"Unknown norm type: {norm}")
-            norms[name] = val.item()
-        return norms
+    return _measure_norms(model.named_parameters(), norm)
 
 
 def measure_semiorthogonality(model: nn.Module) -> Dict[str, float]:
@@ -60,8 +77,8 @@ def measure_semiorthogonality(model: nn.Module) -> Dict[str, float]:
                 I = torch.eye(dim, dtype=P.dtype, device=P.device)
                 Q = P - scale * I
                 score = torch.trace(torch.mm(Q, Q.t()))
-                scores[name] = score.item()
-        return scores
+                scores[name] = score
+        return _to_floats(scores)
 
 
 def measure_gradient_norms(model: nn.Module, norm: str = 'l1') -> Dict[str, float]:
@@ -71,20 +88,13 @@ def measure_gradient_norms(model: nn.Module, norm: str = 'l1') -> Dict[str, floa
     :param model: a torch.nn.Module instance
     :param norm: how to compute the norm. Available values: 'l1', 'l2', 'linf'
     :return: a dict mapping from parameter's name to its gradient's norm.
+        Parameters without gradient are skipped.
     """
-    with torch.no_grad():
-        norms = {}
-        for name, param in model.named_parameters():
-            if norm == 'l1':
-                val = l1_norm(param)
-            elif norm == 'l2':
-                val = l2_norm(param)
-            elif norm == 'linf':
-                val = linf_norm(param)
-            else:
-                raise ValueError(f"Unknown norm type: {norm}")
-            norms[name] = val.item()
-        return norms
+    return _measure_norms(
+        ((name, param.grad) for name, param in model.named_parameters()
+         if param.grad is not None),
+        norm
+    )
 
 
 def optim_step_and_measure_param_change(
@@ -112,5 +122,5 @@ def optim_step_and_measure_param_change(
         for n, p_new in model.named_parameters():
             p_orig = param_copy[n]
             delta = l2_norm(p_orig - p_new) / l2_norm(p_orig)
-            relative_change[n] = delta.item()
-    return relative_change
+            relative_change[n] = delta
+    return _to_floats(relative_change)
@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import k2
+import torch
+
+from snowfall.common import Pathlike
+
+
+def _update_hash(h, value) -> None:
+    if isinstance(value, torch.Tensor):
+        h.update(str(value.dtype).encode())
+        h.update(value.detach().contiguous().cpu().numpy().tobytes())
+    elif isinstance(value, k2.RaggedInt):
+        _update_hash(h, value.row_splits(1))
+        _update_hash(h, value.values())
+    else:
+        h.update(repr(value).encode())
+
+
+def fsa_fingerprint(*fsas: k2.Fsa) -> str:
+    '''Return a hex digest that identifies the given FSAs.
+
+    The digest covers the arcs (including scores) and every tensor
+    attribute of each FSA, so it changes whenever any of the graphs
+    that are used to build the training graphs change.
+
+    Args:
+      fsas:
+        The FSAs to fingerprint, e.g., (ctc_topo, L_inv).
+    Returns:
+      Return a string containing a SHA1 hex digest.
+    '''
+    h = hashlib.sha1()
+    for fsa in fsas:
+        for name, value in sorted(fsa.as_dict().items()):
+            h.update(name.encode())
+            _update_hash(h, value)
+    return h.hexdigest()
+
+
+class GraphCache(object):
+    '''A content-addressed on-disk store of compiled graphs.
+
+    Each graph is saved as the `as_dict()` of a k2.Fsa in its own file,
+    whose name is derived from the given key and the fingerprint of the
+    graphs used to compile it. Files are written to a temporary name
+    and then renamed, so several processes (e.g., all DDP ranks on a
+    node, or DataLoader workers) can share the same directory
+    without locking.
+    '''
+
+    def __init__(self, cache_dir: Pathlike, fingerprint: str):
+        '''
+        Args:
+          cache_dir:
+            The directory where the graphs are stored. It is created
+            if it does not exist.
+          fingerprint:
+            Identifies the graphs used for compilation. It is usually
+            the return value of :func:`fsa_fingerprint`. Graphs compiled
+            with a different fingerprint are kept in a separate
+            sub-directory and never returned.
+        '''
+        self.cache_dir = Path(cache_dir) / fingerprint[:16]
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha1(
+            f'{self.fingerprint}\n{key}'.encode('utf-8')).hexdigest()
+        return self.cache_dir / digest[:2] / f'{digest}.pt'
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def get(self, key: str) -> Optional[k2.Fsa]:
+        '''Return the graph stored under `key`, or None if there is none.'''
+        path = self._path(key)
+        if not path.is_file():
+            return None
+        try:
+            return k2.Fsa.from_dict(torch.load(path, map_location='cpu'))
+        except Exception as e:
+            # A partially written file can only be left behind by a
+            # crashed process on a file system without atomic renames.
+            # Treat it as a miss; it will be overwritten.
+            logging.warning(f'Failed to load cached graph {path}: {e}')
+            return None
+
+    def put(self, key: str, fsa: k2.Fsa) -> None:
+        '''Store `fsa` under `key`. An existing entry is replaced.'''
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(fsa.to('cpu').as_dict(), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
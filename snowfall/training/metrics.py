@@ -0,0 +1,73 @@
+from typing import Dict, Optional
+
+import torch
+import torch.distributed as dist
+
+
+class MetricsAccumulator(object):
+    '''Keeps running sums of scalar metrics, e.g., the objf and the number
+    of frames, on the device.
+
+    Adding a value does not synchronize with the host; the sums are
+    transferred, all at once, only when :meth:`reduce` is called, e.g.,
+    at log intervals.
+
+    Usage::
+
+        metrics = MetricsAccumulator(device)
+        for batch in dataloader:
+            objf, frames = ...
+            metrics.add(objf=objf, frames=frames)
+            if batch_idx % 10 == 0:
+                totals = metrics.reduce()
+    '''
+
+    def __init__(self, device: torch.device):
+        self.device = torch.device(device)
+        self.sums: Dict[str, torch.Tensor] = dict()
+
+    def add(self, **values: torch.Tensor) -> None:
+        '''Add scalar tensors (or numbers) to the sums with the same names.'''
+        for name, value in values.items():
+            value = torch.as_tensor(value).detach().to(self.device,
+                                                       torch.float64,
+                                                       non_blocking=True)
+            if name in self.sums:
+                self.sums[name] += value
+            else:
+                self.sums[name] = value.clone()
+
+    def all_reduce(self) -> None:
+        '''Sum the metrics over all processes of the default process group.
+
+        All processes must have added the same names in the same order.
+        '''
+        if not self.sums:
+            return
+        s = torch.stack(list(self.sums.values()))
+        dist.all_reduce(s, op=dist.ReduceOp.SUM)
+        self.sums = dict(zip(self.sums.keys(), s.unbind(0)))
+
+    def reduce(self, **extra: Optional[torch.Tensor]) -> Dict[str, float]:
+        '''Return the sums as Python floats, using a single device-to-host
+        transfer.
+
+        Args:
+          extra:
+            Other scalar tensors to transfer along with the sums, e.g., the
+            metrics of the current batch. They are returned under their
+            own names. None values are skipped.
+        '''
+        values = dict(self.sums)
+        for name, value in extra.items():
+            if value is not None:
+                assert name not in values, f'{name} is also a running sum'
+                values[name] = torch.as_tensor(value).detach().to(
+                    self.device, torch.float64)
+        if not values:
+            return dict()
+        floats = torch.stack(list(values.values())).tolist()
+        return dict(zip(values.keys(), floats))
+
+    def reset(self) -> None:
+        self.sums = dict()
@@ -2,14 +2,17 @@
 
 from typing import Iterable
 from typing import List
+from typing import Optional
 from typing import Tuple
 
 import k2
 import torch
 
+from snowfall.common import Pathlike
 from snowfall.common import get_phone_symbols
 from .ctc_graph import build_ctc_topo
 from ..lexicon import Lexicon
+from ..lexicon import VocabularyIndex
 
 
 def create_bigram_phone_lm(phones: List[int]) -> k2.Fsa:
@@ -48,7 +51,8 @@ class MmiTrainingGraphCompiler(object):
             lexicon: Lexicon,
             P: k2.Fsa,
             device: torch.device,
-            oov: str = '<UNK>'
+            oov: str = '<UNK>',
+            word_ids_cache: Optional[Pathlike] = None
     ):
         '''
         Args:
@@ -63,6 +67,9 @@ class MmiTrainingGraphCompiler(object):
             The word symbol table.
           oov:
             Out of vocabulary word.
+          word_ids_cache:
+            Optional file in which the word IDs of transcripts are cached.
+            See :class:`snowfall.lexicon.VocabularyIndex`.
         '''
         self.lexicon = lexicon
         L_inv = self.lexicon.L_inv.to(device)
@@ -79,6 +86,9 @@ class MmiTrainingGraphCompiler(object):
         self.oov_id = self.lexicon.words[oov]
         self.oov = oov
         self.device = device
+        self.vocab = VocabularyIndex(self.lexicon.words,
+                                     oov,
+                                     cache_file=word_ids_cache)
 
         phone_symbols = get_phone_symbols(self.lexicon.phones)
         phone_symbols_with_blank = [0] + phone_symbols
@@ -96,7 +106,13 @@ class MmiTrainingGraphCompiler(object):
 
         self.ctc_topo_P = k2.arc_sort(ctc_topo_P)
 
-
+        # The denominator graph does not depend on the transcripts, so we
+        # build it once. Its aux_labels are converted to a ragged tensor so
+        # that it can be concatenated with num_graphs by k2.cat(), which
+        # lets the loss intersect both with a single k2.intersect_dense call.
+        den_graph = k2.create_fsa_vec([self.ctc_topo_P.detach()])
+        den_graph.convert_attr_to_ragged_(name='aux_labels')
+        self.den_graph = den_graph
 
     def compile(self,
                 texts: Iterable[str],
@@ -122,16 +138,7 @@ class MmiTrainingGraphCompiler(object):
               shape of the `num_graph` if replicate_den is True; otherwise, it
               is an FsaVec containing only a single FSA.
         '''
-        num_graphs = self.build_num_graphs(texts)
-        num_graphs_with_self_loops = k2.remove_epsilon_and_add_self_loops(
-            num_graphs)
-
-        num_graphs_with_self_loops = k2.arc_sort(num_graphs_with_self_loops)
-
-        num = k2.compose(self.ctc_topo_P,
-                         num_graphs_with_self_loops,
-                         treat_epsilons_specially=False)
-        num = k2.arc_sort(num)
+        num = self.compile_num_graphs(texts)
 
         ctc_topo_P_vec = k2.create_fsa_vec([self.ctc_topo_P])
         if replicate_den:
@@ -144,6 +151,29 @@ class MmiTrainingGraphCompiler(object):
 
         return num, den
 
+    def compile_num_graphs(self, texts: Iterable[str]) -> k2.Fsa:
+        '''Create numerator graphs from transcripts.
+
+        Args:
+          texts:
+            A list of transcripts. Within a transcript, words are
+            separated by spaces.
+        Returns:
+          An FsaVec with shape `(len(texts), None, None)`. It is the result
+          of compose(ctc_topo, P, L, transcript).
+        '''
+        num_graphs = self.build_num_graphs(texts)
+        num_graphs_with_self_loops = k2.remove_epsilon_and_add_self_loops(
+            num_graphs)
+
+        num_graphs_with_self_loops = k2.arc_sort(num_graphs_with_self_loops)
+
+        num = k2.compose(self.ctc_topo_P,
+                         num_graphs_with_self_loops,
+                         treat_epsilons_specially=False)
+        num = k2.arc_sort(num)
+        return num
+
     def build_num_graphs(self, texts: List[str]) -> k2.Fsa:
         '''Convert transcript to an Fsa with the help of lexicon
         and word symbol table.
@@ -158,17 +188,8 @@ class MmiTrainingGraphCompiler(object):
           Return an FST (FsaVec) corresponding to the transcript. Its `labels` are
           phone IDs and `aux_labels` are word IDs.
         '''
-        word_ids_list = []
-        for text in texts:
-            word_ids = []
-            for word in text.split(' '):
-                if word in self.lexicon.words:
-                    word_ids.append(self.lexicon.words[word])
-                else:
-                    word_ids.append(self.oov_id)
-            word_ids_list.append(word_ids)
-
-        fsa = k2.linear_fsa(word_ids_list, self.device)
+        word_ids = self.vocab.to_ragged(texts, self.device)
+        fsa = k2.linear_fsa(word_ids)
         fsa = k2.add_epsilon_self_loops(fsa)
         assert fsa.device == self.device
         num_graphs = k2.intersect(self.L_inv,
@@ -14,6 +14,7 @@ import torch
 from .ctc_graph import build_ctc_topo
 from snowfall.common import get_phone_symbols
 from snowfall.decoding.graph import compile_HLG
+from snowfall.lexicon import VocabularyIndex
 
 
 def find_first_disambig_symbol(symbols: k2.SymbolTable) -> int:
@@ -72,6 +73,7 @@ class MmiMbrTrainingGraphCompiler(object):
         self.words = words
         self.device = device
         self.oov_id = self.words[oov]
+        self.vocab = VocabularyIndex(words, oov)
 
         phone_symbols = get_phone_symbols(phones)
         phone_symbols_with_blank = [0] + phone_symbols
@@ -174,17 +176,8 @@ class MmiMbrTrainingGraphCompiler(object):
           Return an FST (FsaVec) corresponding to the transcript. Its `labels` are
           phone IDs and `aux_labels` are word IDs.
         '''
-        word_ids_list = []
-        for text in texts:
-            word_ids = []
-            for word in text.split(' '):
-                if word in self.words:
-                    word_ids.append(self.words[word])
-                else:
-                    word_ids.append(self.oov_id)
-            word_ids_list.append(word_ids)
-
-        fsa = k2.linear_fsa(word_ids_list, self.device)
+        word_ids = self.vocab.to_ragged(texts, self.device)
+        fsa = k2.linear_fsa(word_ids)
         fsa = k2.add_epsilon_self_loops(fsa)
         num_graphs = k2.intersect(self.L_inv,
                                   fsa,
@@ -0,0 +1,245 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from lhotse.utils import nullcontext
+from snowfall.common import Pathlike
+
+# The profiler of the step being run by the current thread, if any.
+_active = threading.local()
+
+
+def active_profiler() -> Optional['StepProfiler']:
+    '''Return the profiler of the step run by the current thread, if any.'''
+    return getattr(_active, 'profiler', None)
+
+
+def profile_stage(name: str):
+    '''Time the enclosed code as stage `name` of the current step.
+
+    It does nothing when no step is being profiled in this thread, e.g.,
+    in decoding or in a background validation, so library code can be
+    instrumented unconditionally::
+
+        with profile_stage('intersect_dense'):
+            lats = k2.intersect_dense(...)
+    '''
+    profiler = active_profiler()
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
+
+
+def profile_count(name: str, value: Union[int, float, torch.Tensor]) -> None:
+    '''Add `value` to the counter `name` of the current step, if it is
+    being profiled. Tensors are only copied to the host when the step is
+    written out.'''
+    profiler = active_profiler()
+    if profiler is not None:
+        profiler.count(name, value)
+
+
+class _Step(object):
+    def __init__(self, step: int):
+        self.step = step
+        # Stage name -> list of (start, end), either CUDA events
+        # or wall clock times in seconds.
+        self.stages: Dict[str, List] = OrderedDict()
+        # Stage name -> seconds, for stages measured by the caller.
+        self.times: Dict[str, float] = OrderedDict()
+        self.counters: Dict[str, Union[int, float, torch.Tensor]] = OrderedDict()
+        self.peak_memory: Optional[int] = None
+
+
+class StepProfiler(object):
+    '''Times the stages of each training step and counts the sizes of the
+    lattices it builds.
+
+    Stages are timed with CUDA events on GPU, so that timing does not
+    synchronize with the device, and with the wall clock on CPU. The
+    events are only waited for when the finished steps are written out
+    by :meth:`flush`, e.g., at log intervals, to TensorBoard (averages over
+    the flushed steps) and to a JSONL trace (one line per step). On GPU,
+    the peak memory allocated during each step is recorded as well.
+
+    Stages may be nested, e.g., `intersect_dense` within `forward`;
+    the time of a stage entered several times in a step is summed.
+
+    Usage::
+
+        profiler = StepProfiler(device, tb_writer, 'exp/profile.jsonl')
+        for batch_idx, batch in enumerate(dataloader):
+            with profiler.step(global_batch_idx):
+                with profiler.stage('forward'):
+                    ...
+            if batch_idx % 10 == 0:
+                profiler.flush()
+    '''
+
+    def __init__(self,
+                 device: Union[str, torch.device],
+                 tb_writer: Optional[SummaryWriter] = None,
+                 trace_path: Optional[Pathlike] = None,
+                 enabled: bool = True):
+        '''
+        Args:
+          device:
+            The training device.
+          tb_writer:
+            If not None, averages are written to TensorBoard
+            under `profile/`.
+          trace_path:
+            If not None, a JSONL file to which a record is appended for
+            every step.
+          enabled:
+            If False, all methods do nothing.
+        '''
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.tb_writer = tb_writer
+        self.enabled = enabled
+        self._trace = None
+        if enabled and trace_path is not None:
+            Path(trace_path).parent.mkdir(parents=True, exist_ok=True)
+            self._trace = open(trace_path, 'a')
+        self._current: Optional[_Step] = None
+        self._finished: List[_Step] = []
+
+    @contextmanager
+    def step(self, step: int):
+        '''Profile the enclosed code as the step with index `step`.'''
+        if not self.enabled:
+            yield
+            return
+        assert self._current is None, 'Steps cannot be nested'
+        self._current = _Step(step)
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        _active.profiler = self
+        try:
+            yield
+        finally:
+            _active.profiler = None
+            if self.use_cuda:
+                self._current.peak_memory = torch.cuda.max_memory_allocated(self.device)
+            self._finished.append(self._current)
+            self._current = None
+
+    def stage(self, name: str):
+        '''Time the enclosed code as stage `name` of the current step.
+        Calls from other threads than the one running the step are
+        ignored.'''
+        if active_profiler() is not self:
+            return nullcontext()
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name: str):
+        current = self._current
+        if self.use_cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+        else:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                end = time.perf_counter()
+        current.stages.setdefault(name, []).append((start, end))
+
+    def add_time(self, name: str, seconds: float) -> None:
+        '''Add a duration measured by the caller with the wall clock, e.g.,
+        the time spent waiting for the batch, to stage `name` of the
+        current step.'''
+        if active_profiler() is self:
+            times = self._current.times
+            times[name] = times.get(name, 0.0) + seconds
+
+    def count(self, name: str, value: Union[int, float, torch.Tensor]) -> None:
+        '''Add `value` to the counter `name` of the current step.'''
+        if active_profiler() is not self:
+            return
+        counters = self._current.counters
+        if isinstance(value, torch.Tensor):
+            value = value.detach().sum()
+        if name in counters:
+            counters[name] = counters[name] + value
+        else:
+            counters[name] = value
+
+    def _resolve(self, step: _Step) -> Dict:
+        stages = OrderedDict((name, 1000.0 * seconds)
+                             for name, seconds in step.times.items())
+        for name, intervals in step.stages.items():
+            if self.use_cuda:
+                intervals[-1][1].synchronize()
+                ms = sum(start.elapsed_time(end) for start, end in intervals)
+            else:
+                ms = 1000.0 * sum(end - start for start, end in intervals)
+            stages[name] = stages.get(name, 0.0) + ms
+
+        tensors = [(name, value) for name, value in step.counters.items()
+                   if isinstance(value, torch.Tensor)]
+        counters = OrderedDict(step.counters)
+        if tensors:
+            values = torch.stack([v.to(self.device, torch.float64)
+                                  for _, v in tensors]).tolist()
+            counters.update((name, v) for (name, _), v in zip(tensors, values))
+
+        record = OrderedDict(step=step.step, stages_ms=stages, counters=counters)
+        if step.peak_memory is not None:
+            record['peak_memory_bytes'] = step.peak_memory
+        return record
+
+    def flush(self) -> List[Dict]:
+        '''Write out the steps finished since the previous call.
+
+        Returns:
+          The records of these steps, as written to the trace.
+        '''
+        if not self.enabled or not self._finished:
+            return []
+        records = [self._resolve(step) for step in self._finished]
+        self._finished = []
+
+        if self._trace is not None:
+            for record in records:
+                self._trace.write(json.dumps(record) + '\n')
+            self._trace.flush()
+
+        if self.tb_writer is not None:
+            global_step = records[-1]['step']
+            for key, suffix in (('stages_ms', '_ms'), ('counters', '')):
+                sums = OrderedDict()
+                for record in records:
+                    for name, value in record[key].items():
+                        sums[name] = sums.get(name, 0.0) + value
+                for name, value in sums.items():
+                    self.tb_writer.add_scalar(f'profile/{name}{suffix}',
+                                              value / len(records),
+                                              global_step)
+            peaks = [r['peak_memory_bytes'] for r in records
+                     if 'peak_memory_bytes' in r]
+            if peaks:
+                self.tb_writer.add_scalar('profile/peak_memory_mb',
+                                          max(peaks) / 2 ** 20, global_step)
+        return records
+
+    def close(self) -> None:
+        '''Flush the remaining steps and close the trace.'''
+        self.flush()
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
@@ -0,0 +1,676 @@
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.cuda.amp import GradScaler, autocast
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.nn.utils import clip_grad_value_
+from torch.utils.data import DataLoader
+from torch.utils.tensorboard import SummaryWriter
+
+from lhotse.utils import nullcontext
+from snowfall.common import Pathlike
+from snowfall.common import load_checkpoint, save_checkpoint
+from snowfall.common import save_training_info
+from snowfall.models import AcousticModel
+from snowfall.objectives.common import encode_supervisions
+from snowfall.objectives.mmi import LFMMILoss
+from snowfall.training.diagnostics import measure_gradient_norms, optim_step_and_measure_param_change
+from snowfall.training.metrics import MetricsAccumulator
+from snowfall.training.profiler import StepProfiler, profile_stage
+from snowfall.training.validation import ValidationScheduler
+
+
+class ObjectiveOutput(NamedTuple):
+    # The loss to minimize for the batch, normalized by the number of
+    # sequences. It requires grad in training.
+    loss: torch.Tensor
+    # The total objective function value of the batch, for reporting only.
+    # As in the recipes, it is the negated log-likelihood ratio, so the
+    # lower, the better.
+    objf: torch.Tensor
+    # The number of frames of the sequences that contributed to `objf`.
+    frames: torch.Tensor
+    # The number of frames of all sequences, including failed ones.
+    all_frames: torch.Tensor
+
+
+class Objective(object):
+    '''The training criterion plugged into a :class:`Trainer`.
+
+    Subclasses run the model on a batch and compute the loss; the trainer
+    takes care of everything else (autocast, no_grad for validation,
+    backward, gradient accumulation, optimizer steps, logging, validation
+    and checkpointing).
+    '''
+
+    def __call__(self, batch: Dict[str, Any], model: AcousticModel,
+                 global_batch_idx: Optional[int] = None) -> ObjectiveOutput:
+        '''
+        With asynchronous validation (see :class:`ValidationScheduler`),
+        it may be called from two threads at once.
+
+        Args:
+          batch:
+            A batch from a dataloader of a
+            :class:`snowfall.data.AsrDataModule`.
+          model:
+            The model, possibly wrapped in DistributedDataParallel.
+          global_batch_idx:
+            The global index of the training batch, or None in validation.
+        '''
+        raise NotImplementedError
+
+    def end_of_epoch(self, epoch: int, rank: int) -> None:
+        '''Called by :meth:`Trainer.fit` after each epoch.'''
+        pass
+
+
+class LFMMIObjective(Objective):
+    '''LF-MMI loss, optionally interpolated with the attention decoder loss
+    of the model and regularized with the output of an alignment model
+    at the beginning of training.'''
+
+    def __init__(self,
+                 loss_fn: LFMMILoss,
+                 device: torch.device,
+                 att_rate: float = 0.0,
+                 ali_model: Optional[AcousticModel] = None,
+                 ali_model_num_batches: int = 4000,
+                 accum_grad: int = 1,
+                 beam_tuning_batch: Optional[Dict[str, Any]] = None):
+        '''
+        Args:
+          loss_fn:
+            The LF-MMI loss, created once and reused for all batches.
+          device:
+            The device of the model.
+          att_rate:
+            Attention loss rate, final loss is
+            att_rate * att_loss + (1-att_rate) * mmi_loss.
+          ali_model:
+            If not None, its output is added, with a decaying scale, to the
+            network output during the first `ali_model_num_batches` updates.
+          accum_grad:
+            Number of gradient accumulation, used to count updates for
+            `ali_model`.
+          beam_tuning_batch:
+            A held-out batch, e.g., from the validation set. If not None,
+            the beams of the pruned den intersection are checked on it
+            when `loss_fn.beam_tuner` is due, instead of on a training
+            batch; the tuner must have been created with `held_out=True`.
+        '''
+        if beam_tuning_batch is not None:
+            assert loss_fn.beam_tuner is not None and \
+                loss_fn.beam_tuner.held_out
+        self.loss_fn = loss_fn
+        self.graph_compiler = loss_fn.graph_compiler
+        self.device = device
+        self.att_rate = att_rate
+        self.ali_model = ali_model
+        self.ali_model_num_batches = ali_model_num_batches
+        self.accum_grad = accum_grad
+        self.beam_tuning_batch = beam_tuning_batch
+
+    def __call__(self, batch: Dict[str, Any], model: AcousticModel,
+                 global_batch_idx: Optional[int] = None) -> ObjectiveOutput:
+        feature = batch['inputs']
+        # at entry, feature is [N, T, C]
+        feature = feature.permute(0, 2, 1)  # now feature is [N, C, T]
+        assert feature.ndim == 3
+        with profile_stage('feature_transfer'):
+            feature = feature.to(self.device)
+
+        supervisions = batch['supervisions']
+        supervision_segments, texts = encode_supervisions(supervisions)
+
+        if self.beam_tuning_batch is not None and global_batch_idx is not None \
+                and self.loss_fn.beam_tuner.is_due():
+            self._tune_pruned_beams(model)
+
+        if self.att_rate == 0:
+            # Note: Make TorchScript happy by making the supervision dict strictly
+            #       conform to type Dict[str, Tensor]
+            #       Using the attention decoder with TorchScript is currently unsupported,
+            #       we'll need to separate out the 'text' field from 'supervisions' first.
+            del supervisions['text']
+
+        with profile_stage('nnet_forward'):
+            nnet_output, encoder_memory, memory_mask = model(feature, supervisions)
+            if self.att_rate != 0.0:
+                module = model.module if hasattr(model, 'module') else model
+                att_loss = module.decoder_forward(encoder_memory, memory_mask,
+                                                  supervisions, self.graph_compiler)
+
+        if (self.ali_model is not None and global_batch_idx is not None and
+                global_batch_idx // self.accum_grad < self.ali_model_num_batches):
+            with torch.no_grad():
+                ali_model_output = self.ali_model(feature)
+            if ali_model_output.isinf().any() or ali_model_output.isnan().any():
+                logging.warning("Found 'nan' or 'inf' in ali_model_output... Setting it to zero.")
+                ali_model_output[ali_model_output.isinf()] = 0.0
+                ali_model_output[ali_model_output.isnan()] = 0.0
+            # subsampling is done slightly differently, may be small length
+            # differences.
+            min_len = min(ali_model_output.shape[2], nnet_output.shape[2])
+            # scale less than one so it will be encouraged
+            # to mimic ali_model's output
+            ali_model_scale = 500.0 / (global_batch_idx // self.accum_grad + 500)
+            nnet_output = nnet_output.clone()  # or log-softmax backprop will fail.
+            nnet_output[:, :, :min_len] += ali_model_scale * ali_model_output[:, :, :min_len]
+
+        # nnet_output is [N, C, T]
+        nnet_output = nnet_output.permute(0, 2, 1)  # now nnet_output is [N, T, C]
+
+        mmi_loss, tot_frames, all_frames = self.loss_fn(nnet_output, texts, supervision_segments)
+
+        if self.att_rate != 0.0:
+            loss = (- (1.0 - self.att_rate) * mmi_loss + self.att_rate * att_loss) / len(texts)
+        else:
+            loss = (-mmi_loss) / len(texts)
+        return ObjectiveOutput(loss=loss, objf=-mmi_loss.detach(),
+                               frames=tot_frames, all_frames=all_frames)
+
+    def _tune_pruned_beams(self, model: AcousticModel) -> None:
+        '''Check the beams of the pruned den intersection on the output of
+        `model`, in evaluation mode, on `self.beam_tuning_batch`.'''
+        # Without the DDP wrapper: only this process runs the forward.
+        module = model.module if hasattr(model, 'module') else model
+        feature = self.beam_tuning_batch['inputs'].permute(0, 2, 1)
+        feature = feature.to(self.device)
+        supervisions = {k: v for k, v in
+                        self.beam_tuning_batch['supervisions'].items()
+                        if k != 'text'}
+        supervision_segments, _ = encode_supervisions(
+            self.beam_tuning_batch['supervisions'])
+        module.eval()
+        try:
+            with torch.no_grad():
+                nnet_output, _, _ = module(feature, supervisions)
+        finally:
+            module.train()
+        self.loss_fn.tune_pruned_beams(nnet_output.permute(0, 2, 1),
+                                       supervision_segments)
+
+    def end_of_epoch(self, epoch: int, rank: int) -> None:
+        if rank == 0:
+            self.graph_compiler.vocab.save()
+
+
+class Trainer(object):
+    '''Owns the training loop shared by the recipes: the step loop,
+    gradient accumulation, the AMP grad scaler, DDP wrapping, periodic
+    validation, TensorBoard logging and checkpointing. The criterion is
+    an :class:`Objective`.
+
+    Usage::
+
+        trainer = Trainer(model, objective, optimizer, device, exp_dir, ...)
+        trainer.resume(start_epoch)
+        trainer.fit(train_dl, valid_dl, start_epoch, num_epochs)
+    '''
+
+    def __init__(self,
+                 model: AcousticModel,
+                 objective: Objective,
+                 optimizer: torch.optim.Optimizer,
+                 device: torch.device,
+                 exp_dir: Pathlike,
+                 accum_grad: int = 1,
+                 grad_clip_value: Optional[float] = 5.0,
+                 use_amp: bool = False,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 tb_writer: Optional[SummaryWriter] = None,
+                 log_interval: int = 10,
+                 validation: Optional[ValidationScheduler] = None,
+                 diagnostics_interval: int = 200,
+                 torchscript_epoch: int = -1,
+                 profiler: Optional[StepProfiler] = None):
+        '''
+        Args:
+          model:
+            The model to train. It is moved to `device` and, if `world_size`
+            is greater than 1, wrapped in DistributedDataParallel.
+          objective:
+            The training criterion.
+          optimizer:
+            The optimizer of the parameters of `model`.
+          device:
+            Training device, torch.device("cpu") or
+            torch.device("cuda", device_id).
+          exp_dir:
+            The directory in which checkpoints are saved.
+          accum_grad:
+            Number of batches whose gradients are accumulated per update.
+          grad_clip_value:
+            If not None, the gradients are clipped to this value.
+          use_amp:
+            Whether to use automatic mixed precision (AMP) training.
+          rank, world_size:
+            The rank of this process and the number of processes in DDP
+            training. Only rank 0 saves checkpoints.
+          tb_writer:
+            If not None, the TensorBoard writer.
+          log_interval:
+            Log the training objf every this many batches.
+          validation:
+            Decides when, and how, the validation objf is computed.
+            Defaults to every 200 batches, synchronously.
+          diagnostics_interval:
+            Write gradient norms and relative parameter changes to
+            TensorBoard every this many batches/updates.
+          torchscript_epoch:
+            Checkpoints of this epoch and later ones are also saved with
+            TorchScript; -1 disables it.
+          profiler:
+            If not None, it times the stages of every training step. It is
+            flushed every `log_interval` batches.
+        '''
+        model.to(device)
+        if world_size > 1:
+            model = DDP(model, device_ids=[device.index])
+        self.model = model
+        self.objective = objective
+        self.optimizer = optimizer
+        self.device = device
+        self.exp_dir = Path(exp_dir)
+        self.accum_grad = accum_grad
+        self.grad_clip_value = grad_clip_value
+        self.scaler = GradScaler(enabled=use_amp)
+        self.rank = rank
+        self.world_size = world_size
+        self.tb_writer = tb_writer
+        self.log_interval = log_interval
+        self.validation = validation if validation is not None \
+            else ValidationScheduler()
+        self.diagnostics_interval = diagnostics_interval
+        self.torchscript_epoch = torchscript_epoch
+        self.profiler = profiler if profiler is not None \
+            else StepProfiler(device, enabled=False)
+
+        self.global_batch_idx_train = 0
+        self.best_objf = np.inf
+        self.best_valid_objf = np.inf
+        self.best_epoch = 0
+
+    @property
+    def module(self) -> AcousticModel:
+        '''The model without the DDP wrapper.'''
+        return self.model.module if isinstance(self.model, DDP) else self.model
+
+    def compute_objf(self, batch: Dict[str, Any], is_training: bool,
+                     is_update: bool = False,
+                     model: Optional[AcousticModel] = None
+                    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        '''Compute the objective of one batch and, in training, back-propagate
+        it and update the model if `is_update` is True.
+
+        `model` defaults to the model being trained; another one, e.g.,
+        a snapshot of it, can be given in validation.
+
+        Returns:
+          A tuple of detached scalar tensors (objf, frames, all_frames), see
+          :class:`ObjectiveOutput`. They are not copied to the host, so that
+          the step does not wait for the device.
+        '''
+        grad_context = nullcontext if is_training else torch.no_grad
+        with profile_stage('forward'), \
+                autocast(enabled=self.scaler.is_enabled()), grad_context():
+            output = self.objective(
+                batch, self.model if model is None else model,
+                self.global_batch_idx_train if is_training else None)
+
+        if is_training:
+            with profile_stage('backward'):
+                self.scaler.scale(output.loss / self.accum_grad).backward()
+            if is_update:
+                with profile_stage('optimizer_step'):
+                    self._optimizer_step()
+
+        return output.objf.detach(), output.frames.detach(), \
+            output.all_frames.detach()
+
+    def _maybe_log_gradients(self, tag: str) -> None:
+        if self.tb_writer is not None and \
+                self.global_batch_idx_train % self.diagnostics_interval == 0:
+            self.tb_writer.add_scalars(
+                tag,
+                measure_gradient_norms(self.model, norm='l1'),
+                global_step=self.global_batch_idx_train
+            )
+
+    def _optimizer_step(self) -> None:
+        self._maybe_log_gradients('train/grad_norms')
+        self.scaler.unscale_(self.optimizer)
+        if self.grad_clip_value is not None:
+            clip_grad_value_(self.model.parameters(), self.grad_clip_value)
+        self._maybe_log_gradients('train/clipped_grad_norms')
+        if self.tb_writer is not None and (self.global_batch_idx_train // self.accum_grad) \
+                % self.diagnostics_interval == 0:
+            # Once in a time we will perform a more costly diagnostic
+            # to check the relative parameter change per minibatch.
+            deltas = optim_step_and_measure_param_change(self.model, self.optimizer, self.scaler)
+            self.tb_writer.add_scalars(
+                'train/relative_param_change_per_minibatch',
+                deltas,
+                global_step=self.global_batch_idx_train
+            )
+        else:
+            self.scaler.step(self.optimizer)
+        self.optimizer.zero_grad()
+        self.scaler.update()
+
+    def _accumulate_validation(self, dataloader: DataLoader,
+                               model: AcousticModel) -> MetricsAccumulator:
+        '''Sum the objective of `model`, which is in evaluation mode, over a
+        validation set in this process only.
+
+        It does not communicate with the other processes, so that it can
+        run in the background thread of a :class:`ValidationScheduler`.
+        '''
+        # all_frames includes the frames of the seqs that failed;
+        # frames is for display only.
+        totals = MetricsAccumulator(self.device)
+
+        from torchaudio.datasets.utils import bg_iterator
+        for batch in bg_iterator(dataloader, 2):
+            objf, frames, all_frames = self.compute_objf(batch, is_training=False,
+                                                         model=model)
+            totals.add(objf=objf, frames=frames, all_frames=all_frames)
+        return totals
+
+    def _reduce_validation(self, totals: MetricsAccumulator
+                           ) -> Tuple[float, float, float]:
+        if self.world_size > 1:
+            totals.all_reduce()
+        totals = totals.reduce()
+        return totals['objf'], totals['frames'], totals['all_frames']
+
+    def validate(self, dataloader: DataLoader) -> Tuple[float, float, float]:
+        '''Compute the objective over a validation set, summed over all
+        processes.
+
+        Returns:
+          A tuple (total_objf, total_frames, total_all_frames).
+        '''
+        self.model.eval()
+        try:
+            totals = self._accumulate_validation(dataloader, self.model)
+        finally:
+            self.model.train()
+        return self._reduce_validation(totals)
+
+    def _start_validation(self, valid_dataloader: DataLoader) -> None:
+        def run(model: AcousticModel) -> MetricsAccumulator:
+            return self._accumulate_validation(valid_dataloader, model)
+
+        # A snapshot is taken of the model without the DDP wrapper, whose
+        # forward would communicate with the other processes.
+        model = self.module if self.validation.asynchronous else self.model
+        self.validation.submit(run, model, tag=self.global_batch_idx_train)
+
+    def _finish_validation(self) -> Optional[float]:
+        '''Wait for the validation in progress, if any, and log its result.
+
+        Returns:
+          The average validation objf, or None if no validation was in
+          progress.
+        '''
+        result = self.validation.collect()
+        if result is None:
+            return None
+        global_batch_idx, totals = result
+        total_valid_objf, total_valid_frames, total_valid_all_frames = \
+            self._reduce_validation(totals)
+        valid_average_objf = total_valid_objf / total_valid_frames
+        logging.info(
+            'Validation average objf: {:.6f} over {} frames ({:.1f}% kept), '
+            'started at global batch {}'
+                .format(valid_average_objf,
+                        total_valid_frames,
+                        100.0 * total_valid_frames / total_valid_all_frames,
+                        global_batch_idx))
+
+        if self.tb_writer is not None:
+            # Logged at the step of the weights that were evaluated.
+            self.tb_writer.add_scalar('train/global_valid_average_objf',
+                                      valid_average_objf,
+                                      global_batch_idx)
+            self.module.write_tensorboard_diagnostics(
+                self.tb_writer, global_step=global_batch_idx)
+        return valid_average_objf
+
+    def _run_validation(self, valid_dataloader: DataLoader) -> Optional[float]:
+        '''Start a validation, as scheduled by `self.validation`.
+
+        Returns:
+          The average validation objf of the validation that has finished,
+          i.e., this one if it is synchronous or the previous one otherwise;
+          None if there is none.
+        '''
+        # Asynchronous validations do not overlap.
+        valid_average_objf = self._finish_validation()
+        self._start_validation(valid_dataloader)
+        if not self.validation.asynchronous:
+            valid_average_objf = self._finish_validation()
+        return valid_average_objf
+
+    def _log_progress(self, totals: MetricsAccumulator,
+                      curr_batch_objf: torch.Tensor,
+                      curr_batch_frames: torch.Tensor,
+                      curr_batch_all_frames: torch.Tensor, batch_idx: int,
+                      current_epoch: int, num_epochs: int,
+                      time_waiting_for_batch: float) -> None:
+        # The only device-to-host transfer of the metrics.
+        m = totals.reduce(curr_batch_objf=curr_batch_objf,
+                          curr_batch_frames=curr_batch_frames,
+                          curr_batch_all_frames=curr_batch_all_frames)
+        total_objf, total_frames, total_all_frames = \
+            m['objf'], m['frames'], m['all_frames']
+        curr_batch_objf = m['curr_batch_objf']
+        curr_batch_frames = m['curr_batch_frames']
+        curr_batch_all_frames = m['curr_batch_all_frames']
+        logging.info(
+            'batch {}, epoch {}/{} '
+            'global average objf: {:.6f} over {} '
+            'frames ({:.1f}% kept), current batch average objf: {:.6f} over {} frames ({:.1f}% kept) '
+            'avg time waiting for batch {:.3f}s'.format(
+                batch_idx, current_epoch, num_epochs,
+                total_objf / total_frames, total_frames,
+                100.0 * total_frames / total_all_frames,
+                curr_batch_objf / (curr_batch_frames + 0.001),
+                curr_batch_frames,
+                100.0 * curr_batch_frames / curr_batch_all_frames,
+                time_waiting_for_batch / max(1, batch_idx)))
+
+        if self.tb_writer is not None:
+            self.tb_writer.add_scalar('train/global_average_objf',
+                                      total_objf / total_frames,
+                                      self.global_batch_idx_train)
+
+            self.tb_writer.add_scalar('train/current_batch_average_objf',
+                                      curr_batch_objf / (curr_batch_frames + 0.001),
+                                      self.global_batch_idx_train)
+
+    def train_one_epoch(self, dataloader: DataLoader,
+                        valid_dataloader: DataLoader, current_epoch: int,
+                        num_epochs: int) -> Tuple[float, float]:
+        """One epoch training and validation.
+
+        Args:
+            dataloader: Training dataloader
+            valid_dataloader: Validation dataloader
+            current_epoch: current training epoch, for logging only
+            num_epochs: total number of training epochs, for logging only
+
+        Returns:
+            A tuple of 2 scalar:  (total_objf / total_frames, valid_average_objf)
+            - `total_objf / total_frames` is the average training loss
+            - `valid_average_objf` is the average validation loss
+        """
+        totals = MetricsAccumulator(self.device)
+        valid_average_objf = float('inf')
+        time_waiting_for_batch = 0
+        forward_count = 0
+        prev_timestamp = datetime.now()
+
+        self.model.train()
+        for batch_idx, batch in enumerate(dataloader):
+            forward_count += 1
+            if forward_count == self.accum_grad:
+                is_update = True
+                forward_count = 0
+            else:
+                is_update = False
+
+            self.global_batch_idx_train += 1
+            timestamp = datetime.now()
+            batch_waiting_time = (timestamp - prev_timestamp).total_seconds()
+            time_waiting_for_batch += batch_waiting_time
+
+            with self.profiler.step(self.global_batch_idx_train):
+                self.profiler.add_time('data_wait', batch_waiting_time)
+                curr_batch_objf, curr_batch_frames, curr_batch_all_frames = \
+                    self.compute_objf(batch, is_training=True, is_update=is_update)
+
+                totals.add(objf=curr_batch_objf,
+                           frames=curr_batch_frames,
+                           all_frames=curr_batch_all_frames)
+
+                if batch_idx % self.log_interval == 0:
+                    with self.profiler.stage('logging'):
+                        self._log_progress(totals, curr_batch_objf,
+                                           curr_batch_frames,
+                                           curr_batch_all_frames, batch_idx,
+                                           current_epoch, num_epochs,
+                                           time_waiting_for_batch)
+            if batch_idx % self.log_interval == 0:
+                self.profiler.flush()
+
+            if self.validation.is_due(batch_idx, self.world_size, self.device):
+                objf = self._run_validation(valid_dataloader)
+                if objf is not None:
+                    valid_average_objf = objf
+            prev_timestamp = datetime.now()
+        self.profiler.flush()
+        # The checkpoint of the epoch gets the result of its last validation.
+        objf = self._finish_validation()
+        if objf is not None:
+            valid_average_objf = objf
+        totals = totals.reduce()
+        return totals['objf'] / totals['frames'], valid_average_objf
+
+    def resume(self, start_epoch: int) -> None:
+        '''Load the checkpoint of the epoch before `start_epoch`, if any.'''
+        self.best_epoch = start_epoch
+        if start_epoch <= 0:
+            return
+        model_path = os.path.join(self.exp_dir, 'epoch-{}.pt'.format(start_epoch - 1))
+        ckpt = load_checkpoint(filename=model_path, model=self.model,
+                               optimizer=self.optimizer, scaler=self.scaler)
+        self.best_objf = ckpt['objf']
+        self.best_valid_objf = ckpt['valid_objf']
+        self.global_batch_idx_train = ckpt['global_batch_idx_train']
+        logging.info(f"epoch = {ckpt['epoch']}, objf = {self.best_objf}, valid_objf = {self.best_valid_objf}")
+
+    def save(self, epoch: int, learning_rate: float, objf: float,
+             valid_objf: float) -> None:
+        '''Save the checkpoint of `epoch` and, if its validation objf is the
+        best so far, the best model.'''
+        torchscript = self.torchscript_epoch != -1 and epoch >= self.torchscript_epoch
+        # the lower, the better
+        if valid_objf < self.best_valid_objf:
+            self.best_valid_objf = valid_objf
+            self.best_objf = objf
+            self.best_epoch = epoch
+            best_model_path = os.path.join(self.exp_dir, 'best_model.pt')
+            save_checkpoint(filename=best_model_path,
+                            optimizer=None,
+                            scheduler=None,
+                            scaler=None,
+                            model=self.model,
+                            epoch=epoch,
+                            learning_rate=learning_rate,
+                            objf=objf,
+                            valid_objf=valid_objf,
+                            global_batch_idx_train=self.global_batch_idx_train,
+                            local_rank=self.rank,
+                            torchscript=torchscript
+                            )
+            self._save_training_info(os.path.join(self.exp_dir, 'best-epoch-info'),
+                                     best_model_path, epoch, learning_rate,
+                                     objf, valid_objf)
+
+        # we always save the model for every epoch
+        model_path = os.path.join(self.exp_dir, 'epoch-{}.pt'.format(epoch))
+        save_checkpoint(filename=model_path,
+                        optimizer=self.optimizer,
+                        scheduler=None,
+                        scaler=self.scaler,
+                        model=self.model,
+                        epoch=epoch,
+                        learning_rate=learning_rate,
+                        objf=objf,
+                        valid_objf=valid_objf,
+                        global_batch_idx_train=self.global_batch_idx_train,
+                        local_rank=self.rank,
+                        torchscript=torchscript
+                        )
+        self._save_training_info(os.path.join(self.exp_dir, 'epoch-{}-info'.format(epoch)),
+                                 model_path, epoch, learning_rate, objf,
+                                 valid_objf)
+
+    def _save_training_info(self, filename: str, model_path: str, epoch: int,
+                            learning_rate: float, objf: float,
+                            valid_objf: float) -> None:
+        save_training_info(filename=filename,
+                           model_path=model_path,
+                           current_epoch=epoch,
+                           learning_rate=learning_rate,
+                           objf=objf,
+                           best_objf=self.best_objf,
+                           valid_objf=valid_objf,
+                           best_valid_objf=self.best_valid_objf,
+                           best_epoch=self.best_epoch,
+                           local_rank=self.rank)
+
+    def fit(self,
+            train_dataloader: DataLoader,
+            valid_dataloader: DataLoader,
+            start_epoch: int,
+            num_epochs: int,
+            get_learning_rate: Optional[Callable[[], float]] = None) -> None:
+        '''Train from `start_epoch` to `num_epochs` (exclusive), saving a
+        checkpoint after each epoch.
+
+        Args:
+          get_learning_rate:
+            Returns the current learning rate, for logging and
+            checkpoints. Defaults to the `lr` of the first parameter group.
+        '''
+        if get_learning_rate is None:
+            def get_learning_rate():
+                return self.optimizer.param_groups[0]['lr']
+
+        for epoch in range(start_epoch, num_epochs):
+            if hasattr(train_dataloader.sampler, 'set_epoch'):
+                train_dataloader.sampler.set_epoch(epoch)
+            curr_learning_rate = get_learning_rate()
+            if self.tb_writer is not None:
+                self.tb_writer.add_scalar('train/learning_rate', curr_learning_rate, self.global_batch_idx_train)
+                self.tb_writer.add_scalar('train/epoch', epoch, self.global_batch_idx_train)
+
+            logging.info('epoch {}, learning rate {}'.format(epoch, curr_learning_rate))
+            objf, valid_objf = self.train_one_epoch(
+                dataloader=train_dataloader,
+                valid_dataloader=valid_dataloader,
+                current_epoch=epoch,
+                num_epochs=num_epochs)
+            self.objective.end_of_epoch(epoch, self.rank)
+            self.save(epoch, curr_learning_rate, objf, valid_objf)
+        self.profiler.close()
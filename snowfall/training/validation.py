@@ -0,0 +1,151 @@
+import copy
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple, Union
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from lhotse.utils import nullcontext
+
+
+class ValidationScheduler(object):
+    '''Decides when to compute the validation objf during training and,
+    optionally, computes it in the background.
+
+    Validation is due either every `batch_interval` batches or, if
+    `time_interval` is given, when at least that many seconds have passed
+    since the previous one. In the latter case, the clock is only checked
+    every `check_interval` batches and, in DDP training, the decision of
+    rank 0 is broadcast so that all ranks validate at the same batch.
+
+    If `asynchronous` is True, the validation runs on a snapshot of the
+    weights in a background thread, on a separate CUDA stream when
+    training on GPU, while training goes on. Its result is collected at
+    the next validation point or at the end of the epoch, so it is
+    reported one interval late. It needs the memory of a second copy of
+    the model, and the objective must allow being called from two
+    threads at once.
+    '''
+
+    def __init__(self,
+                 batch_interval: int = 200,
+                 time_interval: Optional[float] = None,
+                 check_interval: int = 10,
+                 asynchronous: bool = False):
+        '''
+        Args:
+          batch_interval:
+            Validate every this many batches. Ignored if `time_interval`
+            is not None.
+          time_interval:
+            If not None, validate every this many seconds instead.
+          check_interval:
+            Used only with `time_interval`. Check the clock every this many
+            batches.
+          asynchronous:
+            If True, validate a snapshot of the model in the background.
+        '''
+        self.batch_interval = batch_interval
+        self.time_interval = time_interval
+        self.check_interval = check_interval
+        self.asynchronous = asynchronous
+        self._last_time = time.time()
+        self._executor = ThreadPoolExecutor(1) if asynchronous else None
+        # A tuple (tag, future, stream) of the validation in progress
+        self._pending: Optional[Tuple[Any, Future, Optional[torch.cuda.Stream]]] = None
+
+    def is_due(self,
+               batch_idx: int,
+               world_size: int = 1,
+               device: Union[str, torch.device] = 'cpu') -> bool:
+        '''Return True if validation should be run after the batch with
+        index `batch_idx` of the current epoch. All ranks of a DDP training
+        must call it for every batch.'''
+        if batch_idx == 0:
+            return False
+        if self.time_interval is None:
+            return batch_idx % self.batch_interval == 0
+        if batch_idx % self.check_interval != 0:
+            return False
+        due = time.time() - self._last_time >= self.time_interval
+        if world_size > 1:
+            # All ranks have to agree, since the results are all-reduced.
+            flag = torch.tensor([int(due)], device=device)
+            dist.broadcast(flag, src=0)
+            due = bool(flag.item())
+        if due:
+            self._last_time = time.time()
+        return due
+
+    def submit(self, fn: Callable[[nn.Module], Any], model: nn.Module,
+               tag: Any = None) -> None:
+        '''Run `fn(model)`.
+
+        In synchronous mode it is run right away. Otherwise, a snapshot of
+        `model` is taken and `fn` is run on it in the background.
+        The result can be retrieved with :meth:`collect`.
+
+        Args:
+          fn:
+            It computes the validation result of a model. The model is in
+            evaluation mode when it is called.
+          model:
+            The model being trained, without the DDP wrapper in
+            asynchronous mode.
+          tag:
+            Returned by :meth:`collect` along with the result, e.g., the
+            index of the batch at which the validation was started.
+        '''
+        assert self._pending is None, 'Collect the previous validation first'
+        if not self.asynchronous:
+            future = Future()
+            model.eval()
+            try:
+                future.set_result(fn(model))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                model.train()
+            self._pending = (tag, future, None)
+            return
+
+        snapshot = copy.deepcopy(model)
+        snapshot.eval()
+        snapshot.requires_grad_(False)
+
+        device = next(snapshot.parameters()).device
+        stream = None
+        if device.type == 'cuda':
+            stream = torch.cuda.Stream(device=device)
+            # The snapshot is copied on the current stream.
+            stream.wait_stream(torch.cuda.current_stream(device))
+
+        def run():
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                return fn(snapshot)
+
+        self._pending = (tag, self._executor.submit(run), stream)
+
+    @property
+    def pending(self) -> bool:
+        return self._pending is not None
+
+    def collect(self) -> Optional[Tuple[Any, Any]]:
+        '''Wait for the validation submitted last, if any.
+
+        Returns:
+          None if nothing was submitted since the last call, otherwise a
+          tuple (tag, result), where `result` is the return value of the
+          function passed to :meth:`submit`.
+        '''
+        if self._pending is None:
+            return None
+        tag, future, stream = self._pending
+        self._pending = None
+        result = future.result()
+        if stream is not None:
+            # The result may still be computed on `stream`.
+            torch.cuda.current_stream(stream.device).wait_stream(stream)
+        return tag, result
@@ -0,0 +1,68 @@
+import argparse
+import random
+
+import pytest
+
+from lhotse import CutSet
+from lhotse.cut import Cut
+from snowfall.data.asr_datamodule import AsrDataModule
+
+
+def _cuts(num_cuts: int = 100, seed: int = 0) -> CutSet:
+    rng = random.Random(seed)
+    return CutSet.from_cuts(
+        Cut(id=f'cut-{i}',
+            start=0.0,
+            duration=round(rng.uniform(1.0, 20.0), 2),
+            channel=0) for i in range(num_cuts))
+
+
+def _datamodule(valid_subset_duration: float,
+                valid_subset_seed: int = 0) -> AsrDataModule:
+    return AsrDataModule(
+        argparse.Namespace(valid_subset_duration=valid_subset_duration,
+                           valid_subset_seed=valid_subset_seed))
+
+
+@pytest.mark.parametrize('max_duration', [5.0, 100.0, 500.0])
+def test_valid_subset_within_budget(max_duration):
+    cuts = _cuts()
+    subset = _datamodule(max_duration).valid_subset(cuts)
+    assert 0 < len(subset) < len(cuts)
+    assert sum(c.duration for c in subset) <= max_duration
+    assert set(subset.ids) <= set(cuts.ids)
+
+
+def test_valid_subset_is_reproducible():
+    cuts = _cuts()
+    subset = _datamodule(200.0).valid_subset(cuts)
+    assert list(_datamodule(200.0).valid_subset(cuts).ids) == list(subset.ids)
+
+    # The selection does not depend on the order of the cuts.
+    shuffled = list(cuts)
+    random.Random(1).shuffle(shuffled)
+    assert sorted(_datamodule(200.0).valid_subset(
+        CutSet.from_cuts(shuffled)).ids) == sorted(subset.ids)
+
+
+def test_valid_subset_depends_on_seed():
+    cuts = _cuts()
+    assert sorted(_datamodule(200.0, 0).valid_subset(cuts).ids) != sorted(
+        _datamodule(200.0, 1).valid_subset(cuts).ids)
+
+
+def test_valid_subset_disabled():
+    cuts = _cuts()
+    assert _datamodule(0).valid_subset(cuts) is cuts
+    assert _datamodule(-1).valid_subset(cuts) is cuts
+
+
+def test_valid_subset_larger_than_cuts():
+    cuts = _cuts()
+    total = sum(c.duration for c in cuts)
+    assert sorted(_datamodule(total + 1).valid_subset(cuts).ids) == sorted(
+        cuts.ids)
+
+
+def test_valid_subset_no_cut_fits():
+    assert len(_datamodule(0.5).valid_subset(_cuts())) == 0
@@ -0,0 +1,137 @@
+import k2
+import pytest
+import torch
+
+from snowfall.decoding.nbest import Nbest, get_top_k_word_seqs
+
+torch.manual_seed(20210614)
+
+
+def _lattice(s: str, aux_labels) -> k2.Fsa:
+    fsa = k2.Fsa.from_str(s)
+    fsa.aux_labels = torch.tensor(aux_labels, dtype=torch.int32)
+    return fsa
+
+
+def _example_lattice() -> k2.Fsa:
+    # Paths (word sequence: score):
+    #   [10, 20]: -2      via state 1
+    #   [10]: -2.5        via state 2, the second word is epsilon
+    #   [11, 20]: -3
+    #   [10]: -3.5        duplicate of [10]
+    #   [10, 21]: -4
+    #   [11, 21]: -5
+    s = '''
+        0 1 1 -1
+        0 1 2 -2
+        0 2 3 -1.5
+        0 2 6 -2.5
+        1 3 4 -1
+        1 3 5 -3
+        2 3 4 -1
+        3 4 -1 0
+        4
+    '''
+    return _lattice(s, [10, 11, 10, 10, 20, 21, 0, -1])
+
+
+def _empty_lattice() -> k2.Fsa:
+    # The final state is not reachable, so nothing is left after connect.
+    return k2.connect(_lattice('0 1 1 0\n2', [5]))
+
+
+def _to_list(ragged: k2.RaggedInt):
+    shape = ragged.shape()
+    seq_splits = shape.row_splits(1).tolist()
+    path_splits = shape.row_splits(2).tolist()
+    values = ragged.values().tolist()
+    return [[values[path_splits[p]:path_splits[p + 1]]
+             for p in range(seq_splits[i], seq_splits[i + 1])]
+            for i in range(len(seq_splits) - 1)]
+
+
+def test_top_k_order_and_distinctness():
+    lats = k2.create_fsa_vec([_example_lattice()])
+    word_seqs = _to_list(get_top_k_word_seqs(lats, num_paths=10))
+    assert word_seqs == [[[10, 20], [10], [11, 20], [10, 21], [11, 21]]]
+
+    word_seqs = _to_list(get_top_k_word_seqs(lats, num_paths=3))
+    assert word_seqs == [[[10, 20], [10], [11, 20]]]
+
+
+def test_top_k_ties():
+    s = '''
+        0 1 1 -1
+        0 1 2 -1
+        0 1 3 -2
+        1 2 -1 0
+        2
+    '''
+    lats = k2.create_fsa_vec([_lattice(s, [7, 8, 9, -1])])
+    word_seqs = _to_list(get_top_k_word_seqs(lats, num_paths=3))
+    assert len(word_seqs[0]) == 3
+    assert sorted(word_seqs[0][:2]) == [[7], [8]]
+    assert word_seqs[0][2] == [9]
+    # The order of ties does not change from one call to the next.
+    assert _to_list(get_top_k_word_seqs(lats, num_paths=3)) == word_seqs
+    assert len(_to_list(get_top_k_word_seqs(lats, num_paths=1))[0]) == 1
+
+
+def test_top_k_empty_lattice():
+    lats = k2.create_fsa_vec(
+        [_example_lattice(), _empty_lattice(), _example_lattice()])
+    word_seqs = get_top_k_word_seqs(lats, num_paths=2)
+    assert _to_list(word_seqs) == [[[10, 20], [10]], [], [[10, 20], [10]]]
+
+    nbest = Nbest(word_seqs)
+    assert nbest.num_paths == 4
+    scores = torch.tensor([[0., 1., 2., 3.]])
+    assert nbest.argmax(scores).tolist() == [[1, -1, 3]]
+
+
+def test_argmax_no_paths():
+    lats = k2.create_fsa_vec([_empty_lattice(), _empty_lattice()])
+    nbest = Nbest(get_top_k_word_seqs(lats, num_paths=2))
+    assert nbest.num_paths == 0
+    ans = nbest.argmax(torch.zeros(3, 0))
+    assert ans.shape == (3, 2)
+    assert (ans == -1).all()
+
+
+def test_argmax_ties():
+    nbest = Nbest(k2.RaggedInt('[ [ [1] [2] [3] ] [ [4] [5] ] ]'))
+    scores = torch.tensor([[1., 2., 2., 5., 5.]])
+    # The first of the best paths of a seq is returned.
+    assert nbest.argmax(scores).tolist() == [[1, 3]]
+
+
+@pytest.mark.parametrize('num_rows', [1, 4])
+def test_argmax_matches_argmax_per_sublist(num_rows):
+    nbest = Nbest(k2.RaggedInt(
+        '[ [ [1 2] [3] ] [ ] [ [4] [5 6] [7] [8] ] [ [9] ] ]'))
+    scores = torch.randn(num_rows, nbest.num_paths)
+    ans = nbest.argmax(scores)
+    assert ans.shape == (num_rows, 4)
+    for r in range(num_rows):
+        ragged_scores = k2.RaggedFloat(nbest.seq_to_path_shape,
+                                       scores[r].contiguous())
+        expected = k2.ragged.argmax_per_sublist(ragged_scores)
+        assert ans[r].tolist() == expected.tolist()
+
+
+def test_select_best_paths():
+    lats = k2.create_fsa_vec([_example_lattice(), _example_lattice()])
+    nbest = Nbest(get_top_k_word_seqs(lats, num_paths=3))
+    # The paths of each seq are [10, 20], [10] and [11, 20].
+    scores = torch.tensor([[3., 2., 1., 1., 2., 3.],
+                           [1., 2., 3., 3., 2., 1.],
+                           [1., 3., 2., 1., 3., 2.]])
+    ans = nbest.select_best_paths(lats, scores, ['a', 'b', 'c'])
+    assert sorted(ans.keys()) == ['a', 'b', 'c']
+
+    def words(fsas: k2.Fsa):
+        return [fsas[i].labels[:-1].tolist() for i in range(fsas.shape[0])]
+
+    assert words(ans['a']) == [[10, 20], [11, 20]]
+    assert words(ans['b']) == [[11, 20], [10, 20]]
+    assert words(ans['c']) == [[10], [10]]
@@ -0,0 +1,113 @@
+import math
+
+import k2
+import pytest
+
+import snowfall.lm.arpa
+from snowfall.lm.arpa import arpa_to_fsa
+
+ARPA = '''
+\\data\\
+ngram 1=5
+ngram 2=4
+
+\\1-grams:
+-1.0 </s>
+-99 <s> -0.5
+-0.3 a -0.2
+-0.6 b -0.4
+-1.2 c -0.1
+
+\\2-grams:
+-0.1 <s> a
+-0.2 a b
+-0.7 a c
+-0.3 b </s>
+
+\\end\\
+'''
+
+# `c` is not in the symbol table, so the n-grams containing it are skipped.
+WORDS = '''
+<eps> 0
+a 1
+b 2
+#0 3
+'''
+
+
+@pytest.fixture
+def arpa_file(tmp_path):
+    filename = tmp_path / 'lm.arpa'
+    filename.write_text(ARPA)
+    return filename
+
+
+def _arcs(G: k2.Fsa):
+    '''Return the arcs of G as (src, dest, label, score) tuples, with the
+    states named after their history: 'bos' for <s>, 'null' for the
+    empty history, 'a' and 'b' for the unigram histories, and 'final'.'''
+    arcs = G.arcs.values()[:, :3].tolist()
+    scores = G.scores.tolist()
+    num_states = G.shape[0]
+
+    def dest(src, label):
+        return [d for s, d, l in arcs if s == src and l == label][0]
+
+    # The start state is <s>, whose back-off arc goes to the null history.
+    null = dest(0, 3)
+    names = {0: 'bos', null: 'null', num_states - 1: 'final'}
+    for word, label in (('a', 1), ('b', 2)):
+        names[dest(null, label)] = word
+    assert len(names) == num_states
+    return sorted((names[s], names[d], l, score)
+                  for (s, d, l), score in zip(arcs, scores))
+
+
+def _expected(arcs):
+    ln10 = math.log(10)
+    return sorted((s, d, l, score * ln10) for s, d, l, score in arcs)
+
+
+def _assert_arcs_equal(actual, expected):
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert a[:3] == e[:3]
+        assert a[3] == pytest.approx(e[3], abs=1e-5)
+
+
+@pytest.mark.parametrize('chunk_size', [32 * 1024 * 1024, 8])
+def test_arpa_to_fsa(arpa_file, monkeypatch, chunk_size):
+    # With a tiny chunk size, each section is split between workers.
+    monkeypatch.setattr(snowfall.lm.arpa, 'CHUNK_SIZE', chunk_size)
+    G = arpa_to_fsa(arpa_file, k2.SymbolTable.from_str(WORDS), num_jobs=2)
+    assert G.labels.tolist() == G.aux_labels.tolist()
+    _assert_arcs_equal(_arcs(G), _expected([
+        # Unigrams leave the null history; </s> becomes a final arc.
+        ('null', 'a', 1, -0.3),
+        ('null', 'b', 2, -0.6),
+        ('null', 'final', -1, -1.0),
+        # Back-off arcs are labeled with #0 and carry the back-off weight.
+        ('bos', 'null', 3, -0.5),
+        ('a', 'null', 3, -0.2),
+        ('b', 'null', 3, -0.4),
+        # Bigrams go to the state of their last word.
+        ('bos', 'a', 1, -0.1),
+        ('a', 'b', 2, -0.2),
+        ('b', 'final', -1, -0.3),
+    ]))
+
+
+def test_arpa_to_fsa_max_order(arpa_file):
+    G = arpa_to_fsa(arpa_file, k2.SymbolTable.from_str(WORDS),
+                    max_order=1, num_jobs=1)
+    arcs = G.arcs.values()[:, :3].tolist()
+    # A single state for the null history, which is the start state.
+    assert G.shape[0] == 2
+    ln10 = math.log(10)
+    expected = sorted([[0, 0, 1, -0.3 * ln10], [0, 0, 2, -0.6 * ln10],
+                       [0, 1, -1, -1.0 * ln10]])
+    actual = sorted(arc + [score] for arc, score in zip(arcs, G.scores.tolist()))
+    assert [a[:3] for a in actual] == [e[:3] for e in expected]
+    assert [a[3] for a in actual] == pytest.approx([e[3] for e in expected],
+                                                   abs=1e-5)
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import snowfall.lm.kneser_ney
+from snowfall.lm.kneser_ney import KneserNeyLm
+
+MAKE_KN_LM = (Path(__file__).parents[2] / 'egs' / 'librispeech' / 'asr' /
+              'simple_v1' / 'local' / 'make_kn_lm.py')
+
+# Repeated n-grams, a word seen only once, an empty line, extra
+# whitespace and a non-ASCII latin-1 word.
+CORPUS = '''a b c a b
+b a c
+a b a b d
+
+a  c\tb
+c c c a
+caf\xe9 a b
+b a c
+'''
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    filename = tmp_path / 'corpus.txt'
+    filename.write_text(CORPUS, encoding='latin-1')
+    return filename
+
+
+def _make_kn_lm(corpus: Path, ngram_order: int, tmp_path: Path) -> bytes:
+    filename = tmp_path / f'ref.{ngram_order}.arpa'
+    subprocess.run([
+        sys.executable, str(MAKE_KN_LM), '-ngram-order',
+        str(ngram_order), '-text',
+        str(corpus), '-lm',
+        str(filename)
+    ], check=True)
+    return filename.read_bytes()
+
+
+@pytest.mark.parametrize('ngram_order', [2, 3, 4])
+@pytest.mark.parametrize('chunk_size', [16 * 1024 * 1024, 8])
+def test_write_arpa_matches_make_kn_lm(corpus, tmp_path, monkeypatch,
+                                       ngram_order, chunk_size):
+    # A small chunk size splits the corpus into several chunks, whose
+    # counts are merged.
+    monkeypatch.setattr(snowfall.lm.kneser_ney, 'CHUNK_SIZE', chunk_size)
+    filename = tmp_path / 'lm.arpa'
+    lm = KneserNeyLm.from_text(corpus, ngram_order=ngram_order, num_jobs=2)
+    lm.write_arpa(filename)
+    assert filename.read_bytes() == _make_kn_lm(corpus, ngram_order,
+                                                tmp_path)
@@ -0,0 +1,229 @@
+import io
+import logging
+import math
+import multiprocessing
+import random
+from collections import defaultdict
+from typing import Dict, List, TextIO, Tuple
+
+import kaldialign
+import pytest
+
+from snowfall.common import ErrorStats, split_into_sub_batches, write_error_stats
+
+
+def _old_write_error_stats(f: TextIO, test_set_name: str, results: List[Tuple[str,str]]) -> float:
+    # write_error_stats as it was before ErrorStats, kept as a reference.
+    subs: Dict[Tuple[str,str], int] = defaultdict(int)
+    ins: Dict[str, int] = defaultdict(int)
+    dels: Dict[str, int] = defaultdict(int)
+
+    # `words` stores counts per word, as follows:
+    #   corr, ref_sub, hyp_sub, ins, dels
+    words: Dict[str, List[int]] = defaultdict(lambda: [0,0,0,0,0])
+    num_corr = 0
+    ERR = '*'
+    for ref, hyp in results:
+        ali = kaldialign.align(ref, hyp, ERR)
+        for ref_word,hyp_word in ali:
+            if ref_word == ERR:
+                ins[hyp_word] += 1
+                words[hyp_word][3] += 1
+            elif hyp_word == ERR:
+                dels[ref_word] += 1
+                words[ref_word][4] += 1
+            elif hyp_word != ref_word:
+                subs[(ref_word,hyp_word)] += 1
+                words[ref_word][1] += 1
+                words[hyp_word][2] += 1
+            else:
+                words[ref_word][0] += 1
+                num_corr += 1
+    ref_len = sum([len(r) for r,_ in results])
+    sub_errs = sum(subs.values())
+    ins_errs = sum(ins.values())
+    del_errs = sum(dels.values())
+    tot_errs = sub_errs + ins_errs + del_errs
+    tot_err_rate = '%.2f' % (100.0 * tot_errs / ref_len)
+
+    logging.info(
+        f'[{test_set_name}] %WER {tot_errs / ref_len:.2%} '
+        f'[{tot_errs} / {ref_len}, {ins_errs} ins, {del_errs} del, {sub_errs} sub ]'
+    )
+
+    print(f"%WER = {tot_err_rate}", file=f)
+    print(f"Errors: {ins_errs} insertions, {del_errs} deletions, {sub_errs} substitutions, over {ref_len} reference words ({num_corr} correct)",
+          file=f)
+    print("Search below for sections starting with PER-UTT DETAILS:, SUBSTITUTIONS:, DELETIONS:, INSERTIONS:, PER-WORD STATS:",
+          file=f)
+
+    print("", file=f)
+    print("PER-UTT DETAILS: corr or (ref->hyp)  ", file=f)
+    for ref, hyp in results:
+        ali = kaldialign.align(ref, hyp, ERR)
+        combine_successive_errors = True
+        if combine_successive_errors:
+            ali = [ [[x],[y]] for x,y in ali ]
+            for i in range(len(ali) - 1):
+                if ali[i][0] != ali[i][1] and ali[i+1][0] != ali[i+1][1]:
+                    ali[i+1][0] = ali[i][0] + ali[i+1][0]
+                    ali[i+1][1] = ali[i][1] + ali[i+1][1]
+                    ali[i] = [[],[]]
+            ali = [ [list(filter(lambda a: a != ERR, x)),
+                     list(filter(lambda a: a != ERR, y))]
+                     for x,y in ali ]
+            ali = list(filter(lambda x: x != [[],[]], ali))
+            ali = [ [ERR if x == [] else ' '.join(x),
+                     ERR if y == [] else ' '.join(y)]
+                    for x,y in ali ]
+
+        print(' '.join((ref_word if ref_word == hyp_word else f'({ref_word}->{hyp_word})'
+                        for ref_word,hyp_word in ali)), file=f)
+
+
+    print("", file=f)
+    print("SUBSTITUTIONS: count ref -> hyp", file=f)
+
+    for count,(ref,hyp) in sorted([(v,k) for k,v in subs.items()], reverse=True):
+        print(f"{count}   {ref} -> {hyp}", file=f)
+
+    print("", file=f)
+    print("DELETIONS: count ref", file=f)
+    for count,ref in sorted([(v,k) for k,v in dels.items()], reverse=True):
+        print(f"{count}   {ref}", file=f)
+
+    print("", file=f)
+    print("INSERTIONS: count hyp", file=f)
+    for count,hyp in sorted([(v,k) for k,v in ins.items()], reverse=True):
+        print(f"{count}   {hyp}", file=f)
+
+    print("", file=f)
+    print("PER-WORD STATS: word  corr tot_errs count_in_ref count_in_hyp", file=f)
+    for _,word,counts in sorted([(sum(v[1:]),k,v) for k,v in words.items()], reverse=True):
+        (corr, ref_sub, hyp_sub, ins, dels) = counts
+        tot_errs = ref_sub + hyp_sub + ins + dels
+        ref_count = corr + ref_sub + dels
+        hyp_count = corr + hyp_sub + ins
+
+        print(f"{word}   {corr} {tot_errs} {ref_count} {hyp_count}", file=f)
+    return float(tot_err_rate)
+
+
+def _random_results(num_utts: int, seed: int = 0) -> List[Tuple[List[str], List[str]]]:
+    rng = random.Random(seed)
+    vocab = [f'W{i}' for i in range(20)]
+    results = []
+    for _ in range(num_utts):
+        ref = [rng.choice(vocab) for _ in range(rng.randint(1, 15))]
+        hyp = []
+        for word in ref:
+            r = rng.random()
+            if r < 0.1:
+                continue  # deletion
+            if r < 0.2:
+                hyp.append(rng.choice(vocab))  # substitution
+            else:
+                hyp.append(word)
+            if rng.random() < 0.1:
+                hyp.append(rng.choice(vocab))  # insertion
+        results.append((ref, hyp))
+    # An utterance with an empty hypothesis
+    results.append((['W0', 'W1'], []))
+    return results
+
+
+def _write(write_fn, *args) -> Tuple[str, float]:
+    f = io.StringIO()
+    wer = write_fn(f, 'test', *args)
+    return f.getvalue(), wer
+
+
+@pytest.fixture
+def results():
+    return _random_results(200)
+
+
+def test_write_error_stats(results):
+    assert _write(write_error_stats, results) == _write(
+        _old_write_error_stats, results)
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 1000])
+def test_error_stats_update(results, batch_size):
+    stats = ErrorStats()
+    for i in range(0, len(results), batch_size):
+        stats.update(results[i:i + batch_size])
+    assert _write(stats.write) == _write(_old_write_error_stats, results)
+
+
+def test_error_stats_merge(results):
+    stats = ErrorStats()
+    stats.update(results[:50])
+    other = ErrorStats()
+    other.update(results[50:])
+    stats.merge(other)
+    assert _write(stats.write) == _write(_old_write_error_stats, results)
+
+
+def test_error_stats_pool(results):
+    with multiprocessing.Pool(2) as pool:
+        # Two instances sharing the pool, as with several LM scales
+        stats = ErrorStats(pool)
+        reversed_stats = ErrorStats(pool)
+        for i in range(0, len(results), 7):
+            stats.update(results[i:i + 7])
+            reversed_stats.update(
+                [(hyp, ref) for ref, hyp in results[i:i + 7]])
+        output = _write(stats.write)
+        reversed_output = _write(reversed_stats.write)
+
+    assert output == _write(_old_write_error_stats, results)
+    assert reversed_output == _write(_old_write_error_stats,
+                                     [(hyp, ref) for ref, hyp in results])
+
+
+def _check_splits(costs: List[int], budget: float, splits: List[int]) -> None:
+    assert splits[0] == 0
+    assert splits[-1] == len(costs)
+    for start, end in zip(splits[:-1], splits[1:]):
+        assert start < end
+        # Only a sub-batch with a single non-empty sequence may exceed
+        # the budget.
+        sub_batch = costs[start:end]
+        assert sum(sub_batch) <= budget or sum(c > 0 for c in sub_batch) == 1
+
+
+@pytest.mark.parametrize('costs, budget, expected', [
+    ([1, 2, 3, 4], 10, [0, 4]),
+    ([1, 2, 3, 4], 6, [0, 3, 4]),
+    ([1, 2, 3, 4], 5, [0, 2, 3, 4]),
+    ([3, 3, 3], 3, [0, 1, 2, 3]),
+    ([5], 1, [0, 1]),
+    ([1, 5, 1], 2, [0, 1, 2, 3]),
+    ([5, 1, 1], 2, [0, 1, 3]),
+    # Sequences of zero cost are kept with the next one.
+    ([0, 0, 5, 0], 2, [0, 3, 4]),
+])
+def test_split_into_sub_batches(costs, budget, expected):
+    splits = split_into_sub_batches(costs, budget)
+    assert splits == expected
+    _check_splits(costs, budget, splits)
+
+
+def test_split_into_sub_batches_all_over_budget():
+    costs = [10, 20, 30]
+    assert split_into_sub_batches(costs, 5) == [0, 1, 2, 3]
+
+
+def test_split_into_sub_batches_infinite_budget():
+    costs = [10**9, 1, 10**12]
+    assert split_into_sub_batches(costs, math.inf) == [0, 3]
+    assert split_into_sub_batches(costs, float('inf')) == [0, 3]
+
+
+def test_split_into_sub_batches_random():
+    rng = random.Random(0)
+    for _ in range(100):
+        costs = [rng.randint(0, 50) for _ in range(rng.randint(1, 30))]
+        budget = rng.randint(1, 100)
+        _check_splits(costs, budget, split_into_sub_batches(costs, budget))
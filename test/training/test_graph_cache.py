@@ -0,0 +1,122 @@
+import k2
+import pytest
+import torch
+
+from snowfall.training.graph_cache import GraphCache, fsa_fingerprint
+
+S = '''
+0 1 1 0.5
+0 1 2 -1.5
+1 2 -1 0
+2
+'''
+
+
+def _fsa(s: str = S) -> k2.Fsa:
+    fsa = k2.Fsa.from_str(s)
+    fsa.aux_labels = torch.tensor([3, 4, -1], dtype=torch.int32)
+    return fsa
+
+
+def _files(cache: GraphCache):
+    return sorted(p for p in cache.cache_dir.rglob('*') if p.is_file())
+
+
+def test_fingerprint_is_stable():
+    assert fsa_fingerprint(_fsa()) == fsa_fingerprint(_fsa())
+    assert fsa_fingerprint(_fsa(), _fsa()) == fsa_fingerprint(_fsa(), _fsa())
+
+
+def test_fingerprint_changes_with_graphs():
+    fingerprint = fsa_fingerprint(_fsa())
+
+    fsa = _fsa()
+    fsa.scores[0] += 1
+    assert fsa_fingerprint(fsa) != fingerprint
+
+    fsa = _fsa()
+    fsa.aux_labels[0] = 5
+    assert fsa_fingerprint(fsa) != fingerprint
+
+    fsa = _fsa()
+    fsa.phones = torch.zeros(3, dtype=torch.int32)
+    assert fsa_fingerprint(fsa) != fingerprint
+
+    assert fsa_fingerprint(_fsa(), _fsa()) != fingerprint
+
+
+def test_miss_then_hit(tmp_path):
+    cache = GraphCache(tmp_path, fsa_fingerprint(_fsa()))
+    assert 'a b' not in cache
+    assert cache.get('a b') is None
+
+    cache.put('a b', _fsa())
+    assert 'a b' in cache
+    assert 'a c' not in cache
+    assert cache.get('a c') is None
+
+    fsa = cache.get('a b')
+    expected = _fsa()
+    assert str(fsa) == str(expected)
+    assert torch.all(torch.eq(fsa.scores, expected.scores))
+    assert torch.all(torch.eq(fsa.aux_labels, expected.aux_labels))
+
+
+def test_shared_between_instances(tmp_path):
+    fingerprint = fsa_fingerprint(_fsa())
+    GraphCache(tmp_path, fingerprint).put('a b', _fsa())
+
+    assert GraphCache(tmp_path, fingerprint).get('a b') is not None
+
+    fsa = _fsa()
+    fsa.scores[0] += 1
+    other = GraphCache(tmp_path, fsa_fingerprint(fsa))
+    assert 'a b' not in other
+    assert other.get('a b') is None
+
+
+def test_put_replaces(tmp_path):
+    cache = GraphCache(tmp_path, fsa_fingerprint(_fsa()))
+    cache.put('a b', _fsa())
+    fsa = _fsa()
+    fsa.scores[0] = 10
+    cache.put('a b', fsa)
+    assert cache.get('a b').scores[0] == 10
+    assert len(_files(cache)) == 1
+
+
+def test_put_is_atomic(tmp_path, monkeypatch):
+    cache = GraphCache(tmp_path, fsa_fingerprint(_fsa()))
+    cache.put('a b', _fsa())
+    files = _files(cache)
+    assert len(files) == 1
+    assert all(p.suffix == '.pt' for p in files)
+
+    def failing_save(obj, f):
+        f.write(b'partial')
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(torch, 'save', failing_save)
+    fsa = _fsa()
+    fsa.scores[0] = 10
+    with pytest.raises(RuntimeError):
+        cache.put('a b', fsa)
+    with pytest.raises(RuntimeError):
+        cache.put('a c', fsa)
+
+    # Neither a temporary file nor a partial entry is left behind, and
+    # the previous entry is intact.
+    assert _files(cache) == files
+    assert 'a c' not in cache
+    assert cache.get('a b').scores[0] == 0.5
+
+
+def test_corrupted_entry_is_a_miss(tmp_path):
+    cache = GraphCache(tmp_path, fsa_fingerprint(_fsa()))
+    cache.put('a b', _fsa())
+    path, = _files(cache)
+    path.write_bytes(b'partial')
+    assert cache.get('a b') is None
+
+    cache.put('a b', _fsa())
+    assert cache.get('a b') is not None
@@ -0,0 +1,88 @@
+import pytest
+import torch
+import torch.distributed as dist
+
+from snowfall.training.metrics import MetricsAccumulator
+
+torch.manual_seed(20210519)
+
+
+def _batches(num_batches: int, dtype: torch.dtype = torch.float32):
+    for _ in range(num_batches):
+        yield (torch.randn(1, dtype=dtype).squeeze() * 1000,
+               torch.randint(100, 2000, (1,)).squeeze())
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float64])
+def test_reduce_matches_float_accumulation(dtype):
+    metrics = MetricsAccumulator('cpu')
+    total_objf = 0.
+    total_frames = 0.
+    for objf, frames in _batches(100, dtype):
+        metrics.add(objf=objf, frames=frames)
+        # What the training loops did before, with a transfer per batch
+        total_objf += objf.item()
+        total_frames += frames.item()
+
+    totals = metrics.reduce()
+    assert list(totals.keys()) == ['objf', 'frames']
+    assert all(isinstance(v, float) for v in totals.values())
+    assert totals['objf'] == total_objf
+    assert totals['frames'] == total_frames
+
+
+def test_add_numbers():
+    metrics = MetricsAccumulator('cpu')
+    metrics.add(objf=1.5, frames=10)
+    metrics.add(objf=torch.tensor(2.25), frames=torch.tensor(5))
+    assert metrics.reduce() == {'objf': 3.75, 'frames': 15.}
+
+
+def test_add_does_not_alias_inputs():
+    metrics = MetricsAccumulator('cpu')
+    objf = torch.tensor(1., dtype=torch.float64)
+    metrics.add(objf=objf)
+    metrics.add(objf=objf)
+    assert objf.item() == 1.
+    assert metrics.reduce() == {'objf': 2.}
+
+
+def test_reduce_extra():
+    metrics = MetricsAccumulator('cpu')
+    metrics.add(objf=torch.tensor(2.), frames=torch.tensor(4))
+    totals = metrics.reduce(batch_objf=torch.tensor(0.5), batch_frames=None)
+    assert totals == {'objf': 2., 'frames': 4., 'batch_objf': 0.5}
+    # The extra values are not accumulated.
+    assert metrics.reduce() == {'objf': 2., 'frames': 4.}
+
+    with pytest.raises(AssertionError):
+        metrics.reduce(objf=torch.tensor(1.))
+
+
+def test_reset():
+    metrics = MetricsAccumulator('cpu')
+    assert metrics.reduce() == dict()
+    metrics.add(objf=torch.tensor(2.))
+    metrics.reset()
+    assert metrics.reduce() == dict()
+    metrics.add(objf=torch.tensor(3.))
+    assert metrics.reduce() == {'objf': 3.}
+
+
+def test_all_reduce_single_process(tmp_path):
+    dist.init_process_group('gloo',
+                            init_method=f'file://{tmp_path / "init"}',
+                            rank=0,
+                            world_size=1)
+    try:
+        metrics = MetricsAccumulator('cpu')
+        metrics.all_reduce()
+        assert metrics.reduce() == dict()
+        metrics.add(objf=torch.tensor(2.), frames=torch.tensor(4))
+        metrics.all_reduce()
+        assert metrics.reduce() == {'objf': 2., 'frames': 4.}
+        # The sums can still be added to.
+        metrics.add(objf=torch.tensor(1.), frames=torch.tensor(1))
+        assert metrics.reduce() == {'objf': 3., 'frames': 5.}
+    finally:
+        dist.destroy_process_group()